@@ -2,6 +2,7 @@
 # Sets the variable "BeginTime" in ISO-8601 standard (e.g. "2020-04-29T17:04:29+0000")
 set_BeginTime () {
    BeginTime=`date -u -Iseconds`
+   BeginUs=`date -u +%s%6N`
    BeginStamp=`echo ${BeginTime%+*} | tr T ' '`
 }
 
@@ -17,3 +18,11 @@ get_Runtime() {
    timediff
    Runtime=$Dtime
 }
+
+# Appends a span from $BeginUs to now, named $1, to the trace file of the slot
+# $FMIPPN_TRACE_FILE (see fmippn/tracing.py). Does nothing if it is not set.
+trace_span() {
+   if [ ! $FMIPPN_TRACE_FILE ]; then return 0; fi
+   local EndUs=`date -u +%s%6N`
+   echo "{\"name\": \"$1\", \"cat\": \"shell\", \"ph\": \"X\", \"ts\": ${BeginUs}, \"dur\": $((EndUs-BeginUs)), \"pid\": $$, \"tid\": $$, \"args\": {\"domain\": \"${DOMAIN}\", \"timestamp\": \"${TIMESTAMP}\"}}" >> $FMIPPN_TRACE_FILE
+}
@@ -0,0 +1,131 @@
+"""Windowed nowcast accumulation products for FMI-PPN.
+
+Replaces the pamarith/composite/replace_grey chain of
+run-and-distribution/distribute_DOMAIN=ravake.sh, which makes hourly
+accumulations from cumulative ensemble mean accumulation PGM files:
+
+    acc = cumulative(end) - cumulative(end - window_length), at least 0
+    acc = nodata, where any field of the window had nodata (hourmask)
+    acc = replace_value, where replace_range[0] <= acc <= replace_range[1]
+
+Only the cumulative accumulation and the cumulative nodata count at window
+boundaries are kept, and all windows are calculated at once with vectorized
+differences of those snapshots.
+
+The hourmask masks of the shell chain are made from the nodata of the
+interpolated nowcast fields. Here the same mask is derived from the nodata
+(NaN) of the streamed fields. Radar coverage masks made elsewhere (e.g.
+mask1h files of postprocess/src/hourmask.c) can be given in addition with
+`set_coverage_mask()`.
+"""
+import numpy as np
+
+
+def window_accumulations(cumulative, nodata_count, starts, ends, replace_range=None,
+                         replace_value=0.0, coverage=None):
+    """Calculate accumulations of several windows at once.
+
+    Input:
+        cumulative -- cumulative accumulation (boundary, y, x) in mm
+        nodata_count -- cumulative number of nodata fields (boundary, y, x)
+        starts, ends -- boundary indices of window starts and ends
+        replace_range -- optional (min, max) of accumulations to replace
+        replace_value -- value for replaced accumulations (default=0.0)
+        coverage -- optional list of radar coverage masks (y, x) or None for
+                    each window, nodata where False
+
+    Output:
+        float32 array (window, y, x) in mm, NaN for nodata
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    acc = np.maximum(cumulative[ends] - cumulative[starts], 0.0).astype(np.float32)
+    if replace_range is not None:
+        acc[(acc >= replace_range[0]) & (acc <= replace_range[1])] = replace_value
+    acc[nodata_count[ends] - nodata_count[starts] > 0] = np.nan
+    for window_acc, covered in zip(acc, coverage or []):
+        if covered is not None:
+            window_acc[~covered] = np.nan
+    return acc
+
+
+class WindowedAccumulations:
+    """Windowed accumulations from streamed rain rate fields.
+
+    Usage:
+        products = WindowedAccumulations(shape, timestep=5, window_ends=[60, 120])
+        for index, rate in enumerate(ensemble_mean):  # mm/h, NaN for nodata
+            for product in products.add(index, rate):
+                ...  # dict with start, end (minutes) and accumulation (mm)
+
+    All windows are returned together when the last one is complete. If the
+    nowcast stops early, `products(last_step)` gives the complete windows.
+    """
+    def __init__(self, field_shape, timestep, window_ends=(60, 120, 180, 240), window_length=60,
+                 replace_range=None, replace_value=0.0):
+        for end in window_ends:
+            if end % timestep or window_length % timestep or end < window_length:
+                raise ValueError(f"Window ending at {end} min with length {window_length} min "
+                                 f"does not fit timestep {timestep} min")
+        self.timestep = timestep
+        self.windows = [(end - window_length, end) for end in sorted(window_ends)]
+        self.replace_range = replace_range
+        self.replace_value = replace_value
+
+        boundaries = sorted({minutes for window in self.windows for minutes in window})
+        self._boundary_index = {minutes // timestep: i for i, minutes in enumerate(boundaries)}
+        self._cumulative = np.zeros((len(boundaries),) + tuple(field_shape), dtype=np.float64)
+        self._nodata_count = np.zeros((len(boundaries),) + tuple(field_shape), dtype=np.uint16)
+        self._running = np.zeros(field_shape, dtype=np.float64)
+        self._running_nodata = np.zeros(field_shape, dtype=np.uint16)
+        self._last_step = max(self._boundary_index)
+        self._coverage = dict()
+
+    def set_coverage_mask(self, end, covered):
+        """Set radar coverage (y, x) of the window ending at `end` minutes,
+        False where the window is nodata"""
+        self._coverage[end] = np.asarray(covered, dtype=bool)
+
+    def add(self, leadtime_index, rate):
+        """Add rain rate field (mm/h) of one leadtime.
+
+        Output:
+            list of products, empty until the last window is complete
+        """
+        step = leadtime_index + 1
+        if step > self._last_step:
+            return []
+        rate = np.asarray(rate)
+        nodata = ~np.isfinite(rate)
+        self._running += np.where(nodata, 0.0, rate) * (self.timestep / 60.0)
+        self._running_nodata += nodata
+        if step in self._boundary_index:
+            self._cumulative[self._boundary_index[step]] = self._running
+            self._nodata_count[self._boundary_index[step]] = self._running_nodata
+        if step < self._last_step:
+            return []
+        return self.products()
+
+    def products(self, last_step=None):
+        """Return windows as a list of dicts with keys start, end and accumulation.
+
+        Input:
+            last_step -- number of leadtimes added, only windows ending by then
+                         are returned (default=all windows)
+        """
+        windows = self.complete_windows(last_step)
+        if not windows:
+            return []
+        starts = [self._boundary_index[start // self.timestep] for start, _ in windows]
+        ends = [self._boundary_index[end // self.timestep] for _, end in windows]
+        accs = window_accumulations(self._cumulative, self._nodata_count, starts, ends,
+                                    self.replace_range, self.replace_value,
+                                    coverage=[self._coverage.get(end) for _, end in windows])
+        return [{"start": start, "end": end, "accumulation": acc}
+                for (start, end), acc in zip(windows, accs)]
+
+    def complete_windows(self, last_step=None):
+        """Return (start, end) windows in minutes that end by `last_step` leadtimes"""
+        if last_step is None:
+            return list(self.windows)
+        return [(start, end) for start, end in self.windows if end // self.timestep <= last_step]
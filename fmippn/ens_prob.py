@@ -0,0 +1,234 @@
+"""Streaming exceedance probabilities for FMI-PPN.
+
+Probabilities are calculated from ensemble members as they are produced by
+the nowcaster, instead of reading member accumulations back from disk as
+postprocess/src/prob_thresholding.c does. Two kinds of products are made:
+
+    rate products         -- probability that the instantaneous rain rate
+                             exceeds each threshold (mm/h), one per leadtime
+    accumulation products -- probability that the rain accumulated over a
+                             window exceeds each threshold (mm), one per window
+
+Accumulation periods use the format of the PROB_THRCFG files
+(config/precipitation_thresholds_DOMAIN=*.conf):
+
+    Accumulation minutes+forecast interval[min]/number of fields:threshold1,threshold2...
+
+e.g. "30+10/5:0.5,1,2" gives 30 minute accumulations starting every 10
+minutes, five windows in total.
+
+Exceedances are kept in per-pixel uint8 counters (uint16 for ensembles with
+more than 255 members), so the memory used for the probability fields does
+not depend on ensemble size. Accumulation products are the exception: the
+nowcaster gives all members of one leadtime at a time, so every member's sum
+over a window must be kept until the window ends. They need a float32
+running sum per member, plus a snapshot of it per member for each window
+start that still has open windows. `accumulation_state_bytes()` gives the
+peak size of this state, e.g. 5 fields per member for "30+10/5" with a
+5 minute timestep. The state is released when the last window is complete.
+Probabilities are stored in percent, like in prob_thresholding.c, with 255
+marking pixels where some member had no data.
+"""
+import numpy as np
+
+PROB_NODATA = 255
+
+
+class AccumulationPeriod:
+    """Accumulation period definition, see module docstring"""
+    def __init__(self, acc_minutes, interval, n_fields, thresholds):
+        self.acc_minutes = acc_minutes
+        self.interval = interval
+        self.n_fields = n_fields
+        self.thresholds = list(thresholds)
+
+    @classmethod
+    def from_string(cls, line):
+        """Parse a line like '30+10/5:.04,0.5,1'"""
+        period, thresholds = line.split(":")
+        acc_minutes, rest = period.split("+")
+        interval, n_fields = rest.split("/")
+        return cls(int(acc_minutes), int(interval), int(n_fields),
+                   [float(thr) for thr in thresholds.split(",") if thr.strip()])
+
+    def windows(self, timestep):
+        """Return list of (start, end) windows in units of nowcast timesteps"""
+        if self.acc_minutes % timestep or self.interval % timestep:
+            raise ValueError(f"Accumulation period {self.acc_minutes}+{self.interval} is not a "
+                             f"multiple of nowcast timestep {timestep}")
+        start_step = self.interval // timestep
+        length = self.acc_minutes // timestep
+        return [(f * start_step, f * start_step + length) for f in range(self.n_fields)]
+
+
+def read_threshold_config(fname):
+    """Read accumulation periods from a PROB_THRCFG file"""
+    periods = []
+    with open(fname, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            periods.append(AccumulationPeriod.from_string(line))
+    return periods
+
+
+class _Counter:
+    """Exceedance counts for one product"""
+    def __init__(self, n_thresholds, field_shape, dtype):
+        self.counts = np.zeros((n_thresholds,) + tuple(field_shape), dtype=dtype)
+        self.invalid = np.zeros(field_shape, dtype=bool)
+        self.n_members = 0
+
+    def add(self, values, thresholds):
+        """Add exceedances of members (member, y, x)"""
+        invalid = ~np.isfinite(values)
+        self.invalid |= invalid.any(axis=0)
+        for tidx, thr in enumerate(thresholds):
+            # NaN comparisons are False, those pixels are masked on output anyway
+            self.counts[tidx] += np.count_nonzero(values >= thr, axis=0).astype(self.counts.dtype)
+        self.n_members += values.shape[0]
+
+    def probabilities(self, n_members):
+        prob = (100 * self.counts.astype(np.uint32)) // n_members
+        prob = prob.astype(np.uint8)
+        prob[:, self.invalid] = PROB_NODATA
+        return prob
+
+
+class ExceedanceProbabilities:
+    """Streaming exceedance probability engine.
+
+    Feed rain rate fields (mm/h) with `update()` as the nowcaster produces
+    them, either all members of a leadtime at once or one member at a time.
+    Each member's leadtimes must arrive in order. `update()` returns the
+    products completed by the call as a list of dictionaries with keys
+
+        kind -- "rate" or "accumulation"
+        start, end -- product validity in nowcast timesteps after analysis time
+        acc_minutes -- accumulation length (accumulation products only)
+        thresholds -- list of thresholds
+        probabilities -- uint8 array (threshold, y, x) in percent
+    """
+    def __init__(self, n_members, field_shape, timestep, rate_thresholds=(),
+                 accumulation_periods=()):
+        self.n_members = n_members
+        self.field_shape = tuple(field_shape)
+        self.timestep = timestep
+        self.rate_thresholds = list(rate_thresholds)
+        self.periods = list(accumulation_periods)
+        self._dtype = np.uint8 if n_members <= np.iinfo(np.uint8).max else np.uint16
+
+        # Accumulation windows by end step, and the steps where snapshots are needed
+        self._windows = dict()
+        for period in self.periods:
+            for start, end in period.windows(timestep):
+                self._windows.setdefault(end, []).append((start, period))
+        self._ends_by_start = dict()
+        for end, wins in self._windows.items():
+            for start, _ in wins:
+                self._ends_by_start.setdefault(start, set()).add(end)
+        self._snapshot_steps = set(self._ends_by_start)
+        self._last_step = max(self._windows) if self._windows else 0
+
+        self._rate_counters = dict()
+        self._acc_counters = dict()
+        self._cumulative = None
+        self._snapshots = dict()
+        self._done_windows = set()
+
+    def accumulation_state_bytes(self):
+        """Return peak memory use of the per-member accumulation state in bytes"""
+        if not self._windows:
+            return 0
+        open_snapshots = [sum(1 for start, ends in self._ends_by_start.items()
+                              if 0 < start <= step <= max(ends))
+                          for step in range(1, self._last_step + 1)]
+        field_bytes = self.n_members * int(np.prod(self.field_shape)) * np.dtype(np.float32).itemsize
+        return (1 + max(open_snapshots)) * field_bytes
+
+    def update(self, leadtime_index, rates, member_index=None, n_members=None):
+        """Add ensemble rain rates for one leadtime.
+
+        Input:
+            leadtime_index -- leadtime number (starting from 0)
+            rates -- rain rates in mm/h, shape (member, y, x), or (y, x) for
+                     a single member
+            member_index -- index of the first member in `rates` (default=0)
+            n_members -- number of members of this leadtime, e.g. without
+                         time-lagged members after the end of their forecast.
+                         They must be the first members and must not grow
+                         with leadtime (default=all)
+
+        Output:
+            list of completed products, see class docstring
+        """
+        rates = np.asarray(rates, dtype=np.float32)
+        if rates.ndim == 2:
+            rates = rates[np.newaxis]
+        first = 0 if member_index is None else member_index
+        members = slice(first, first + rates.shape[0])
+        step = leadtime_index + 1  # Fields are valid at the end of the step
+        n_members = self.n_members if n_members is None else n_members
+
+        completed = []
+        if self.rate_thresholds:
+            counter = self._rate_counters.setdefault(
+                step, _Counter(len(self.rate_thresholds), self.field_shape, self._dtype))
+            counter.add(rates, self.rate_thresholds)
+            if counter.n_members >= n_members:
+                del self._rate_counters[step]
+                completed.append({
+                    "kind": "rate",
+                    "start": step,
+                    "end": step,
+                    "thresholds": self.rate_thresholds,
+                    "probabilities": counter.probabilities(n_members),
+                })
+
+        if self._windows and step <= self._last_step:
+            completed.extend(self._update_accumulations(step, rates, members, n_members))
+        return completed
+
+    def _update_accumulations(self, step, rates, members, n_members):
+        if self._cumulative is None:
+            self._cumulative = np.zeros((self.n_members,) + self.field_shape, dtype=np.float32)
+        self._cumulative[members] += rates * (self.timestep / 60.0)
+
+        if step in self._snapshot_steps:
+            snapshot = self._snapshots.setdefault(
+                step, np.zeros((self.n_members,) + self.field_shape, dtype=np.float32))
+            snapshot[members] = self._cumulative[members]
+
+        completed = []
+        for start, period in self._windows.get(step, []):
+            key = (start, step, period.acc_minutes)
+            counter = self._acc_counters.setdefault(
+                key, _Counter(len(period.thresholds), self.field_shape, self._dtype))
+            accumulation = self._cumulative[members]
+            if start > 0:
+                accumulation = accumulation - self._snapshots[start][members]
+            counter.add(accumulation, period.thresholds)
+            if counter.n_members >= n_members:
+                del self._acc_counters[key]
+                self._done_windows.add((start, step, period.acc_minutes))
+                completed.append({
+                    "kind": "accumulation",
+                    "start": start,
+                    "end": step,
+                    "acc_minutes": period.acc_minutes,
+                    "thresholds": period.thresholds,
+                    "probabilities": counter.probabilities(n_members),
+                })
+        self._release_snapshots()
+        return completed
+
+    def _release_snapshots(self):
+        """Drop snapshots of window starts whose windows have all completed"""
+        for start in list(self._snapshots):
+            windows = {(start, end, period.acc_minutes) for end in self._ends_by_start[start]
+                       for wstart, period in self._windows[end] if wstart == start}
+            if windows <= self._done_windows:
+                del self._snapshots[start]
+        if len(self._done_windows) == sum(len(wins) for wins in self._windows.values()):
+            self._cumulative = None
@@ -0,0 +1,112 @@
+"""Per-pixel ensemble quantiles for FMI-PPN.
+
+Quantiles across ensemble members are calculated for all pixels at once with
+numpy.partition, which only moves the order statistics needed for the
+requested fractiles into place instead of sorting all members of every
+pixel (compare get_fractiles_per_accs() in prob_thresholding.c). Fields are
+processed in blocks of rows to bound the size of temporary arrays.
+
+Quantiles are interpolated linearly between order statistics, which is the
+default method of numpy.quantile. Pixels where any member is NaN are NaN.
+"""
+import numpy as np
+
+
+def _order_statistics(n_members, fractiles):
+    """Return lower and upper order statistic index and interpolation weight for each fractile"""
+    positions = np.asarray(fractiles, dtype=np.float64) * (n_members - 1)
+    lower = np.floor(positions).astype(np.intp)
+    upper = np.minimum(lower + 1, n_members - 1)
+    weight = positions - lower
+    return lower, upper, weight
+
+
+def ensemble_quantiles(members, fractiles, block_rows=64, out=None):
+    """Calculate quantiles across ensemble members for every pixel.
+
+    Input:
+        members -- array of shape (member, y, x)
+        fractiles -- sequence of fractiles between 0 and 1
+        block_rows -- number of rows processed at once (default=64)
+        out -- optional float32 output array of shape (fractile, y, x)
+
+    Output:
+        float32 array of shape (fractile, y, x)
+    """
+    fractiles = np.asarray(fractiles, dtype=np.float64)
+    if np.any((fractiles < 0) | (fractiles > 1)):
+        raise ValueError("Fractiles must be between 0 and 1")
+    n_members, nrows = members.shape[0], members.shape[1]
+    if out is None:
+        out = np.empty((len(fractiles),) + members.shape[1:], dtype=np.float32)
+
+    lower, upper, weight = _order_statistics(n_members, fractiles)
+    # The last member is always partitioned into place, so NaNs can be found there
+    kth = np.unique(np.concatenate((lower, upper, [n_members - 1])))
+    weight = weight.astype(np.float32)[:, np.newaxis, np.newaxis]
+
+    for row in range(0, nrows, block_rows):
+        rows = slice(row, min(row + block_rows, nrows))
+        # Members as the last, contiguous axis. This is a copy, so the
+        # original members are not reordered by partitioning.
+        block = np.ascontiguousarray(np.moveaxis(members[:, rows], 0, -1), dtype=np.float32)
+        block.partition(kth, axis=-1)
+        low, high = np.moveaxis(block[..., lower], -1, 0), np.moveaxis(block[..., upper], -1, 0)
+        result = low + weight * (high - low)
+        # NaNs are partitioned last
+        result[:, np.isnan(block[..., -1])] = np.nan
+        out[:, rows] = result
+    return out
+
+
+class QuantileBuffer:
+    """Fixed-size buffer for calculating quantiles from streamed members.
+
+    Members of one leadtime are collected into a preallocated
+    (member, y, x) buffer, and quantiles are calculated when the last member
+    of the leadtime arrives. Members may arrive one at a time or all at once,
+    but leadtimes must be completed in order.
+    """
+    def __init__(self, n_members, field_shape, fractiles, block_rows=64):
+        self.n_members = n_members
+        self.fractiles = list(fractiles)
+        self.block_rows = block_rows
+        self._buffer = np.empty((n_members,) + tuple(field_shape), dtype=np.float32)
+        self._out = np.empty((len(self.fractiles),) + tuple(field_shape), dtype=np.float32)
+        self._received = 0
+        self._leadtime = None
+
+    def add(self, leadtime_index, fields, member_index=None, n_members=None):
+        """Add members for one leadtime.
+
+        Input:
+            leadtime_index -- leadtime number (starting from 0)
+            fields -- array (member, y, x), or (y, x) for a single member
+            member_index -- index of the first member in `fields` (default=number
+                            of members already received for this leadtime)
+            n_members -- number of members of this leadtime, at most the buffer
+                         size (default=all)
+
+        Output:
+            quantiles (fractile, y, x) when the leadtime is complete, else None.
+            The returned array is reused by the next leadtime, copy it if needed.
+        """
+        if self._leadtime is None:
+            self._leadtime = leadtime_index
+        elif leadtime_index != self._leadtime:
+            raise ValueError(f"Leadtime {self._leadtime} is incomplete, got leadtime {leadtime_index}")
+
+        fields = np.asarray(fields)
+        if fields.ndim == 2:
+            fields = fields[np.newaxis]
+        first = self._received if member_index is None else member_index
+        self._buffer[first:first + fields.shape[0]] = fields
+        self._received += fields.shape[0]
+
+        n_members = self.n_members if n_members is None else n_members
+        if self._received < n_members:
+            return None
+        self._received = 0
+        self._leadtime = None
+        return ensemble_quantiles(self._buffer[:n_members], self.fractiles,
+                                  block_rows=self.block_rows, out=self._out)
@@ -0,0 +1,130 @@
+"""Online ensemble statistics for FMI-PPN.
+
+Deterministically weighted ensemble mean and spread are calculated for each
+leadtime while the nowcast fields are still in memory. The weighting follows
+postprocess/src/ensmean_determweighted.c:
+
+    determ_startw = 0.01 * determ_initweight * n_members
+    determ_lapse = 100 * determ_startw / (determ_weightspan * n_leadtimes)
+    determ_w(leadtime index i) = determ_startw - determ_lapse * i
+
+The deterministic nowcast gets weight `determ_w` (zero after it becomes
+negative, constant if determ_weightspan <= 0) and every ensemble member
+gets weight 1. Averaging is done in rain rate units (mm/h), dry pixels are
+counted as zero rain and nodata pixels are left out.
+"""
+import numpy as np
+
+import utils
+
+
+def deterministic_weights(n_members, n_leadtimes, determ_initweight, determ_weightspan):
+    """Return weight of the deterministic nowcast for each leadtime index"""
+    startw = 0.01 * determ_initweight * n_members
+    if determ_weightspan <= 0:
+        lapse = 0.0
+    else:
+        lapse = 100.0 * startw / (determ_weightspan * n_leadtimes)
+    weights = startw - lapse * np.arange(n_leadtimes)
+    weights[weights < 0] = 0.0
+    return weights
+
+
+def to_rainrate(data, unit, rain_threshold, zr_a, zr_b):
+    """Convert thresholded nowcast field to rain rate (mm/h).
+
+    Pixels under `rain_threshold` (in the units of the data) are set to zero
+    rain, non-finite pixels stay NaN.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    dry = data < rain_threshold
+    if unit.lower() == "dbz":
+        rate = ((10.0 ** (data / 10.0)) / zr_a) ** (1.0 / zr_b)
+    elif unit.lower() in {"mm/h", "rrate"}:
+        rate = data.copy()
+    else:
+        raise ValueError(f"Cannot convert unit '{unit}' to rain rate")
+    rate[dry] = 0.0
+    return rate
+
+
+class EnsembleStatistics:
+    """Deterministically weighted ensemble mean and spread per leadtime.
+
+    Usage:
+        stats = EnsembleStatistics(n_members, n_leadtimes, 100, 150, zr_a, zr_b, rain_thr)
+        stats.set_deterministic(deterministic, "dBZ")  # optional, (leadtime, y, x)
+        mean, spread = stats.update(0, members, "dBZ")  # members: (member, y, x)
+    """
+    def __init__(self, n_members, n_leadtimes, determ_initweight, determ_weightspan,
+                 zr_a, zr_b, rain_threshold):
+        self.n_members = n_members
+        self.n_leadtimes = n_leadtimes
+        self.zr_a = zr_a
+        self.zr_b = zr_b
+        self.rain_threshold = rain_threshold
+        self.determ_weights = deterministic_weights(n_members, n_leadtimes,
+                                                    determ_initweight, determ_weightspan)
+        self._deterministic = None
+
+    def set_deterministic(self, deterministic, unit):
+        """Store deterministic nowcast (leadtime, y, x) as rain rate for weighting"""
+        self._deterministic = to_rainrate(deterministic, unit, self.rain_threshold,
+                                          self.zr_a, self.zr_b)
+
+    def update(self, leadtime_index, members, unit):
+        """Calculate statistics for one leadtime.
+
+        Input:
+            leadtime_index -- leadtime number (starting from 0)
+            members -- ensemble fields for this leadtime (member, y, x)
+            unit -- unit of `members` ("dBZ" or "mm/h")
+
+        Output:
+            tuple (mean, spread) of rain rate fields in mm/h, NaN where
+            no valid values were available
+        """
+        rate = to_rainrate(members, unit, self.rain_threshold, self.zr_a, self.zr_b)
+        valid = np.isfinite(rate)
+        rate[~valid] = 0.0
+
+        weight_sum = valid.sum(axis=0, dtype=np.float32)
+        rate_sum = rate.sum(axis=0)
+        sq_sum = np.einsum("ijk,ijk->jk", rate, rate)
+
+        determ_w = self.determ_weights[leadtime_index]
+        if self._deterministic is not None and determ_w > 0:
+            det = self._deterministic[leadtime_index]
+            det_valid = np.isfinite(det)
+            det = np.where(det_valid, det, 0.0)
+            weight_sum += determ_w * det_valid
+            rate_sum += determ_w * det
+            sq_sum += determ_w * det * det
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = rate_sum / weight_sum
+            variance = sq_sum / weight_sum - mean * mean
+        spread = np.sqrt(np.maximum(variance, 0.0))
+        return mean, spread
+
+
+def pack_statistics(field, options):
+    """Scale rain rate statistics field for writing.
+
+    Output:
+        tuple (packed_field, scale_meta) similar to utils.prepare_data_for_writing
+    """
+    dtype = np.dtype(options.get("convert_to_dtype", "uint16"))
+    gain = options.get("gain", 0.01)
+    offset = options.get("offset", 0.0)
+    nodata = np.iinfo(dtype).max
+    packed = np.rint(utils.pack_value(field, gain, offset))
+    packed = np.clip(packed, np.iinfo(dtype).min, nodata - 1)
+    packed[~np.isfinite(field)] = nodata
+    scale_meta = {
+        "gain": gain,
+        "offset": offset,
+        "nodata": nodata,
+        "undetect": utils.pack_value(0.0, gain, offset),
+    }
+    return packed.astype(dtype), scale_meta
@@ -0,0 +1,110 @@
+"""Time-lagged ensemble members for FMI-PPN.
+
+The previous run started one nowcast timestep earlier, so its leadtime k+1
+is valid at the same time as leadtime k of the current run. Its stored
+members are read back with ppn_reader, shifted by the lag and appended to
+the current ensemble as extra members.
+
+The last `lag` leadtimes of the current run are beyond the previous run's
+forecast, and lagged members are nodata (NaN) there. Ensemble products
+(probabilities, quantiles, statistics) use the lagged members only for the
+leadtimes given by `LaggedMembers.valid_leadtimes`, the stored members keep
+the nodata.
+"""
+import datetime as dt
+
+import numpy as np
+
+import ppn_reader
+
+
+def previous_startdate(startdate, lag_minutes):
+    """Return analysis time of the run whose members are used as lagged members"""
+    return startdate - dt.timedelta(minutes=lag_minutes)
+
+
+class LaggedMembers:
+    """Members of a previous run aligned to the leadtimes of this run.
+
+    The previous output stays open and members are read one leadtime at a
+    time, so the whole previous ensemble is not kept in memory:
+
+        lagged = open_lagged_members(path, startdate, 5, 5, n_leadtimes=12)
+        fields = lagged.leadtime(0)  # (member, y, x)
+        lagged.close()
+    """
+    def __init__(self, prev, startdate, timestep, n_leadtimes, n_members, undetect_value=None):
+        self._prev = prev
+        self._members = prev.ensemble.decoded(undetect_value=undetect_value)
+        self.n_members = n_members
+        self.n_leadtimes = n_leadtimes
+        self.field_shape = tuple(prev.ensemble.shape[2:])
+        prev_index = {time: i for i, time in enumerate(prev.valid_times)}
+        # Leadtime index of this run -> leadtime index of the previous run
+        self._index = dict()
+        for index in range(n_leadtimes):
+            validtime = startdate + (index + 1) * dt.timedelta(minutes=timestep)
+            if validtime in prev_index:
+                self._index[index] = prev_index[validtime]
+
+    @property
+    def valid_leadtimes(self):
+        """Number of leading leadtimes that the previous run covers. Later
+        leadtimes are left out of ensemble products even if some of them
+        have data, so that accumulations over several leadtimes have the same
+        members throughout."""
+        count = 0
+        while count in self._index:
+            count += 1
+        return count
+
+    def leadtime(self, index):
+        """Return float32 members (member, y, x) of leadtime `index` in the
+        physical units of the stored output, NaN where the previous run has
+        no data"""
+        if index not in self._index:
+            return np.full((self.n_members,) + self.field_shape, np.nan, dtype=np.float32)
+        return self._members[:self.n_members, self._index[index]].astype(np.float32)
+
+    def load(self):
+        """Return all leadtimes as a float32 array (member, leadtime, y, x)"""
+        lagged = np.empty((self.n_members, self.n_leadtimes) + self.field_shape, dtype=np.float32)
+        for index in range(self.n_leadtimes):
+            lagged[:, index] = self.leadtime(index)
+        return lagged
+
+    def close(self):
+        self._prev.close()
+
+
+def open_lagged_members(path, startdate, lag_minutes, timestep, n_leadtimes, max_members=None,
+                        config=None, undetect_value=None):
+    """Open members of a previous run for reading them leadtime by leadtime.
+
+    Input:
+        path -- ensemble output file, or callback output folder, of the previous run
+        startdate -- analysis time of this run
+        lag_minutes -- age of the previous run in minutes (multiple of `timestep`)
+        timestep -- nowcast timestep in minutes
+        n_leadtimes -- number of leadtimes in this run
+        max_members -- use at most this many members, taken from the start
+                       (lagged members of the previous run are stored last)
+        config -- config name for selecting runs from a callback folder
+        undetect_value -- value for undetect pixels (default=unpack them)
+
+    Output:
+        LaggedMembers object, close() it when done
+    """
+    if lag_minutes % timestep:
+        raise ValueError(f"Lag {lag_minutes} min is not a multiple of nowcast timestep {timestep} min")
+    prev_start = previous_startdate(startdate, lag_minutes)
+
+    prev = ppn_reader.open_output(path, startdate=prev_start, config=config)
+    if prev.ensemble is None:
+        prev.close()
+        raise ValueError(f"No ensemble members found in {path}")
+    n_members = prev.ensemble.shape[0]
+    if max_members is not None:
+        n_members = min(n_members, max_members)
+    return LaggedMembers(prev, startdate, timestep, n_leadtimes, n_members,
+                         undetect_value=undetect_value)
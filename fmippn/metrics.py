@@ -0,0 +1,224 @@
+"""Per-stage timing and memory metrics for FMI-PPN.
+
+Like ppn_logger, the collector is a module-level object: `start_run()`
+enables it, `stage(name)` (context manager) and `timed(name)` (decorator)
+measure stages, and `finish_run()` writes the results. Without a started
+run, `stage()` and `timed()` do nothing.
+
+For each stage name the collector keeps the number of calls, total and
+maximum wall time, process peak RSS after the stage and how much the stage
+raised it, and the current RSS. With `trace_allocations` the bytes
+allocated through Python and numpy (tracemalloc) are recorded as well,
+which slows the run down. Stages can be nested, and the time of an outer
+stage includes its inner stages.
+
+Each stage is also recorded as a span in the trace (see tracing.py) when
+tracing is started.
+
+Output is one JSON record per run, appended to a JSON lines file, and
+optionally a Prometheus text exposition file (e.g. for the node exporter
+textfile collector), which is replaced on each run.
+"""
+import contextlib
+import functools
+import json
+import os
+import resource
+import socket
+import time
+import tracemalloc
+from pathlib import Path
+
+import tracing
+
+_collector = None
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StageMetrics:
+    """Accumulated metrics of one stage name"""
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.peak_rss_increase_bytes = 0
+        self.rss_bytes = None
+        self.allocated_bytes = None
+
+    def add(self, seconds, peak_before, peak_after, rss, allocated):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, peak_after)
+        self.peak_rss_increase_bytes += peak_after - peak_before
+        if rss is not None:
+            self.rss_bytes = max(self.rss_bytes or 0, rss)
+        if allocated is not None:
+            self.allocated_bytes = (self.allocated_bytes or 0) + allocated
+
+    def as_dict(self):
+        return {key: value for key, value in vars(self).items() if value is not None}
+
+
+class RunCollector:
+    """Metrics of one run"""
+    def __init__(self, labels, trace_allocations=False):
+        self.labels = labels
+        self.stages = dict()
+        self.trace_allocations = trace_allocations
+        self._start = time.perf_counter()
+        self._started_at = time.time()
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        peak_before = _peak_rss_bytes()
+        traced_before = tracemalloc.get_traced_memory()[0] if self.trace_allocations else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            allocated = None
+            if self.trace_allocations:
+                allocated = max(tracemalloc.get_traced_memory()[0] - traced_before, 0)
+            self.stages.setdefault(name, StageMetrics()).add(
+                seconds, peak_before, _peak_rss_bytes(), _current_rss_bytes(), allocated)
+
+    def record(self):
+        """Return metrics of the run as a JSON serializable dictionary"""
+        record = dict(self.labels)
+        record.update({
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started_at": self._started_at,
+            "total_seconds": time.perf_counter() - self._start,
+            "peak_rss_bytes": _peak_rss_bytes(),
+            "stages": {name: stage.as_dict() for name, stage in self.stages.items()},
+        })
+        if self.trace_allocations:
+            record["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        return record
+
+
+def start_run(trace_allocations=False, **labels):
+    """Start collecting metrics. `labels` (e.g. config, startdate) are
+    stored in the record, config is also the exposition label."""
+    global _collector
+    _collector = RunCollector(labels, trace_allocations=trace_allocations)
+    return _collector
+
+
+def annotate(**labels):
+    """Add labels (e.g. run cache status) to the record of the current run"""
+    if _collector is not None:
+        _collector.labels.update(labels)
+
+
+@contextlib.contextmanager
+def _stage_and_span(name, **args):
+    with tracing.span(name, **args), _collector.stage(name):
+        yield
+
+
+def stage(name, **args):
+    """Context manager measuring stage `name`, no-op if no run is started.
+    `args` are stored in the trace span only."""
+    if _collector is None:
+        return tracing.span(name, **args)
+    return _stage_and_span(name, **args)
+
+
+def timed(name):
+    """Decorator measuring each call of the function as stage `name`"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _label_string(labels):
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"')
+               for key, value in labels.items()}
+    return ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+
+def exposition(record):
+    """Return run record in Prometheus text exposition format"""
+    # Only config as label, startdate would make a new series on every run
+    labels = {"config": record.get("config")}
+    lines = [
+        "# HELP fmippn_run_seconds Wall time of the last run",
+        "# TYPE fmippn_run_seconds gauge",
+        f"fmippn_run_seconds{{{_label_string(labels)}}} {record['total_seconds']:.6f}",
+        "# HELP fmippn_run_peak_rss_bytes Peak resident set size of the last run",
+        "# TYPE fmippn_run_peak_rss_bytes gauge",
+        f"fmippn_run_peak_rss_bytes{{{_label_string(labels)}}} {record['peak_rss_bytes']}",
+    ]
+    stage_metrics = (
+        ("seconds", "fmippn_stage_seconds", "Total wall time of the stage in the last run"),
+        ("max_seconds", "fmippn_stage_max_seconds", "Longest single call of the stage"),
+        ("calls", "fmippn_stage_calls", "Number of calls of the stage"),
+        ("peak_rss_increase_bytes", "fmippn_stage_peak_rss_increase_bytes",
+         "Increase of process peak RSS during the stage"),
+        ("allocated_bytes", "fmippn_stage_allocated_bytes", "Net bytes allocated in the stage"),
+    )
+    for key, metric, description in stage_metrics:
+        values = [(name, stage[key]) for name, stage in record["stages"].items() if key in stage]
+        if not values:
+            continue
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name, value in values:
+            stage_labels = dict(labels, stage=name)
+            lines.append(f"{metric}{{{_label_string(stage_labels)}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def finish_run(json_file=None, exposition_file=None):
+    """Stop collecting and write the run record.
+
+    Input:
+        json_file -- JSON lines file, the record is appended (default=None)
+        exposition_file -- Prometheus text file, replaced (default=None)
+
+    Output:
+        run record (dictionary), None if no run was started
+    """
+    global _collector
+    if _collector is None:
+        return None
+    record = _collector.record()
+    if _collector.trace_allocations:
+        tracemalloc.stop()
+    _collector = None
+
+    if json_file is not None:
+        Path(json_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(json_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    if exposition_file is not None:
+        exposition_file = Path(exposition_file)
+        exposition_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fname = exposition_file.with_name(f".{exposition_file.name}.{os.getpid()}")
+        with open(tmp_fname, "w") as f:
+            f.write(exposition(record))
+        os.replace(tmp_fname, exposition_file)
+    return record
@@ -0,0 +1,259 @@
+"""Temporal interpolation of nowcast fields along motion for FMI-PPN.
+
+Accumulations between consecutive nowcast fields are calculated with
+`intsteps` sub-steps, following the trajectories of the motion field, in the
+same way as postprocess/src/thread_member_interp.c:
+
+  * For every interpolation sub-step, the source pixel of the trajectory
+    "from past" (backwards along motion) and "from future" (forwards along
+    motion) are looked up from tables. Tables of the shared motion are
+    calculated once per run. Tables of per-member motion would need
+    2 * (intsteps-1) * y * x int32 per member, so they are calculated chunk
+    by chunk for each leadtime instead of kept.
+  * The rain rate of a sub-step is interpolated linearly in time between
+    the past and future source pixels.
+  * Nodata areas of the past field are advected one timestep forward.
+
+All members are processed with vectorized gathers over blocks of pixels, as
+soon as their leadtimes arrive. Accumulation files compatible with the
+RAVAKE accumulation files of thread_member_interp.c (int32, unit 1e-5 mm,
+-1 for nodata, all members of a leadtime in one file) can be written with
+`write_ravake_accumulation()`.
+"""
+import numpy as np
+
+# Accumulation unit of RAVAKE accumulation files (mm)
+RAVAKE_ACC_UNIT = 1e-5
+RAVAKE_ACC_NODATA = -1
+
+
+class TrajectoryTables:
+    """Trajectory source pixel tables for one motion field.
+
+    Attributes:
+        past -- int32 array (intsteps-1, y*x), flat source pixel index of the
+                trajectory from past field for each sub-step, -1 if outside
+        future -- same for the trajectory from future field
+        one_step -- int32 array (y*x), source pixel of a whole timestep
+                    displacement, used for advecting nodata
+
+    With precompute=False the tables are not kept. `tables()` then calculates
+    them for the requested pixels only, which keeps memory use to one chunk
+    at the cost of recalculating them for every leadtime.
+    """
+    def __init__(self, motion, intsteps, precompute=True):
+        """Calculate the tables.
+
+        Input:
+            motion -- motion field (2, y, x) in pixels per nowcast timestep,
+                      x component first (pysteps convention)
+            intsteps -- number of interpolation sub-steps per timestep
+            precompute -- calculate and keep the tables of all pixels (default=True)
+        """
+        self._motion = np.asarray(motion)
+        self.shape = self._motion.shape[1:]
+        self.intsteps = intsteps
+        self.past = None
+        self.future = None
+        self._one_step = None
+        if precompute:
+            npix = self.shape[0] * self.shape[1]
+            self.past, self.future = self._trajectories(slice(0, npix))
+            self._one_step = self._one_step_index()
+
+    @property
+    def one_step(self):
+        if self._one_step is not None:
+            return self._one_step
+        return self._one_step_index()
+
+    def tables(self, pix):
+        """Return tables (past, future) of pixel slice `pix`, each (intsteps-1, pixels)"""
+        if self.past is not None:
+            return self.past[:, pix], self.future[:, pix]
+        return self._trajectories(pix)
+
+    def _pixel_centres(self, pix):
+        yy, xx = np.divmod(np.arange(pix.start, pix.stop), self.shape[1])
+        return xx + 0.5, yy + 0.5
+
+    def _one_step_index(self):
+        npix = self.shape[0] * self.shape[1]
+        xx, yy = self._pixel_centres(slice(0, npix))
+        return self._source_index(xx - self._motion[0].reshape(-1), yy - self._motion[1].reshape(-1))
+
+    def _trajectories(self, pix):
+        intsteps = self.intsteps
+        intlen = intsteps - 1
+        xx, yy = self._pixel_centres(pix)
+        npix = xx.size
+
+        # Motion vectors scaled to sub-step length, for all pixels, as the
+        # trajectories continue with the motion at their source points
+        mo_x = self._motion[0].reshape(-1)
+        mo_y = self._motion[1].reshape(-1)
+        past = np.empty((intlen, npix), dtype=np.int32)
+        future = np.empty((intlen, npix), dtype=np.int32)
+
+        for table, sign in ((past, -1.0), (future, 1.0)):
+            dx = mo_x[pix] / intsteps
+            dy = mo_y[pix] / intsteps
+            own = np.arange(pix.start, pix.stop)
+            for i in range(intlen):
+                source = self._source_index(xx + sign * dx, yy + sign * dy)
+                # Trajectory continues with the motion at the source point
+                motion_at = np.where(source >= 0, source, own)
+                dx += mo_x[motion_at] / intsteps
+                dy += mo_y[motion_at] / intsteps
+                # Past trajectory is weighted from the start, future from the end
+                weight_index = i if sign < 0 else intlen - i - 1
+                table[weight_index] = source
+        return past, future
+
+    def _source_index(self, x, y):
+        ysize, xsize = self.shape
+        # Truncation like (int32_t) cast in the C implementation
+        ix = x.astype(np.int64)
+        iy = y.astype(np.int64)
+        inside = (ix >= 0) & (ix < xsize) & (iy >= 0) & (iy < ysize)
+        return np.where(inside, iy * xsize + ix, -1).astype(np.int32)
+
+
+def interpolate_step(past, future, tables, timestep, chunk_size=None):
+    """Accumulate rain between two consecutive rain rate fields.
+
+    Input:
+        past -- rain rate field (y, x) at the start of the timestep (mm/h, NaN=nodata)
+        future -- rain rate field (y, x) at the end of the timestep
+        tables -- TrajectoryTables
+        timestep -- timestep length in minutes
+        chunk_size -- number of pixels processed at once (default=all)
+
+    Output:
+        accumulation (y, x) in mm, NaN where trajectory left the area or
+        hit nodata
+    """
+    intsteps = tables.intsteps
+    sub_hours = timestep / 60.0 / intsteps
+    past_flat = np.asarray(past, dtype=np.float32).ravel()
+    future_flat = np.asarray(future, dtype=np.float32).ravel()
+    npix = past_flat.size
+    chunk_size = npix if chunk_size is None else chunk_size
+    acc = np.empty(npix, dtype=np.float32)
+
+    for start in range(0, npix, chunk_size):
+        pix = slice(start, min(start + chunk_size, npix))
+        past_table, future_table = tables.tables(pix)
+        # First sub-step is the past field itself
+        chunk_acc = past_flat[pix].copy()
+        for w in range(intsteps - 1):
+            past_src = past_table[w]
+            future_src = future_table[w]
+            p = past_flat[past_src]
+            f = future_flat[future_src]
+            rate = p + (f - p) * ((w + 1) / intsteps)
+            rate[(past_src < 0) | (future_src < 0)] = np.nan
+            chunk_acc += rate
+        acc[pix] = chunk_acc * sub_hours
+    return acc.reshape(tables.shape)
+
+
+def advect_nodata(past, future, tables):
+    """Set pixels of `future` to NaN where the past field one timestep upstream
+    is nodata or outside the area. `future` is modified in place."""
+    past_flat = np.asarray(past).ravel()
+    future_flat = future.reshape(-1)
+    upstream = tables.one_step
+    upstream_nodata = np.isnan(past_flat[np.where(upstream >= 0, upstream, 0)])
+    future_flat[(upstream < 0) | upstream_nodata] = np.nan
+    return future
+
+
+class AccumulationInterpolator:
+    """Interpolated accumulations for streamed ensemble members.
+
+    Usage:
+        interp = AccumulationInterpolator(obs_rate, motion, timestep=5, n_members=15)
+        interp.set_deterministic(det_rates)   # optional, becomes member 0
+        for leadtime, fields in enumerate(nowcast):
+            acc = interp.add(leadtime, fields)  # cumulative accumulation (member, y, x) in mm
+
+    Members get their own trajectory tables if `member_motion` (e.g. perturbed
+    ensemble motion) is given, they are calculated chunk by chunk when needed.
+    Members without their own motion field (e.g. time-lagged members) and the
+    deterministic nowcast use `motion`.
+    """
+    def __init__(self, initial_rate, motion, timestep, n_members, intsteps=10, chunk_size=None,
+                 member_motion=None):
+        self.timestep = timestep
+        self.intsteps = intsteps
+        self.chunk_size = chunk_size
+        self._deterministic = None
+        self.n_members = n_members
+
+        self._shared_tables = TrajectoryTables(motion, intsteps)
+        self._tables = [TrajectoryTables(mot, intsteps, precompute=False)
+                        for mot in (member_motion or [])]
+
+        initial_rate = np.asarray(initial_rate, dtype=np.float32)
+        shape = initial_rate.shape[-2:]
+        self._past = np.empty((n_members,) + shape, dtype=np.float32)
+        self._past[...] = initial_rate
+        self._cumulative = np.zeros((n_members,) + shape, dtype=np.float32)
+        self._initial = initial_rate.copy()
+
+    def set_deterministic(self, rates):
+        """Add deterministic nowcast (leadtime, y, x) as an extra member. It is
+        interpolated with the unperturbed motion and returned as member 0."""
+        self._deterministic = np.asarray(rates, dtype=np.float32)
+        self._det_past = self._initial.copy()
+        self._det_cumulative = np.zeros_like(self._det_past)
+
+    def _tables_for(self, member):
+        if member < len(self._tables):
+            return self._tables[member]
+        return self._shared_tables
+
+    def _step(self, past, future, tables):
+        future = np.array(future, dtype=np.float32)
+        acc = interpolate_step(past, future, tables, self.timestep, chunk_size=self.chunk_size)
+        advect_nodata(past, future, tables)
+        return acc, future
+
+    def add(self, leadtime_index, rates, member_index=None):
+        """Add rain rates (member, y, x) or (y, x) of one leadtime.
+
+        Output:
+            cumulative accumulation since analysis time (member, y, x) in mm
+            for the given members, with deterministic first if it was set
+            and the full ensemble was given at once
+        """
+        rates = np.asarray(rates, dtype=np.float32)
+        if rates.ndim == 2:
+            rates = rates[np.newaxis]
+        first = 0 if member_index is None else member_index
+
+        for i in range(rates.shape[0]):
+            member = first + i
+            acc, self._past[member] = self._step(self._past[member], rates[i],
+                                                 self._tables_for(member))
+            self._cumulative[member] += acc
+        result = self._cumulative[first:first + rates.shape[0]]
+
+        if self._deterministic is not None and member_index is None:
+            acc, self._det_past = self._step(self._det_past, self._deterministic[leadtime_index],
+                                             self._shared_tables)
+            self._det_cumulative += acc
+            result = np.concatenate((self._det_cumulative[np.newaxis], result))
+        return result
+
+
+def write_ravake_accumulation(fname, accumulations):
+    """Write cumulative accumulations of all members (member, y, x) in mm to
+    a RAVAKE accumulation file (int32, unit 1e-5 mm, -1 for nodata)."""
+    scaled = np.asarray(accumulations, dtype=np.float64) / RAVAKE_ACC_UNIT
+    out = np.full(scaled.shape, RAVAKE_ACC_NODATA, dtype=np.int32)
+    valid = np.isfinite(scaled) & (scaled >= 0)
+    out[valid] = np.minimum(scaled[valid], np.iinfo(np.int32).max).astype(np.int32)
+    with open(fname, "wb") as f:
+        out.tofile(f)
@@ -0,0 +1,177 @@
+"""Rolling observed accumulation for FMI-PPN.
+
+run-and-distribution/bin/acc1h rebuilds the observed accumulation of the
+previous hour from all twelve 5-minute composites every time it is run.
+Here the accumulation is updated incrementally: each observation slot adds
+its own accumulation (rain rate * timestep) to a running sum, and slots
+that fall out of the window are subtracted. The state is kept in
+memory-mapped .npy files in a state folder, so it survives between runs:
+
+    acc_sum.npy       -- float64 (y, x), sum of the stored slots (mm)
+    acc_nodata.npy    -- uint16 (y, x), number of slots with nodata per pixel
+    acc_slots.npy     -- float32 (n_slots, y, x), accumulation of each slot (mm)
+    acc_slot_mask.npy -- bool (n_slots, y, x), nodata mask of each slot
+    acc_slot_time.npy -- int64 (n_slots,), slot time in epoch minutes, -1 if empty
+
+Like in acc1h, the accumulation ending at time T is the sum of the
+observations at T-60min, T-55min, ..., T-5min, i.e. the slots in
+[T - minutes, T). The observation valid at T itself belongs to the next
+window. One slot more than the window length is stored, so that the
+newest observation is kept while the window ending at it is computed.
+A pixel is nodata if it is nodata in any slot of the window. Missing
+observations are left out of the sum and reported as missing.
+"""
+import datetime as dt
+from pathlib import Path
+
+import numpy as np
+
+import pgm_io
+
+_EPOCH = dt.datetime(1970, 1, 1)
+EMPTY_SLOT = -1
+
+
+def _epoch_minutes(time):
+    return int((time.replace(tzinfo=None) - _EPOCH).total_seconds() // 60)
+
+
+class RollingAccumulation:
+    """Observed accumulation over a rolling window.
+
+    Usage:
+        acc = RollingAccumulation("/var/tmp/obsacc", (1226, 760), timestep=5)
+        acc.update(obstime, rate)  # rain rate (mm/h), NaN for nodata
+        field, n_missing = acc.accumulation(obstime)  # last hour, mm
+    """
+    def __init__(self, state_dir, field_shape, timestep=5, window_minutes=60):
+        if window_minutes % timestep:
+            raise ValueError(f"Window length {window_minutes} is not a multiple of timestep {timestep}")
+        self.timestep = timestep
+        self.window_minutes = window_minutes
+        # Slots [now - window_minutes, now]
+        self.n_slots = window_minutes // timestep + 1
+        self.field_shape = tuple(field_shape)
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+        state = [
+            ("acc_sum.npy", np.float64, self.field_shape, 0),
+            ("acc_nodata.npy", np.uint16, self.field_shape, 0),
+            ("acc_slots.npy", np.float32, (self.n_slots,) + self.field_shape, 0),
+            ("acc_slot_mask.npy", np.bool_, (self.n_slots,) + self.field_shape, False),
+            ("acc_slot_time.npy", np.int64, (self.n_slots,), EMPTY_SLOT),
+        ]
+        arrays = [self._open(name, dtype, shape) for name, dtype, shape, _ in state]
+        if any(array is None for array in arrays):
+            # Missing or mismatching state, start over with all arrays
+            arrays = [np.lib.format.open_memmap(self.state_dir.joinpath(name), mode="w+",
+                                                dtype=dtype, shape=shape)
+                      for name, dtype, shape, _ in state]
+            for array, (_, _, _, fill_value) in zip(arrays, state):
+                array[...] = fill_value
+        self._sum, self._nodata, self._slots, self._slot_mask, self._slot_time = arrays
+
+    def _open(self, name, dtype, shape):
+        """Open state array, or return None if it is missing or does not match"""
+        fname = self.state_dir.joinpath(name)
+        if not fname.exists():
+            return None
+        array = np.load(fname, mmap_mode="r+")
+        if array.shape == shape and array.dtype == dtype:
+            return array
+        return None
+
+    def _slot_index(self, obstime):
+        return (_epoch_minutes(obstime) // self.timestep) % self.n_slots
+
+    def has_slot(self, obstime):
+        """True if the observation valid at `obstime` is already in the window"""
+        return self._slot_time[self._slot_index(obstime)] == _epoch_minutes(obstime)
+
+    def _remove_slot(self, index):
+        self._sum -= self._slots[index]
+        self._nodata -= self._slot_mask[index]
+        self._slot_time[index] = EMPTY_SLOT
+
+    def update(self, obstime, rate):
+        """Add observed rain rate field (mm/h) valid at `obstime`.
+
+        Slots older than `window_minutes` before `obstime` are subtracted. An
+        observation whose slot is already stored is not added again, so the
+        same observations can be fed on every run.
+
+        Output:
+            True if the observation was added
+        """
+        now = _epoch_minutes(obstime)
+        for index in np.flatnonzero((self._slot_time != EMPTY_SLOT) &
+                                    (self._slot_time < now - self.window_minutes)):
+            self._remove_slot(index)
+
+        index = self._slot_index(obstime)
+        slot_time = self._slot_time[index]
+        if slot_time == now:
+            return False
+        if slot_time > now:
+            # Older than what is already in the window
+            return False
+        if slot_time != EMPTY_SLOT:
+            self._remove_slot(index)
+
+        rate = np.asarray(rate, dtype=np.float32)
+        nodata = ~np.isfinite(rate)
+        self._slots[index] = np.where(nodata, 0.0, rate) * (self.timestep / 60.0)
+        self._slot_mask[index] = nodata
+        self._sum += self._slots[index]
+        self._nodata += nodata
+        self._slot_time[index] = now
+        return True
+
+    def accumulation(self, end_time, minutes=None):
+        """Return observed accumulation of `minutes` (default=window length)
+        ending at `end_time`, from the observations in [end_time - minutes, end_time).
+
+        Output:
+            tuple (accumulation, n_missing), accumulation in mm as float32 with
+            NaN for nodata, n_missing is the number of missing observations
+        """
+        minutes = self.window_minutes if minutes is None else minutes
+        if minutes > self.window_minutes or minutes % self.timestep:
+            raise ValueError(f"Cannot calculate {minutes} minute accumulation from "
+                             f"{self.window_minutes} minute window with timestep {self.timestep}")
+        end = _epoch_minutes(end_time)
+        stored = self._slot_time != EMPTY_SLOT
+        in_window = stored & (self._slot_time >= end - minutes) & (self._slot_time < end)
+        n_missing = minutes // self.timestep - int(np.count_nonzero(in_window))
+
+        end_slot = np.flatnonzero(self._slot_time == end)
+        if (minutes == self.window_minutes and
+                np.count_nonzero(in_window) + end_slot.size == np.count_nonzero(stored)):
+            # Running sum covers the window and possibly the observation at end_time
+            acc = self._sum.copy()
+            nodata = self._nodata.astype(np.int32)
+            for index in end_slot:
+                acc -= self._slots[index]
+                nodata -= self._slot_mask[index]
+            acc = np.maximum(acc, 0.0).astype(np.float32)
+            nodata = nodata > 0
+        else:
+            indices = np.flatnonzero(in_window)
+            acc = self._slots[indices].sum(axis=0, dtype=np.float64).astype(np.float32)
+            nodata = self._slot_mask[indices].any(axis=0)
+        acc[nodata] = np.nan
+        return acc, n_missing
+
+    def flush(self):
+        """Write state to disk"""
+        for array in (self._sum, self._nodata, self._slots, self._slot_mask, self._slot_time):
+            array.flush()
+
+
+def write_acc_pgm(fname, accumulation):
+    """Write accumulation (mm) as 16-bit PGM like acc1h: unit 0.01 mm, 65535 for nodata"""
+    nodata = ~np.isfinite(accumulation)
+    scaled = np.clip(np.where(nodata, 0.0, accumulation) * 100.0, 0, 65534).astype(">u2")
+    scaled[nodata] = 65535
+    pgm_io.write_pgm(fname, scaled, maxval=65535)
@@ -0,0 +1,72 @@
+"""Ring buffer of decoded observations for consecutive runs in one process.
+
+In batch mode (run_ppn.py --start/--end) consecutive nowcasts use mostly the
+same input composites. ObservationWindow keeps the decoded fields of the
+latest files, so each run decodes only the composites that are new since the
+previous run. Reading behaves like pysteps.io.readers.read_timeseries.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ObservationWindow:
+    """Decoded input fields of the latest `capacity` files
+
+    Input:
+        capacity -- number of decoded files kept, usually
+                    run_options.num_prev_observations + 1
+    """
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self._fields = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read_file(self, fname, importer, importer_kwargs):
+        """Return decoded field and metadata of `fname`, decode only if not kept"""
+        if fname in self._fields:
+            self._fields.move_to_end(fname)
+            self.hits += 1
+            return self._fields[fname]
+        field, _, metadata = importer(fname, **importer_kwargs)
+        self.misses += 1
+        self._fields[fname] = (field, metadata)
+        while len(self._fields) > self.capacity:
+            self._fields.popitem(last=False)
+        return field, metadata
+
+    def read_timeseries(self, inputfns, importer, **importer_kwargs):
+        """Read observations like pysteps.io.readers.read_timeseries.
+
+        Input:
+            inputfns -- tuple (filenames, timestamps) from pysteps.io.find_by_date
+            importer -- pysteps importer function
+
+        Output:
+            tuple (observations, None, metadata). Observations and metadata are
+            copies, they can be modified by the caller.
+        """
+        fnames, timestamps = inputfns
+        fields = []
+        metadata = None
+        for fname in fnames:
+            if fname is None:
+                fields.append(None)
+                continue
+            field, field_metadata = self.read_file(fname, importer, importer_kwargs)
+            fields.append(field)
+            if metadata is None:
+                metadata = dict(field_metadata)
+        if metadata is None:
+            return None, None, None
+
+        # Missing files are filled with nodata, as in pysteps
+        shape = next(field.shape for field in fields if field is not None)
+        observations = np.stack([np.full(shape, np.nan) if field is None else field
+                                 for field in fields])
+        metadata["timestamps"] = np.array(timestamps)
+        return observations, None, metadata
+
+    def clear(self):
+        self._fields.clear()
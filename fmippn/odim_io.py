@@ -1,11 +1,18 @@
 """Writing functions for storing the PPN output in HDF5 files"""
 import os
+import datetime as dt
 
 import h5py
+import numpy as np
 
 import utils
+import sparse_io
+import ens_stats
+import ens_prob
+import metrics
 from ppn_config import defaults
 
+@metrics.timed("write_deterministic")
 def write_deterministic_to_file(configuration, nowcast_data, filename=None, metadata=None):
     """Write deterministic output in ODIM HDF5 format..
 
@@ -22,6 +29,7 @@ def write_deterministic_to_file(configuration, nowcast_data, filename=None, meta
     _write(nowcast_data, filename, metadata, configuration=configuration, optype="det")
 
 
+@metrics.timed("write_ensemble")
 def write_ensemble_to_file(configuration, nowcast_data, filename=None, metadata=None):
     """Write ensemble output in ODIM HDF5 format..
 
@@ -38,6 +46,7 @@ def write_ensemble_to_file(configuration, nowcast_data, filename=None, metadata=
     _write(nowcast_data, filename, metadata,configuration=configuration,  optype="ens")
 
 
+@metrics.timed("write_motion")
 def write_motion_to_file(configuration, motion_data, filename=None, metadata=None):
     """Write motion field output in ODIM HDF5 format..
 
@@ -53,6 +62,148 @@ def write_motion_to_file(configuration, motion_data, filename=None, metadata=Non
 
     _write(motion_data, filename, metadata,configuration=configuration,  optype="mot")
 
+@metrics.timed("write_ensemble_statistics")
+def write_ensemble_statistics_to_file(configuration, mean, spread, filename, metadata):
+    """Write deterministically weighted ensemble mean and spread in ODIM HDF5 format.
+
+    Each leadtime is stored in its own dataset, with mean in data1 and spread
+    (standard deviation) in data2. Both are rain rates (mm/h).
+
+    Input:
+        configuration -- Object containing configuration parameters
+        mean -- sequence of ensemble mean fields, one for each leadtime
+        spread -- sequence of ensemble spread fields, one for each leadtime
+        filename -- filename for output HDF5 file
+        metadata -- dictionary containing "startdate" and optionally
+                    "first_index" (leadtime number of the first field, default 0)
+    """
+    stat_options = configuration["ensemble_statistics"]
+    nowcast_timestep = get_timesteps(configuration)
+    startdate = metadata["startdate"]
+    first_index = metadata.get("first_index", 0)
+
+    with h5py.File(filename, 'w') as outf:
+        utils.copy_odim_attributes(configuration["odim_metadata"], outf)
+        how_grp = outf["how"]
+        how_grp.attrs["domain"] = configuration["nowcast_options"]["domain"]
+        how_grp.attrs["zr_a"] = configuration["data_options"]["zr_a"]
+        how_grp.attrs["zr_b"] = configuration["data_options"]["zr_b"]
+        how_grp.attrs["ensemble_size"] = get_ensemble_size(configuration)
+        store_lagged_how_attrs(how_grp, configuration)
+        store_schedule_how_attrs(how_grp, configuration)
+        store_fingerprint_how_attrs(how_grp, configuration)
+        how_grp.attrs["determ_initweight"] = stat_options["determ_initweight"]
+        how_grp.attrs["determ_weightspan"] = stat_options["determ_weightspan"]
+        how_grp.attrs["nowcast_timestep"] = nowcast_timestep
+
+        for index, (mean_field, spread_field) in enumerate(zip(mean, spread)):
+            dset_grp = outf.create_group(f"/dataset{index+1}")
+            utils.store_odim_dset_attrs(dset_grp, first_index + index, startdate, nowcast_timestep)
+
+            for didx, (statistic, field) in enumerate((("mean", mean_field), ("std", spread_field))):
+                packed, scale_meta = ens_stats.pack_statistics(field, stat_options)
+                data_grp = dset_grp.create_group(f"data{didx+1}")
+                data_grp.create_dataset("data", data=packed)
+                utils.store_odim_data_what_attrs(data_grp, {"unit": "mm/h"}, scale_meta)
+                data_grp.create_group("how").attrs["statistic"] = statistic
+
+    return None
+
+@metrics.timed("write_quantiles")
+def write_quantiles_to_file(configuration, quantiles, filename, metadata):
+    """Write per-pixel ensemble quantiles in ODIM HDF5 format.
+
+    Each leadtime is stored in its own dataset, with one data group for each
+    fractile. Quantiles are rain rates (mm/h).
+
+    Input:
+        configuration -- Object containing configuration parameters
+        quantiles -- sequence of arrays (fractile, y, x), one for each leadtime
+        filename -- filename for output HDF5 file
+        metadata -- dictionary containing "startdate" and optionally
+                    "first_index" (leadtime number of the first field, default 0)
+    """
+    quantile_options = configuration["ensemble_quantiles"]
+    fractiles = quantile_options["fractiles"]
+    nowcast_timestep = get_timesteps(configuration)
+    first_index = metadata.get("first_index", 0)
+
+    with h5py.File(filename, 'w') as outf:
+        utils.copy_odim_attributes(configuration["odim_metadata"], outf)
+        how_grp = outf["how"]
+        how_grp.attrs["domain"] = configuration["nowcast_options"]["domain"]
+        how_grp.attrs["ensemble_size"] = get_ensemble_size(configuration)
+        store_lagged_how_attrs(how_grp, configuration)
+        store_schedule_how_attrs(how_grp, configuration)
+        store_fingerprint_how_attrs(how_grp, configuration)
+        how_grp.attrs["nowcast_timestep"] = nowcast_timestep
+
+        for index, fields in enumerate(quantiles):
+            dset_grp = outf.create_group(f"/dataset{index+1}")
+            utils.store_odim_dset_attrs(dset_grp, first_index + index, metadata["startdate"],
+                                        nowcast_timestep)
+            for fidx, fractile in enumerate(fractiles):
+                packed, scale_meta = ens_stats.pack_statistics(fields[fidx], quantile_options)
+                data_grp = dset_grp.create_group(f"data{fidx+1}")
+                data_grp.create_dataset("data", data=packed)
+                utils.store_odim_data_what_attrs(data_grp, {"unit": "mm/h"}, scale_meta)
+                data_grp.create_group("how").attrs["fractile"] = fractile
+
+    return None
+
+
+@metrics.timed("write_probabilities")
+def write_probabilities_to_file(configuration, product, filename, startdate):
+    """Write exceedance probability product in ODIM HDF5 format.
+
+    The product is stored in /dataset1, with one data group for each threshold.
+    Probabilities are in percent, 255 marks missing data.
+
+    Input:
+        configuration -- Object containing configuration parameters
+        product -- dictionary returned by ens_prob.ExceedanceProbabilities.update()
+        filename -- filename for output HDF5 file
+        startdate -- nowcast analysis time (datetime object)
+    """
+    nowcast_timestep = get_timesteps(configuration)
+    start = startdate + product["start"] * dt.timedelta(minutes=nowcast_timestep)
+    end = startdate + product["end"] * dt.timedelta(minutes=nowcast_timestep)
+    quantity = "RATE" if product["kind"] == "rate" else "ACRR"
+
+    with h5py.File(filename, 'w') as outf:
+        utils.copy_odim_attributes(configuration["odim_metadata"], outf)
+        how_grp = outf["how"]
+        how_grp.attrs["domain"] = configuration["nowcast_options"]["domain"]
+        how_grp.attrs["ensemble_size"] = get_ensemble_size(configuration)
+        store_lagged_how_attrs(how_grp, configuration)
+        store_schedule_how_attrs(how_grp, configuration)
+        store_fingerprint_how_attrs(how_grp, configuration)
+        if "acc_minutes" in product:
+            how_grp.attrs["accumulation_minutes"] = product["acc_minutes"]
+
+        dset_grp = outf.create_group("/dataset1")
+        dset_what_grp = dset_grp.create_group("what")
+        dset_what_grp.attrs["product"] = "COMP"
+        dset_what_grp.attrs["startdate"] = int(start.strftime("%Y%m%d"))
+        dset_what_grp.attrs["starttime"] = int(start.strftime("%H%M%S"))
+        dset_what_grp.attrs["enddate"] = int(end.strftime("%Y%m%d"))
+        dset_what_grp.attrs["endtime"] = int(end.strftime("%H%M%S"))
+
+        for tidx, threshold in enumerate(product["thresholds"]):
+            data_grp = dset_grp.create_group(f"data{tidx+1}")
+            data_grp.create_dataset("data", data=product["probabilities"][tidx])
+            data_what_grp = data_grp.create_group("what")
+            data_what_grp.attrs["quantity"] = "PROB"
+            data_what_grp.attrs["gain"] = 1.0
+            data_what_grp.attrs["offset"] = 0.0
+            data_what_grp.attrs["nodata"] = ens_prob.PROB_NODATA
+            data_what_grp.attrs["undetect"] = 0
+            data_what_grp.attrs["threshold_id"] = tidx + 1
+            data_what_grp.attrs["threshold_value"] = threshold
+            data_what_grp.attrs["threshold_quantity"] = quantity
+
+    return None
+
 # FIXME: This logic should be converted to use a list of leadtimes instead of assuming regular timestep
 def get_timesteps(configuration):
     """Return the nowcast timestep if it is regular"""
@@ -87,6 +238,25 @@ def _convert_motion_units(data_pxts, kmperpixel=1.0, timestep=1.0):
     return data_ms
 
 
+def store_field(data_grp, field, scale_meta, configuration):
+    """Store a single nowcast field into ODIM data group using the encoding
+    selected in `output_options.field_encoding`.
+
+    Input:
+        data_grp -- data HDF5 group object (data1, data2 ...)
+        field -- 2D field, already scaled with prepare_data_for_writing()
+        scale_meta -- scale values metadata (undetect is used as fill value)
+        configuration -- Object containing configuration parameters
+    """
+    encoding = configuration["output_options"].get("field_encoding", "dense")
+    if encoding == "dense":
+        data_grp.create_dataset("data", data=field)
+    elif encoding == "sparse":
+        sparse_io.store_sparse_field(data_grp, field, scale_meta.get("undetect"))
+    else:
+        raise ValueError(f"Unknown field_encoding '{encoding}'. Valid options are 'dense' and 'sparse'.")
+
+
 def _write(data, filename, metadata, configuration, optype=None):
     # Necessary input value checks, exit early if no need to store anything
     if data is None:
@@ -176,7 +346,7 @@ def _write(data, filename, metadata, configuration, optype=None):
                 #Store data
                 ts_point = data[index, :, :]
                 data_grp=dset_grp.create_group("data1")
-                data_grp.create_dataset("data",data=ts_point)
+                store_field(data_grp, ts_point, scale_meta, configuration)
 
                 #Store data/what group attributes
                 utils.store_odim_data_what_attrs(data_grp, metadata, scale_meta)
@@ -189,6 +359,8 @@ def _write(data, filename, metadata, configuration, optype=None):
             # FIXME: "nowcast_timestep" might not be constants, see above
             how_grp.attrs["nowcast_timestep"] = nowcast_timestep
             how_grp.attrs["max_leadtime"] = configuration["run_options"]["max_leadtime"]
+            store_schedule_how_attrs(how_grp, configuration)
+            store_fingerprint_how_attrs(how_grp, configuration)
             default_cascade_levels = defaults["nowcast_options"]["n_cascade_levels"]
             how_grp.attrs["n_cascade_levels"] = configuration["nowcast_options"].get("n_cascade_levels",
                                                                                      default_cascade_levels)
@@ -207,26 +379,166 @@ def _write(data, filename, metadata, configuration, optype=None):
                     #Store data
                     ts_point = data[eidx, index, :, :]
                     data_grp=dset_grp.create_group(f"data{eidx+1}")
-                    data_grp.create_dataset("data",data=ts_point)
+                    store_field(data_grp, ts_point, scale_meta, configuration)
 
                     #Store data/what group attributes
                     utils.store_odim_data_what_attrs(data_grp, metadata, scale_meta)
 
             #Store PPN specific metadata into /how group
-            how_grp.attrs["zr_a"] = configuration["data_options"]["zr_a"]
-            how_grp.attrs["zr_b"] = configuration["data_options"]["zr_b"]
-            how_grp.attrs["seed"] = metadata.get("seed","Unknown")
-            how_grp.attrs["ensemble_size"] = configuration["ensemble_size"]
-            # FIXME: "leadtimes" can be a list (irregular timesteps) -> take that into account
-            how_grp.attrs["num_timesteps"] = configuration["run_options"]["leadtimes"]
-            # FIXME: "nowcast_timestep" might not be constants, see above
-            how_grp.attrs["nowcast_timestep"] = nowcast_timestep
-            how_grp.attrs["max_leadtime"] = configuration["run_options"]["max_leadtime"]
-            default_cascade_levels = defaults["nowcast_options"]["n_cascade_levels"]
-            how_grp.attrs["n_cascade_levels"] = configuration["nowcast_options"].get("n_cascade_levels",
-                                                                                     default_cascade_levels)
+            _store_ensemble_how_attrs(how_grp, configuration, metadata.get("seed", "Unknown"),
+                                      configuration["ensemble_size"], nowcast_timestep)
+
+    return None
+
+
+def get_ensemble_size(configuration):
+    """Return number of output ensemble members, including time-lagged members"""
+    lagged = configuration.get("lagged_info") or dict()
+    return configuration["nowcast_options"]["n_ens_members"] + lagged.get("lagged_members", 0)
+
+
+def store_lagged_how_attrs(how_grp, configuration):
+    """Store time-lagged ensemble metadata (see lagged_ensemble.py) into /how group"""
+    for key, value in (configuration.get("lagged_info") or dict()).items():
+        how_grp.attrs[key] = value
+
+
+def store_schedule_how_attrs(how_grp, configuration):
+    """Store deadline scheduling metadata (see scheduler.py) into /how group"""
+    for key, value in (configuration.get("schedule_info") or dict()).items():
+        how_grp.attrs[key] = value
+
+
+def store_fingerprint_how_attrs(how_grp, configuration):
+    """Store run cache fingerprint (see run_cache.py) into /how group"""
+    if configuration.get("run_fingerprint"):
+        how_grp.attrs["run_fingerprint"] = configuration["run_fingerprint"]
+
+
+def _store_ensemble_how_attrs(how_grp, configuration, seed, ensemble_size, nowcast_timestep):
+    """Store PPN specific ensemble metadata into /how group"""
+    how_grp.attrs["zr_a"] = configuration["data_options"]["zr_a"]
+    how_grp.attrs["zr_b"] = configuration["data_options"]["zr_b"]
+    how_grp.attrs["seed"] = seed
+    how_grp.attrs["ensemble_size"] = ensemble_size
+    store_lagged_how_attrs(how_grp, configuration)
+    store_schedule_how_attrs(how_grp, configuration)
+    store_fingerprint_how_attrs(how_grp, configuration)
+    # FIXME: "leadtimes" can be a list (irregular timesteps) -> take that into account
+    how_grp.attrs["num_timesteps"] = configuration["run_options"]["leadtimes"]
+    # FIXME: "nowcast_timestep" might not be constants, see above
+    how_grp.attrs["nowcast_timestep"] = nowcast_timestep
+    how_grp.attrs["max_leadtime"] = configuration["run_options"]["max_leadtime"]
+    default_cascade_levels = defaults["nowcast_options"]["n_cascade_levels"]
+    how_grp.attrs["n_cascade_levels"] = configuration["nowcast_options"].get("n_cascade_levels",
+                                                                             default_cascade_levels)
+
+
+@metrics.timed("write_ensemble_virtual")
+def write_ensemble_virtual_file(configuration, part_files, filename):
+    """Write ensemble output in ODIM HDF5 format using HDF5 virtual datasets.
+
+    Every /datasetN/dataM/data in the output file is a virtual dataset mapped
+    to /dataset1/data1/data of a single-field file written by the callback
+    function, so no data is copied. Source files are referenced with paths
+    relative to the output file, so the output folder can be moved as a whole.
+
+    Input:
+        configuration -- Object containing configuration parameters
+        part_files -- nested list of callback filenames, indexed [member][leadtime]
+        filename -- filename for output ensemble HDF5 file
+    """
+    nowcast_timestep = get_timesteps(configuration)
+    startdate = configuration["startdate"]
+    ensemble_size = len(part_files)
+    outdir = os.path.dirname(os.path.abspath(filename))
+
+    # All callback files share shape, dtype and scaling
+    with h5py.File(part_files[0][0], 'r') as f:
+        src = f["/dataset1/data1/data"]
+        shape, dtype = src.shape, src.dtype
+
+    with h5py.File(filename, 'w') as outf:
+        utils.copy_odim_attributes(configuration["odim_metadata"], outf)
+        how_grp = outf["how"]
+        how_grp.attrs["domain"] = configuration["nowcast_options"]["domain"]
+
+        for index in range(len(part_files[0])):
+            dset_grp = outf.create_group(f"/dataset{index+1}")
+            utils.store_odim_dset_attrs(dset_grp, index, startdate, nowcast_timestep)
+
+            for eidx in range(ensemble_size):
+                part_fname = part_files[eidx][index]
+                layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+                layout[...] = h5py.VirtualSource(os.path.relpath(part_fname, outdir),
+                                                 "/dataset1/data1/data", shape=shape)
+                data_grp = dset_grp.create_group(f"data{eidx+1}")
+                data_grp.create_virtual_dataset("data", layout)
+
+                # Copy data/what attributes (gain, offset, nodata, undetect, quantity)
+                with h5py.File(part_fname, 'r') as f:
+                    src_what = f["/dataset1/data1/what"].attrs
+                    data_what_grp = data_grp.create_group("what")
+                    for key, value in src_what.items():
+                        data_what_grp.attrs[key] = value
+
+        _store_ensemble_how_attrs(how_grp, configuration,
+                                  configuration["nowcast_options"].get("seed", "Unknown"),
+                                  ensemble_size, nowcast_timestep)
 
     return None
 
 
+@metrics.timed("write_reprojected")
+def write_reprojected_file(reprojector, in_fname, out_fname, batch_size=16):
+    """Write a copy of an ODIM HDF5 output file with all /datasetN/dataM fields
+    reprojected to the target grid of `reprojector` (see reproject.py).
 
+    Fields are read one at a time. Up to `batch_size` fields with equal data
+    type and nodata value are stacked and reprojected with one gather, so at
+    most a batch of fields per data type is in memory. Sparse fields are
+    decoded and written dense. Target pixels outside the source grid get the
+    nodata value of the field.
+    """
+    with h5py.File(in_fname, 'r') as inf, h5py.File(out_fname, 'w') as outf:
+        for key, value in inf.attrs.items():
+            outf.attrs[key] = value
+        for name in inf:
+            if not name.startswith("dataset"):
+                inf.copy(name, outf)
+
+        # Pending fields by (dtype, nodata)
+        batches = dict()
+
+        def flush(key):
+            entries = batches.pop(key)
+            fields = reprojector.apply(np.stack([field for _, _, field in entries]), nodata=key[1])
+            for (path, data_grp, _), field in zip(entries, fields):
+                out_grp = outf.require_group(path)
+                for name in data_grp:
+                    if name not in {"data", "run_start", "run_length", "values"}:
+                        data_grp.copy(name, out_grp)
+                out_grp.create_dataset("data", data=field)
+
+        for dset_name, dset_grp in inf.items():
+            if not dset_name.startswith("dataset"):
+                continue
+            out_dset = outf.create_group(dset_name)
+            for name in dset_grp:
+                if not name.startswith("data"):
+                    dset_grp.copy(name, out_dset)
+                    continue
+                data_grp = dset_grp[name]
+                field = sparse_io.read_field(data_grp)
+                nodata = data_grp["what"].attrs.get("nodata", 0) if "what" in data_grp else 0
+                key = (field.dtype.str, float(nodata))
+                batches.setdefault(key, []).append((f"{dset_name}/{name}", data_grp, field))
+                if len(batches[key]) >= batch_size:
+                    flush(key)
+
+        for key in list(batches):
+            flush(key)
+
+        where_grp = outf.require_group("where")
+        for key, value in reprojector.where_attrs().items():
+            where_grp.attrs[key] = value
@@ -0,0 +1,225 @@
+"""Nowcast output in POSIX shared memory for local consumers.
+
+With shared_memory_output enabled, ppn.run() and cb_nowcast() place the
+quantized ensemble and deterministic fields into a shared memory arena per
+product (/dev/shm/<prefix>_<tag>_<YYYYMMDDHHMM>, tag "ens" or "det") as soon
+as each leadtime is ready. Postprocessing on the same host maps the arena
+read-only and can start with the first leadtime, without waiting for the
+files. The files are still written for archival, by a background thread
+(ArchiveWriter) when shared_memory_output.async_archive is set.
+
+Arena layout (little endian):
+    bytes 0-7    -- magic b"FMIPPNA1"
+    bytes 8-15   -- completed leadtimes (uint64), increased after the
+                    fields of a leadtime are written
+    bytes 16-23  -- state (uint64): 0 = writing, 1 = complete, 2 = stopped
+                    early (e.g. deadline reached), 3 = failed
+    bytes 24-31  -- descriptor length (uint64)
+    descriptor   -- JSON: shape [leadtime, member, y, x], dtype, startdate,
+                    valid_times, config, tag, unit, quantity, scale_offset,
+                    data_offset
+    scale table  -- float64 [leadtime, 4] at scale_offset: gain, offset,
+                    undetect, nodata of each leadtime
+    data         -- fields [leadtime, member, y, x], C order, at data_offset
+
+The arena stays after the run, remove old arenas with
+    $ python shm_io.py cleanup --prefix fmippn_<config>_out_ens --older-than 120
+"""
+import concurrent.futures
+import json
+import struct
+import time
+
+import numpy as np
+
+import shm_io
+
+MAGIC = b"FMIPPNA1"
+_PREFIX_BYTES = 32
+_ALIGN = 64
+
+WRITING = 0
+COMPLETE = 1
+STOPPED = 2
+FAILED = 3
+
+
+def default_prefix(config):
+    return f"fmippn_{config}_out"
+
+
+def arena_name(prefix, tag, startdate):
+    return shm_io.segment_name(f"{prefix}_{tag}", startdate)
+
+
+class OutputArena:
+    """Writer side of an arena.
+
+    Usage:
+        arena = OutputArena.create(name, 12, 51, (1226, 760), "uint16", descriptor)
+        arena.put(0, fields, scale_meta)  # fields (member, y, x)
+        arena.finish()
+    """
+    def __init__(self, shm, descriptor):
+        self._shm = shm
+        self.name = shm.name
+        self.descriptor = descriptor
+        self.data = np.ndarray(tuple(descriptor["shape"]), dtype=np.dtype(descriptor["dtype"]),
+                               buffer=shm.buf, offset=descriptor["data_offset"])
+        self.scales = np.ndarray((descriptor["shape"][0], 4), dtype="<f8", buffer=shm.buf,
+                                 offset=descriptor["scale_offset"])
+        self.completed = 0
+        self.state = WRITING
+
+    @classmethod
+    def create(cls, name, n_leadtimes, n_members, field_shape, dtype, descriptor):
+        """Create arena `name`, replacing an arena of an earlier run with the same name.
+
+        Input:
+            descriptor -- dictionary of JSON serializable run information
+                          (startdate, valid_times, unit etc.)
+        """
+        dtype = np.dtype(dtype).newbyteorder("<")
+        shape = [n_leadtimes, n_members] + list(field_shape)
+        descriptor = dict(descriptor, shape=shape, dtype=dtype.str)
+        # Offsets depend on the descriptor length, reserve space for the numbers
+        length = len(json.dumps(dict(descriptor, scale_offset=0, data_offset=0),
+                                default=shm_io.json_value).encode()) + 40
+        scale_offset = -(-(_PREFIX_BYTES + length) // _ALIGN) * _ALIGN
+        data_offset = -(-(scale_offset + n_leadtimes * 4 * 8) // _ALIGN) * _ALIGN
+        descriptor.update(scale_offset=scale_offset, data_offset=data_offset)
+        descriptor_bytes = json.dumps(descriptor, default=shm_io.json_value).encode()
+
+        shm_io.unlink(name)
+        shm = shm_io.open_segment(name, create=True,
+                                  size=data_offset + int(np.prod(shape)) * dtype.itemsize)
+        shm.buf[:8] = MAGIC
+        struct.pack_into("<QQQ", shm.buf, 8, 0, WRITING, len(descriptor_bytes))
+        shm.buf[_PREFIX_BYTES:_PREFIX_BYTES + len(descriptor_bytes)] = descriptor_bytes
+        arena = cls(shm, descriptor)
+        arena.scales[...] = np.nan
+        return arena
+
+    def put(self, leadtime_index, fields, scale_meta):
+        """Store quantized fields (member, y, x) of a leadtime and its scaling
+        (gain, offset, undetect, nodata from utils.prepare_data_for_writing)"""
+        self.data[leadtime_index] = fields
+        self.scales[leadtime_index] = [scale_meta.get(key) if scale_meta.get(key) is not None else np.nan
+                                       for key in ("gain", "offset", "undetect", "nodata")]
+        self.completed = max(self.completed, leadtime_index + 1)
+        # Counter last, consumers read only completed leadtimes
+        struct.pack_into("<Q", self._shm.buf, 8, self.completed)
+
+    def finish(self, state=COMPLETE):
+        self.state = state
+        struct.pack_into("<Q", self._shm.buf, 16, state)
+
+    def close(self):
+        self.data = None
+        self.scales = None
+        self._shm.close()
+
+
+class ArenaView:
+    """Read-only consumer view of an arena. `data` (leadtime, member, y, x)
+    maps the shared memory, valid until close()."""
+    def __init__(self, shm, descriptor):
+        self._shm = shm
+        self.name = shm.name
+        self.descriptor = descriptor
+        self.data = np.ndarray(tuple(descriptor["shape"]), dtype=np.dtype(descriptor["dtype"]),
+                               buffer=shm.buf, offset=descriptor["data_offset"])
+        self.data.flags.writeable = False
+        self._scales = np.ndarray((descriptor["shape"][0], 4), dtype="<f8", buffer=shm.buf,
+                                  offset=descriptor["scale_offset"])
+        self._scales.flags.writeable = False
+
+    @property
+    def completed(self):
+        return struct.unpack_from("<Q", self._shm.buf, 8)[0]
+
+    @property
+    def state(self):
+        return struct.unpack_from("<Q", self._shm.buf, 16)[0]
+
+    def scale(self, leadtime_index):
+        """Return dictionary with gain, offset, undetect and nodata of a leadtime"""
+        return dict(zip(("gain", "offset", "undetect", "nodata"),
+                        (float(value) for value in self._scales[leadtime_index])))
+
+    def decoded(self, leadtime_index):
+        """Return fields (member, y, x) of a leadtime in physical units, nodata as NaN"""
+        scale = self.scale(leadtime_index)
+        raw = self.data[leadtime_index]
+        data = raw.astype(np.float64) * scale["gain"] + scale["offset"]
+        if np.isfinite(scale["nodata"]):
+            data[raw == scale["nodata"]] = np.nan
+        return data
+
+    def wait(self, n_leadtimes, timeout=None, poll_interval=0.05):
+        """Wait until `n_leadtimes` leadtimes are completed or the run has ended.
+        Return number of completed leadtimes."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.completed < n_leadtimes and self.state == WRITING:
+            if end is not None and time.monotonic() > end:
+                break
+            time.sleep(poll_interval)
+        return self.completed
+
+    def close(self):
+        self.data = None
+        self._scales = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(name):
+    """Return ArenaView of arena `name`, or None if it does not exist"""
+    try:
+        shm = shm_io.open_segment(name)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        length = struct.unpack_from("<Q", shm.buf, 24)[0]
+        if bytes(shm.buf[:8]) != MAGIC:
+            shm.close()
+            return None
+        descriptor = json.loads(bytes(shm.buf[_PREFIX_BYTES:_PREFIX_BYTES + length]))
+    except (struct.error, ValueError):
+        shm.close()
+        return None
+    return ArenaView(shm, descriptor)
+
+
+class ArchiveWriter:
+    """Write output files in a background thread, in submission order.
+
+    At most `max_pending` writes are queued, `submit()` waits for the oldest
+    write before queueing more. The queued writes hold their fields, so this
+    bounds the memory used when writing falls behind the nowcast.
+    """
+    def __init__(self, max_pending=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                               thread_name_prefix="ppn-archive")
+        self.max_pending = max(int(max_pending), 1)
+        self._futures = []
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write, raise the error of a completed earlier write"""
+        while len(self._futures) >= self.max_pending:
+            self._futures.pop(0).result()
+        self._futures.append(self._executor.submit(func, *args, **kwargs))
+
+    def wait(self):
+        """Wait for submitted writes, raise the first error"""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,241 @@
+"""Memory-mapped PGM reading and writing for FMI-PPN.
+
+Binary (P5) PGM rasters are mapped with numpy.memmap after parsing the
+header, so reading a composite does not copy or decode the raster until the
+data is used. Rasters with maxval < 256 are uint8, others big-endian uint16.
+
+`import_fmi_pgm()` is a drop-in replacement for the pysteps fmi_pgm importer
+(same return values and metadata), selected in the configuration with
+"importer": "fmippn_pgm". Projection metadata is derived from the header
+comments, and it is cached so that the PROJ calculations are only done once
+per domain. Domain header files (config/*_PGM_stere.hdr) are cached with
+`read_hdr_file()`.
+"""
+import functools
+import gzip
+import os
+
+import numpy as np
+
+# Hard-coded in the pysteps fmi_pgm importer as well, the projection
+# definition is missing from the PGM files
+FMI_STERE_PARAMS = "+a=6371288 +x_0=380886.310 +y_0=3395677.920 +no_defs"
+MISSING_VALUE = 255
+
+
+def _parse_comments(lines):
+    """Parse header comment lines like '# key value1 value2' into a dictionary
+    of value lists, like the pysteps fmi_pgm importer."""
+    metadata = dict()
+    for line in lines:
+        tokens = line.lstrip("#").split()
+        if len(tokens) >= 2:
+            metadata[tokens[0]] = tokens[1:]
+    return metadata
+
+
+def _read_header_from(f):
+    """Read PGM header from an open binary file.
+
+    Output:
+        dictionary with keys width, height, maxval, offset (bytes to the
+        raster) and comments (metadata dictionary, see _parse_comments)
+    """
+    magic = f.readline().strip()
+    if magic != b"P5":
+        raise ValueError(f"Not a binary PGM file (magic number {magic!r})")
+    comments = []
+    values = []
+    while len(values) < 3:
+        line = f.readline()
+        if not line:
+            raise ValueError("Unexpected end of PGM header")
+        line = line.decode("ascii", errors="replace")
+        if line.startswith("#"):
+            comments.append(line.strip())
+        else:
+            values.extend(int(value) for value in line.split())
+    width, height, maxval = values
+    return {
+        "width": width,
+        "height": height,
+        "maxval": maxval,
+        "offset": f.tell(),
+        "comments": _parse_comments(comments),
+    }
+
+
+def read_header(fname):
+    """Read header of a binary PGM file, see _read_header_from"""
+    with open(fname, "rb") as f:
+        return _read_header_from(f)
+
+
+def _raster_dtype(maxval):
+    return np.dtype(np.uint8) if maxval < 256 else np.dtype(">u2")
+
+
+def read_pgm(fname, gzipped=False):
+    """Read binary PGM file.
+
+    Output:
+        tuple (raster, header). Without gzip the raster is a read-only
+        numpy.memmap of shape (height, width).
+    """
+    if gzipped:
+        with gzip.open(fname, "rb") as f:
+            header = _read_header_from(f)
+            dtype = _raster_dtype(header["maxval"])
+            raster = np.frombuffer(f.read(header["width"] * header["height"] * dtype.itemsize),
+                                   dtype=dtype).reshape(header["height"], header["width"])
+        return raster, header
+
+    header = read_header(fname)
+    raster = np.memmap(fname, dtype=_raster_dtype(header["maxval"]), mode="r",
+                       offset=header["offset"], shape=(header["height"], header["width"]))
+    return raster, header
+
+
+def write_pgm(fname, data, maxval=None, comments=None):
+    """Write 2D array as binary PGM file.
+
+    Input:
+        fname -- output filename
+        data -- 2D array of unsigned integers
+        maxval -- maximum value in header (default=255 for 1-byte data, else 65535)
+        comments -- optional list of header comment lines (without "#")
+    """
+    data = np.asarray(data)
+    if maxval is None:
+        maxval = 255 if data.dtype.itemsize == 1 else 65535
+    # No copy if data is already in the stored byte order and type
+    raster = data.astype(_raster_dtype(maxval), copy=False)
+    header = "P5\n"
+    for comment in comments or []:
+        header += f"# {comment}\n"
+    header += f"{data.shape[1]} {data.shape[0]}\n{maxval}\n"
+    with open(fname, "wb") as f:
+        f.write(header.encode("ascii"))
+        np.ascontiguousarray(raster).tofile(f)
+
+
+@functools.lru_cache(maxsize=32)
+def _geodata(projection_key):
+    """Projection metadata of the pysteps fmi_pgm importer, cached per projection"""
+    import pyproj
+
+    params = dict(projection_key)
+    geodata = dict()
+    projdef = ""
+    if params.get("type") == "stereographic":
+        # Same string as built by pysteps
+        projdef = (f"+proj=stere  +lon_0={params['centrallongitude']}E"
+                   f" +lat_0={params['centrallatitude']}N +lat_ts={params['truelatitude']}"
+                   f" {FMI_STERE_PARAMS}")
+    geodata["projection"] = projdef
+
+    ll_lon, ll_lat = [float(value) for value in params["bottomleft"].split()]
+    ur_lon, ur_lat = [float(value) for value in params["topright"].split()]
+    proj = pyproj.Proj(projdef)
+    x1, y1 = proj(ll_lon, ll_lat)
+    x2, y2 = proj(ur_lon, ur_lat)
+    geodata["x1"] = x1
+    geodata["y1"] = y1
+    geodata["x2"] = x2
+    geodata["y2"] = y2
+    geodata["cartesian_unit"] = "m"
+    geodata["xpixelsize"] = float(params["metersperpixel_x"])
+    geodata["ypixelsize"] = float(params["metersperpixel_y"])
+    geodata["yorigin"] = "upper"
+    return geodata
+
+
+def geodata_from_comments(comments):
+    """Return pysteps geodata dictionary from parsed header comments"""
+    keys = ("type", "centrallongitude", "centrallatitude", "truelatitude",
+            "bottomleft", "topright", "metersperpixel_x", "metersperpixel_y")
+    projection_key = tuple((key, " ".join(comments[key])) for key in keys if key in comments)
+    return dict(_geodata(projection_key))
+
+
+def _threshold_value(precip):
+    """Smallest value above the minimum, like in pysteps importers"""
+    valid = precip[np.isfinite(precip)]
+    if valid.size == 0:
+        return np.nan
+    min_precip = valid.min()
+    above_min = valid[valid > min_precip]
+    return above_min.min() if above_min.size else min_precip
+
+
+def import_fmi_pgm(filename, gzipped=False, **kwargs):
+    """Import an 8-bit FMI PGM composite (0.5 dBZ steps, offset -32 dBZ).
+
+    Returns the same (precip, quality, metadata) tuple as
+    pysteps.io.importers.import_fmi_pgm.
+    """
+    raster, header = read_pgm(filename, gzipped=gzipped)
+    if header["maxval"] > 255:
+        raise ValueError(f"{filename}: expected 8-bit reflectivity PGM, maxval is {header['maxval']}")
+
+    # Lookup table instead of arithmetic per pixel
+    lut = (np.arange(256, dtype=np.float64) - 64.0) / 2.0
+    lut[MISSING_VALUE] = np.nan
+    precip = lut[raster]
+
+    metadata = geodata_from_comments(header["comments"])
+    metadata["institution"] = "Finnish Meteorological Institute"
+    metadata["accutime"] = 5.0
+    metadata["unit"] = "dBZ"
+    metadata["transform"] = "dB"
+    metadata["zerovalue"] = np.nanmin(precip)
+    metadata["threshold"] = _threshold_value(precip)
+    metadata["zr_a"] = 223.0
+    metadata["zr_b"] = 1.53
+    return precip, None, metadata
+
+
+IMPORTERS = {
+    "fmippn_pgm": import_fmi_pgm,
+}
+
+
+def get_importer(name):
+    """Return importer function by name"""
+    try:
+        return IMPORTERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown importer '{name}'. Valid options are {list(IMPORTERS)}") from None
+
+
+def _hdr_cache_key(fname):
+    stat = os.stat(fname)
+    return os.path.abspath(fname), stat.st_mtime_ns
+
+
+@functools.lru_cache(maxsize=16)
+def _read_hdr_file(fname, mtime_ns):
+    with open(fname, "r") as f:
+        comments = [line.strip().lstrip("#").strip() for line in f if line.startswith("#")]
+    parsed = _parse_comments(comments)
+    return {
+        "comments": comments,
+        "metadata": parsed,
+        "geodata": geodata_from_comments(parsed),
+    }
+
+
+def read_hdr_file(fname):
+    """Read domain PGM header file (e.g. config/europe_PGM_stere.hdr), which
+    contains the magic number and comment lines of a PGM header. Output is a
+    dictionary with the comment lines, parsed metadata and geodata. It is
+    cached until the file changes."""
+    return _read_hdr_file(*_hdr_cache_key(fname))
+
+
+def rewrap_pgm(src_fname, dst_fname, hdr_fname):
+    """Write the raster of `src_fname` with the header comments of domain
+    header file `hdr_fname`, like preprocess/run_preprocess_DOMAIN=europe.sh"""
+    raster, header = read_pgm(src_fname)
+    write_pgm(dst_fname, raster, maxval=header["maxval"],
+              comments=read_hdr_file(hdr_fname)["comments"])
@@ -11,7 +11,9 @@ ODIM output option and callback function added by Tuuli Perttula, 2021
 
 """
 import datetime as dt
+import os
 import random
+import time
 from pathlib import Path
 
 import numpy as np
@@ -23,6 +25,22 @@ import ppn_logger
 import ppn_config
 import utils
 import odim_io
+import ens_stats
+import ens_prob
+import ens_quantiles
+import motion_interp
+import reproject
+import obs_acc
+import acc_products
+import pgm_io
+import lagged_ensemble
+import scheduler
+import metrics
+import tracing
+import run_cache
+import verification
+import shm_io
+import output_arena
 
 # Global objects for storing and accessing configuration parameters
 PD = dict()
@@ -37,10 +55,34 @@ def run(timestamp=None, config=None, **kwargs):
         config -- Configuration parameter. If None, use defaults. (default=None)
 
     Optional keyword arguments:
-        (none)
+        deadline -- wall-clock time available for the run in seconds, overrides
+                    scheduling.deadline_seconds (default=None)
+        queue_delay -- seconds the run waited for the run lock, reported in
+                       the log and subtracted from the deadline (default=0)
+        num_workers -- number of assigned CPUs, overrides
+                       nowcast_options.num_workers (default=None)
+        observation_window -- obs_window.ObservationWindow keeping decoded
+                              observations between runs in one process (default=None)
+        force -- run even if the run cache has up to date outputs (default=False)
     """
+    try:
+        _run(timestamp=timestamp, config=config, **kwargs)
+    finally:
+        # Also when the run fails, the background writer and arenas are released
+        close_output_arenas()
+        stop_archive()
+
+
+def _run(timestamp=None, config=None, **kwargs):
+    """Nowcast of run(), see its docstring"""
+    run_start = time.monotonic()
     nc_fname = None
 
+    # Nothing is carried over from a previous run in the same process (batch mode)
+    PD.clear()
+    PD_callback.clear()
+    PD_callback["output_files"] = []
+    cb_nowcast.counter = 0
     PD.update(ppn_config.get_config(config))
 
     initialise_logging(log_folder=PD["logging"]["log_folder"],
@@ -61,6 +103,31 @@ def run(timestamp=None, config=None, **kwargs):
 
     PD["startdate"] = startdate
     PD["config"] = config
+
+    trace_file = PD["tracing"].get("trace_file") or os.environ.get("FMIPPN_TRACE_FILE")
+    # Runs started by run_fmippn_common.sh with TRACEDIR are traced
+    if trace_file and (PD["tracing"].get("enabled", False) or "FMIPPN_TRACE_FILE" in os.environ):
+        tracing.start(trace_file, process_name="ppn.run", config=config,
+                      startdate=f"{startdate:%Y%m%d%H%M}")
+
+    if PD["metrics"].get("enabled", False):
+        metrics.start_run(trace_allocations=PD["metrics"].get("trace_allocations", False),
+                          config=config, startdate=f"{startdate:%Y%m%d%H%M}")
+
+    if kwargs.get("num_workers"):
+        PD["nowcast_options"]["num_workers"] = kwargs["num_workers"]
+    log("info", f"Using {PD['nowcast_options']['num_workers']} workers, "
+                f"OMP_NUM_THREADS={os.environ.get('OMP_NUM_THREADS')}")
+
+    PD["schedule_info"] = None
+    PD_callback.pop("deadline", None)
+    queue_delay = kwargs.get("queue_delay") or 0
+    if queue_delay:
+        log("info", f"Queueing delay before start: {queue_delay:.1f} s")
+    deadline_seconds = kwargs.get("deadline") or PD["scheduling"].get("deadline_seconds")
+    if deadline_seconds and PD["run_options"].get("run_ensemble"):
+        apply_schedule(deadline_seconds - queue_delay, run_start)
+        PD["schedule_info"]["schedule_queue_delay_seconds"] = round(queue_delay, 1)
         
     if nc_fname is None:
         nc_fname = "nc_{:%Y%m%d%H%M}.h5".format(startdate)
@@ -75,7 +142,10 @@ def run(timestamp=None, config=None, **kwargs):
         datasource = pystepsrc["data_sources"][PD["DOMAIN"]]
 
     # Used methods
-    importer = importer_method(name=datasource["importer"])
+    if datasource["importer"] in pgm_io.IMPORTERS:
+        importer = importer_method("fmippn", name=datasource["importer"])
+    else:
+        importer = importer_method(name=datasource["importer"])
     optflow = optflow_method("pysteps")
     nowcaster = nowcast_method("pysteps")
     deterministic_nowcaster = deterministic_method("pysteps")
@@ -87,6 +157,8 @@ def run(timestamp=None, config=None, **kwargs):
     # Output filenames
     motion_output_fname = output_options["path"].joinpath(nc_fname_templ.format(date=startdate, tag="motion", config=config))
     ensemble_output_fname = output_options["path"].joinpath(nc_fname_templ.format(date=startdate, tag="ens", config=config))
+    ensstat_output_fname = output_options["path"].joinpath(nc_fname_templ.format(date=startdate, tag="ensstat", config=config))
+    ensquant_output_fname = output_options["path"].joinpath(nc_fname_templ.format(date=startdate, tag="ensquant", config=config))
     determ_output_fname = output_options["path"].joinpath(nc_fname_templ.format(date=startdate, tag="det", config=config))
 
     # pysteps callback output folder setup
@@ -102,7 +174,25 @@ def run(timestamp=None, config=None, **kwargs):
     time_at_start = dt.datetime.today()
 
     # Observation data input
-    input_files = get_filelist(startdate, datasource)
+    with metrics.stage("file_discovery"):
+        input_files = get_filelist(startdate, datasource)
+
+    PD["run_fingerprint"] = None
+    if PD["run_cache"].get("enabled", False):
+        cache = run_cache.RunCache(PD["run_cache"].get("cache_dir") or
+                                   output_options["path"].joinpath(".run_cache"))
+        PD["run_fingerprint"] = run_cache_fingerprint(input_files[0])
+    if PD["run_fingerprint"] is not None:
+        entry = None if kwargs.get("force") else cache.lookup(PD["run_fingerprint"])
+        metrics.annotate(run_cache="hit" if entry else ("forced" if kwargs.get("force") else "miss"))
+        if entry is not None:
+            log("info", f"Run cache hit {PD['run_fingerprint'][:12]}: {len(entry['outputs'])} "
+                        f"output files of the run at {entry['created']} are up to date, "
+                        f"skipping nowcast")
+            finish_run()
+            return
+        log("info", f"Run cache {'override' if kwargs.get('force') else 'miss'} "
+                    f"{PD['run_fingerprint'][:12]}")
 
     if datasource["importer"] in {"opera_hdf5", "odim_hdf5"}:
         input_quantity = datasource["importer_kwargs"]["qty"]
@@ -121,10 +211,20 @@ def run(timestamp=None, config=None, **kwargs):
     if run_options["nowcast_method"] == "steps":
         nowcast_kwargs = generate_pysteps_setup()
 
-    observations, obs_metadata = read_observations(input_files, datasource, importer)
+    with metrics.stage("read_observations"):
+        observations, obs_metadata = read_observations(input_files, datasource, importer,
+                                                       window=kwargs.get("observation_window"))
 
     # Save obs_metadata in callback function (global dictionary)
     PD_callback['obs_metadata'] = obs_metadata
+
+    if PD["observed_accumulation"].get("compute", False):
+        update_observed_accumulation(observations, PD_callback["obs_nodata"], input_files)
+
+    if PD["verification"].get("compute", False):
+        with metrics.stage("verification"):
+            verify_past_forecasts(observations[-1], PD_callback["obs_nodata"][-1],
+                                  input_files[1][-1], nc_fname_templ)
     
     projection_meta = {
         "projstr": obs_metadata["projection"],
@@ -143,20 +243,23 @@ def run(timestamp=None, config=None, **kwargs):
         }
 
     # pysteps returns motion field in units of pixel/timestep
-    motion_field = optflow(observations, **PD.get("motion_options", dict()))
+    with metrics.stage("motion"):
+        motion_field = optflow(observations, **PD.get("motion_options", dict()))
 
     # TODO: Convert motion field timestep, if needed?
 
     if output_options.get("store_motion", False) and output_options.get("write_asap", False):
         log("info", "write_asap requested, writing motion field now...")
-        odim_io.write_motion_to_file(PD, motion_field, motion_output_fname, metadata=asap_meta)
+        odim_io.write_motion_to_file(PD, motion_field, record_output(motion_output_fname),
+                                     metadata=asap_meta)
 
     # Regenerate ensemble motion
     if run_options.get("regenerate_perturbed_motion"):
         if PD["nowcast_options"].get("seed") is None:
             raise ValueError("Cannot regenerate motion field with unknown seed value!")
         log("info", "Regenerating ensemble motion fields...")
-        ensemble_motion = regenerate_ensemble_motion(motion_field, nowcast_kwargs)
+        with metrics.stage("ensemble_motion"):
+            ensemble_motion = regenerate_ensemble_motion(motion_field, nowcast_kwargs)
         log("info", "Finished regeneration.")
         if output_options.get("store_perturbed_motion", False) and output_options.get("write_asap", False):
             raise NotImplementedError
@@ -167,11 +270,45 @@ def run(timestamp=None, config=None, **kwargs):
     if PD["nowcast_options"].get("seed") is None:
         PD["nowcast_options"]["seed"] = random.randrange(2**32-1)
 
+    PD["lagged_info"] = None
+    close_lagged_members()
+    if run_options.get("run_ensemble") and PD["lagged_ensemble"].get("compute", False):
+        load_lagged_ensemble(ensemble_output_fname, nc_fname_templ)
+
+    if run_options.get("run_ensemble") and PD["ensemble_statistics"].get("compute", False):
+        setup_ensemble_statistics()
+    if run_options.get("run_ensemble") and PD["nowcast_accumulations"].get("compute", False):
+        if "ens_stats" not in PD_callback:
+            raise ValueError("nowcast_accumulations needs ensemble_statistics.compute to be true")
+        setup_nowcast_accumulations(field_shape=observations.shape[1:])
+    if run_options.get("run_ensemble") and PD["exceedance_probabilities"].get("compute", False):
+        setup_exceedance_probabilities(field_shape=observations.shape[1:])
+    if run_options.get("run_ensemble") and PD["ensemble_quantiles"].get("compute", False):
+        quantile_options = PD["ensemble_quantiles"]
+        PD_callback["ens_quantiles"] = ens_quantiles.QuantileBuffer(
+            n_members=odim_io.get_ensemble_size(PD),
+            field_shape=observations.shape[1:],
+            fractiles=quantile_options["fractiles"],
+            block_rows=quantile_options.get("block_rows", 64),
+        )
+
+    if run_options.get("run_ensemble") and PD["accumulation_interpolation"].get("compute", False):
+        setup_accumulation_interpolation(observations[-1], motion_field, ensemble_motion)
+
+    if PD["shared_memory_output"].get("enabled", False):
+        setup_output_arenas(observations.shape[1:], projection_meta)
+
     if run_options.get("run_deterministic"):
-        deterministic, det_meta = generate_deterministic(observations[-1],
-                                                         motion_field,
-                                                         deterministic_nowcaster,
-                                                         metadata=obs_metadata)
+        with metrics.stage("deterministic"):
+            deterministic, det_meta = generate_deterministic(observations[-1],
+                                                             motion_field,
+                                                             deterministic_nowcaster,
+                                                             metadata=obs_metadata)
+        if "ens_stats" in PD_callback:
+            PD_callback["ens_stats"].set_deterministic(deterministic, det_meta["unit"])
+        if ("acc_interp" in PD_callback and
+                PD["accumulation_interpolation"].get("include_deterministic", True)):
+            PD_callback["acc_interp"].set_deterministic(_to_rainrate(deterministic, det_meta["unit"]))
         if output_options.get("store_deterministic", False) and output_options.get("write_asap", False):
             log("info", "write_asap requested, writing deterministic nowcast now...")
             _out, _out_meta = prepare_data_for_writing(deterministic)
@@ -183,7 +320,9 @@ def run(timestamp=None, config=None, **kwargs):
                 log("info", "separate output requested for deterministic nowcast")
                 write_deterministic_separate_odim_output(_out, asap_meta, _out_meta)                
             else:
-                odim_io.write_deterministic_to_file(PD, _out, determ_output_fname, metadata=asap_meta)      
+                archive(odim_io.write_deterministic_to_file, PD, _out, record_output(determ_output_fname),
+                        metadata=dict(asap_meta))
+            publish_to_arena("det", _out, _out_meta)
             # Release memory
             _out = None
             deterministic = None
@@ -196,15 +335,55 @@ def run(timestamp=None, config=None, **kwargs):
         if output_options.get("write_leadtimes_separately", False):
             # Run forecast without saving it here, saving through callback function
             log("debug", "Callback was requested, will skip saving regardless of settings")
-            nowcaster(observations, motion_field, PD["run_options"]["leadtimes"],
-                         **nowcast_kwargs)
+            nowcast_start = time.monotonic()
+            try:
+                with metrics.stage("ensemble_nowcast"):
+                    nowcaster(observations, motion_field, PD["run_options"]["leadtimes"],
+                                 **nowcast_kwargs)
+                finish_arena("ens")
+            except scheduler.DeadlineReached:
+                tracing.instant("deadline_reached", leadtimes=cb_nowcast.counter)
+                stop_at_deadline(cb_nowcast.counter)
+                if "nowcast_acc" in PD_callback:
+                    finish_nowcast_accumulations(cb_nowcast.counter)
+                finish_arena("ens", output_arena.STOPPED)
+            except Exception:
+                finish_arena("ens", output_arena.FAILED)
+                raise
+            nowcast_seconds = time.monotonic() - nowcast_start
+            # Member files must be complete before consolidation
+            wait_for_archive()
             ensemble_forecast = None
             ens_meta = dict()
             PD["ensemble_size"] = None
+            if (output_options.get("store_ensemble", False) and
+                    PD["callback_options"].get("consolidate_ensemble", False)):
+                consolidate_callback_output(ensemble_output_fname)
         else:
-            ensemble_forecast, ens_meta = generate(observations, motion_field, nowcaster,
-                                                nowcast_kwargs, metadata=obs_metadata)
+            nowcast_start = time.monotonic()
+            with metrics.stage("ensemble_nowcast"):
+                ensemble_forecast, ens_meta = generate(observations, motion_field, nowcaster,
+                                                    nowcast_kwargs, metadata=obs_metadata)
+            nowcast_seconds = time.monotonic() - nowcast_start
+            if "lagged" in PD_callback:
+                ensemble_forecast = np.concatenate((ensemble_forecast, PD_callback["lagged"].load()))
             PD["ensemble_size"] = ensemble_forecast.shape[0]
+            if "ens_stats" in PD_callback:
+                write_ensemble_statistics(ensemble_forecast, ens_meta["unit"], ensstat_output_fname)
+            if "ens_prob" in PD_callback:
+                for index in range(ensemble_forecast.shape[1]):
+                    update_exceedance_probabilities(index, ensemble_forecast[:, index],
+                                                    ens_meta["unit"], folder=output_options["path"])
+            if "ens_quantiles" in PD_callback:
+                quantiles = [update_ensemble_quantiles(index, ensemble_forecast[:, index],
+                                                       ens_meta["unit"]).copy()
+                             for index in range(ensemble_forecast.shape[1])]
+                odim_io.write_quantiles_to_file(PD, quantiles, record_output(ensquant_output_fname),
+                                                metadata={"startdate": startdate})
+            if "acc_interp" in PD_callback:
+                for index in range(ensemble_forecast.shape[1]):
+                    update_accumulation_interpolation(index, ensemble_forecast[:, index],
+                                                      ens_meta["unit"])
         
             if output_options.get("store_ensemble", False) and output_options.get("write_asap", False):
                 log("info", "write_asap requested, writing ensemble nowcast now...")
@@ -212,7 +391,9 @@ def run(timestamp=None, config=None, **kwargs):
                 asap_meta["scale_meta"] = _out_meta
                 asap_meta["startdate"] = startdate
                 asap_meta["unit"] = ens_meta["unit"]
-                odim_io.write_ensemble_to_file(PD, _out, ensemble_output_fname, metadata=asap_meta)
+                archive(odim_io.write_ensemble_to_file, PD, _out, record_output(ensemble_output_fname),
+                        metadata=dict(asap_meta))
+                publish_to_arena("ens", _out.transpose(1, 0, 2, 3), _out_meta)
                 # Release memory
                 _out = None
                 ensemble_forecast = None
@@ -253,6 +434,15 @@ def run(timestamp=None, config=None, **kwargs):
     if store_meta["seed"] is None:  # Cannot write None to HDF5
         del store_meta["seed"]
 
+    # Output written at the end is quantized here for the shared memory arenas
+    if not output_options.get("write_asap", False):
+        if ensemble_forecast is not None and "arena_ens" in PD_callback:
+            _out, _out_meta = prepare_data_for_writing(ensemble_forecast)
+            publish_to_arena("ens", _out.transpose(1, 0, 2, 3), _out_meta)
+        if deterministic is not None and "arena_det" in PD_callback:
+            publish_to_arena("det", *prepare_data_for_writing(deterministic))
+        _out = None
+
     # WRITE OUTPUT TO A FILE
     if output_options.get("write_asap", False):
         # Output is already written, skip this
@@ -265,24 +455,99 @@ def run(timestamp=None, config=None, **kwargs):
             motion_meta = {
                 "projection": projection_meta,
             }
-            odim_io.write_motion_to_file(PD, motion_field, motion_output_fname, metadata=motion_meta)
+            odim_io.write_motion_to_file(PD, motion_field, record_output(motion_output_fname),
+                                         metadata=motion_meta)
         if output_options.get("store_ensemble") and not output_options.get("write_leadtimes_separately"):
-            odim_io.write_ensemble_to_file(PD, ensemble_forecast, ensemble_output_fname, metadata=store_meta)
+            odim_io.write_ensemble_to_file(PD, ensemble_forecast, record_output(ensemble_output_fname),
+                                           metadata=store_meta)
         if output_options.get("store_deterministic"):
-            odim_io.write_deterministic_to_file(PD, deterministic, determ_output_fname, metadata=store_meta)
+            odim_io.write_deterministic_to_file(PD, deterministic, record_output(determ_output_fname),
+                                                metadata=store_meta)
         if output_options.get("store_perturbed_motion"):
             pass
 
+    wait_for_archive(shutdown=True)
+    close_output_arenas()
+    close_lagged_members()
     log("info", "Finished writing output to a file.")
+
+    if PD["reprojection"].get("compute", False):
+        product_files = {
+            "det": determ_output_fname,
+            "ens": ensemble_output_fname,
+            "ensstat": ensstat_output_fname,
+            "ensquant": ensquant_output_fname,
+        }
+        reproject_output_files(product_files, projection_meta, observations.shape[1:])
+
+    if run_options.get("run_ensemble") and PD["scheduling"].get("history_file"):
+        record_run_timing(nowcast_seconds, time.monotonic() - run_start)
+
+    if PD["run_fingerprint"] is not None:
+        record_run_cache(cache)
+
+    finish_run()
+
+
+def finish_run():
+    """Write metrics and trace of the run"""
+    run_metrics = metrics.finish_run(json_file=PD["metrics"].get("json_file"),
+                                     exposition_file=PD["metrics"].get("exposition_file"))
+    if run_metrics is not None:
+        log("info", "Stage timings: " + ", ".join(
+            f"{name}={stage['seconds']:.2f}s" for name, stage in run_metrics["stages"].items()))
+
+    tracing.finish()
     log("info", "Run complete. Exiting.")
-    
+
+
+def run_cache_fingerprint(input_files):
+    """Return fingerprint of the run for the run cache (see run_cache.py),
+    or None if the result of the run is not reproducible."""
+    if PD["nowcast_options"].get("seed") is None:
+        log("info", "Run cache: nowcast_options.seed is not set, run is not cached")
+        return None
+    if PD["lagged_ensemble"].get("compute", False):
+        log("info", "Run cache: lagged ensemble depends on previous output, run is not cached")
+        return None
+    return run_cache.fingerprint(input_files, PD, PD["config"], PD["startdate"],
+                                 hash_inputs=PD["run_cache"].get("hash_inputs", "stat"))
+
+
+def record_output(fname):
+    """Add `fname` to the output files of this run (see record_run_cache) and return it"""
+    PD_callback["output_files"].append(Path(fname))
+    return fname
+
+
+def record_run_cache(cache):
+    """Store output files written by this run in the run cache"""
+    if (PD["schedule_info"] or dict()).get("schedule_degraded"):
+        log("info", "Run cache: run was reduced to meet the deadline, outputs are not cached")
+        return
+    output_files = sorted({fname.resolve() for fname in PD_callback["output_files"] if fname.exists()})
+    try:
+        cache.record(PD["run_fingerprint"], output_files, config=PD["config"],
+                     startdate=f"{PD['startdate']:%Y%m%d%H%M}",
+                     created=dt.datetime.utcnow().isoformat(timespec="seconds"))
+    except OSError as error:
+        log("warning", f"Cannot write run cache index: {error}")
+        return
+    log("info", f"Run cache: recorded {len(output_files)} output files")
+
+
 def initialise_logging(log_folder='./', log_fname='ppn.log'):
     """Wrapper for ppn_logger.config_logging() method. Does nothing if writing
     to log is not enabled."""
     if PD["logging"]["write_log"]:
         full_path = Path(log_folder).expanduser().resolve()
         ppn_logger.config_logging(full_path / log_fname,
-                                  level=PD["logging"]["log_level"])
+                                  level=PD["logging"]["log_level"],
+                                  queued=PD["logging"].get("queued", False),
+                                  json_format=PD["logging"].get("json_format", False),
+                                  max_bytes=PD["logging"].get("max_bytes", 0),
+                                  backup_count=PD["logging"].get("backup_count", 5),
+                                  queue_size=PD["logging"].get("queue_size", 10000))
 
 def log(level, msg, *args, **kwargs):
     """Wrapper for ppn_logger. Function does nothing if writing to log is
@@ -305,6 +570,8 @@ def importer_method(module="pysteps", **kwargs):
     """
     if module == "pysteps":
         return pysteps.io.get_method(method_type="importer", **kwargs)
+    if module == "fmippn":
+        return pgm_io.get_importer(**kwargs)
     # Add more options here
 
     raise ValueError("Unknown module {} for importer method".format(module))
@@ -403,6 +670,83 @@ def generate_pysteps_setup():
 
     return nowcast_kwargs
 
+def _n_leadtimes():
+    leadtimes = PD["run_options"]["leadtimes"]
+    return leadtimes if isinstance(leadtimes, int) else len(leadtimes)
+
+
+def _set_n_leadtimes(n_leadtimes):
+    """Reduce the number of leadtimes in run_options to `n_leadtimes`"""
+    runopt = PD["run_options"]
+    if runopt.get("max_leadtime"):
+        runopt["max_leadtime"] = runopt["max_leadtime"] * n_leadtimes // _n_leadtimes()
+    if isinstance(runopt["leadtimes"], int):
+        runopt["leadtimes"] = n_leadtimes
+    else:
+        runopt["leadtimes"] = list(runopt["leadtimes"])[:n_leadtimes]
+
+
+def apply_schedule(deadline_seconds, run_start):
+    """Fit ensemble size and number of leadtimes into the deadline, using the
+    timings of recent runs (see scheduler.py). Must be called before
+    generate_pysteps_setup()."""
+    options = PD["scheduling"]
+    records = scheduler.read_history(options.get("history_file"), config=PD["config"],
+                                     max_runs=options.get("history_runs", 20))
+    model = scheduler.CostModel.from_history(records)
+    n_members = PD["nowcast_options"]["n_ens_members"]
+    n_leadtimes = _n_leadtimes()
+    result = scheduler.plan(model, deadline_seconds - options.get("reserve_seconds", 0),
+                            n_members, n_leadtimes,
+                            min_members=options.get("min_members", 1),
+                            min_leadtimes=options.get("min_leadtimes", 1),
+                            order=options.get("reduce_order", ["members", "leadtimes"]),
+                            safety_factor=options.get("safety_factor", 1.1))
+    if model is None:
+        log("info", f"No timing history for config {PD['config']}, running without degradation")
+    elif result["degraded"]:
+        log("warning", f"Predicted run time exceeds deadline of {deadline_seconds} s, running "
+                       f"{result['n_members']}/{n_members} members and "
+                       f"{result['n_leadtimes']}/{n_leadtimes} leadtimes "
+                       f"(predicted {result['predicted_seconds']:.1f} s)")
+    PD["nowcast_options"]["n_ens_members"] = result["n_members"]
+    if result["n_leadtimes"] != n_leadtimes:
+        _set_n_leadtimes(result["n_leadtimes"])
+
+    PD["schedule_info"] = {
+        "schedule_deadline_seconds": deadline_seconds,
+        "schedule_requested_members": n_members,
+        "schedule_requested_leadtimes": n_leadtimes,
+        "schedule_members": result["n_members"],
+        "schedule_leadtimes": result["n_leadtimes"],
+        "schedule_degraded": int(result["degraded"]),
+        "schedule_stopped_early": 0,
+    }
+    if result["predicted_seconds"] is not None:
+        PD["schedule_info"]["schedule_predicted_seconds"] = round(result["predicted_seconds"], 1)
+    PD_callback["deadline"] = scheduler.Deadline(deadline_seconds, start=run_start)
+
+
+def stop_at_deadline(n_computed):
+    """Record that the callback nowcast was stopped after `n_computed` leadtimes"""
+    log("warning", f"Deadline reached, stopped nowcasting after {n_computed}/{_n_leadtimes()} leadtimes")
+    _set_n_leadtimes(n_computed)
+    PD["schedule_info"]["schedule_leadtimes"] = n_computed
+    PD["schedule_info"]["schedule_degraded"] = 1
+    PD["schedule_info"]["schedule_stopped_early"] = 1
+
+
+def record_run_timing(nowcast_seconds, total_seconds):
+    """Append timings of this run to the scheduling history file"""
+    record = scheduler.history_record(PD["config"], PD["startdate"],
+                                      PD["nowcast_options"]["n_ens_members"], _n_leadtimes(),
+                                      nowcast_seconds, total_seconds)
+    try:
+        scheduler.append_history(PD["scheduling"]["history_file"], record)
+    except OSError as error:
+        log("warning", f"Cannot write timing history: {error}")
+
+
 def get_filelist(startdate, datasource):
     """Get a list of input file names"""
     try:
@@ -420,14 +764,34 @@ def get_filelist(startdate, datasource):
         raise OSError(error_msg) from pysteps_error
     return filelist
 
-def read_observations(filelist, datasource, importer):
+def read_observations(filelist, datasource, importer, window=None):
     """Read observations from archives using pysteps methods. Also threshold
     the input data and (optionally) convert dBZ -> dBR based on configuration
-    parameters."""
+    parameters. If `window` (obs_window.ObservationWindow) is given, files
+    decoded in previous runs are taken from it. With shared_memory_input,
+    observations published in shared memory are used instead of the files
+    (see shm_io.py)."""
     # PGM files contain dBZ values
-    obs, _, metadata = pysteps.io.readers.read_timeseries(filelist,
-                                                          importer,
-                                                          **datasource["importer_kwargs"])
+    with metrics.stage("decoding"):
+        if PD["shared_memory_input"].get("enabled", False):
+            reader = shm_io.SharedMemoryReader(PD["shared_memory_input"].get("prefix") or
+                                               shm_io.default_prefix(PD["config"]),
+                                               fallback=window)
+            obs, _, metadata = reader.read_timeseries(filelist, importer,
+                                                      **datasource["importer_kwargs"])
+            log("info", f"Observations from shared memory: {reader.attached}, "
+                        f"decoded from files: {reader.decoded}")
+        elif window is not None:
+            obs, _, metadata = window.read_timeseries(filelist, importer,
+                                                      **datasource["importer_kwargs"])
+            log("debug", f"Observation window: {window.hits} reused, {window.misses} decoded")
+        else:
+            obs, _, metadata = pysteps.io.readers.read_timeseries(filelist,
+                                                                  importer,
+                                                                  **datasource["importer_kwargs"])
+
+    # Nodata pixels and missing observations are NaN until thresholding fills them
+    PD_callback["obs_nodata"] = ~np.isfinite(obs)
 
     input_qty = PD["input_quantity"]
     fct_qty = PD["run_options"].get("forecast_as_quantity", input_qty)
@@ -437,8 +801,9 @@ def read_observations(filelist, datasource, importer):
     elif utils.quantity_is_rate(input_qty) and utils.quantity_is_dbzh(fct_qty):
         obs, metadata = rrate_to_dbz(obs, metadata)
 
-    obs, metadata = thresholding(obs, metadata, threshold=PD["converted_rain_thr"],
-                                 norain_value=PD["run_options"]["steps_set_no_rain_to_value"])
+    with metrics.stage("thresholding"):
+        obs, metadata = thresholding(obs, metadata, threshold=PD["converted_rain_thr"],
+                                     norain_value=PD["run_options"]["steps_set_no_rain_to_value"])
 
     if utils.quantity_is_rate(fct_qty):
         obs, metadata = transform_to_decibels(obs, metadata)
@@ -578,6 +943,372 @@ def generate_deterministic(observations, motion_field, nowcaster, nowcast_kwargs
                               metadata)
     return forecast, meta
 
+def setup_ensemble_statistics():
+    """Initialise online ensemble statistics (see ens_stats.py). The statistics
+    are updated for each leadtime in cb_nowcast or after generate()."""
+    stat_options = PD["ensemble_statistics"]
+    leadtimes = PD["run_options"]["leadtimes"]
+    n_leadtimes = leadtimes if isinstance(leadtimes, int) else len(leadtimes)
+
+    PD_callback["ens_stats"] = ens_stats.EnsembleStatistics(
+        n_members=odim_io.get_ensemble_size(PD),
+        n_leadtimes=n_leadtimes,
+        determ_initweight=stat_options["determ_initweight"],
+        determ_weightspan=stat_options["determ_weightspan"],
+        zr_a=PD["data_options"]["zr_a"],
+        zr_b=PD["data_options"]["zr_b"],
+        rain_threshold=_output_rain_threshold(),
+    )
+    log("debug", "Ensemble statistics will be calculated during nowcasting")
+
+def _output_rain_threshold():
+    """Rain threshold in output quantity units"""
+    out_qty = PD["output_options"].get("as_quantity", None)
+    if out_qty is None:
+        out_qty = PD["input_quantity"]
+    return _convert_for_output(PD["data_options"].get("rain_threshold"), out_qty)
+
+def setup_exceedance_probabilities(field_shape):
+    """Initialise streaming exceedance probabilities (see ens_prob.py). They are
+    updated for each leadtime in cb_nowcast or after generate()."""
+    prob_options = PD["exceedance_probabilities"]
+    periods = [ens_prob.AccumulationPeriod.from_string(line)
+               for line in prob_options.get("accumulation_periods", [])]
+    if prob_options.get("threshold_file") is not None:
+        periods.extend(ens_prob.read_threshold_config(prob_options["threshold_file"]))
+
+    PD_callback["ens_prob"] = ens_prob.ExceedanceProbabilities(
+        n_members=odim_io.get_ensemble_size(PD),
+        field_shape=field_shape,
+        timestep=get_timesteps(),
+        rate_thresholds=prob_options.get("rate_thresholds", []),
+        accumulation_periods=periods,
+    )
+    state_mb = PD_callback["ens_prob"].accumulation_state_bytes() / 2**20
+    max_state_mb = prob_options.get("max_accumulation_state_mb")
+    if max_state_mb is not None and state_mb > max_state_mb:
+        raise ValueError(f"Accumulation probabilities need {state_mb:.0f} MB for "
+                         f"{odim_io.get_ensemble_size(PD)} members, more than "
+                         f"exceedance_probabilities.max_accumulation_state_mb={max_state_mb}")
+    log("debug", f"Exceedance probabilities will be calculated for {len(periods)} accumulation "
+                 f"periods, accumulation state {state_mb:.0f} MB")
+
+def _to_rainrate(field, unit):
+    """Convert thresholded output field to rain rate (mm/h)"""
+    return ens_stats.to_rainrate(field, unit, _output_rain_threshold(),
+                                 PD["data_options"]["zr_a"], PD["data_options"]["zr_b"])
+
+def load_lagged_ensemble(ensemble_output_fname, nc_fname_templ):
+    """Open members of the previous run as time-lagged members (see
+    lagged_ensemble.py). They are read one leadtime at a time in cb_nowcast,
+    or all at once after generate(), and appended after the members of this run."""
+    lag_options = PD["lagged_ensemble"]
+    timestep = get_timesteps()
+    lag_minutes = lag_options.get("lag_minutes") or timestep
+    prev_start = lagged_ensemble.previous_startdate(PD["startdate"], lag_minutes)
+
+    path = lag_options.get("path")
+    if path is None:
+        if (PD["output_options"].get("write_leadtimes_separately", False) and
+                not PD["callback_options"].get("consolidate_ensemble", False)):
+            path = PD["callback_options"]["tmp_folder"]
+        else:
+            path = Path(ensemble_output_fname).with_name(
+                nc_fname_templ.format(date=prev_start, tag="ens", config=PD["config"]))
+
+    out_qty = PD["output_options"].get("as_quantity", None) or PD["input_quantity"]
+    _set_output_thresholds(out_qty)
+    leadtimes = PD["run_options"]["leadtimes"]
+    try:
+        lagged = lagged_ensemble.open_lagged_members(
+            path, PD["startdate"], lag_minutes, timestep,
+            n_leadtimes=leadtimes if isinstance(leadtimes, int) else len(leadtimes),
+            max_members=lag_options.get("max_members") or PD["nowcast_options"]["n_ens_members"],
+            config=PD["config"],
+            undetect_value=PD["out_norain_value"],
+        )
+    except (OSError, ValueError) as error:
+        # Previous run is missing, run without lagged members
+        log("warning", f"Time-lagged members not available from {path}: {error}")
+        return
+
+    PD_callback["lagged"] = lagged
+    PD_callback["lagged_leadtimes"] = lagged.valid_leadtimes
+    if PD_callback["lagged_leadtimes"] < lagged.n_leadtimes:
+        log("info", f"Time-lagged members are left out of ensemble products after "
+                    f"leadtime {PD_callback['lagged_leadtimes']}")
+    PD["lagged_info"] = {
+        "lagged_members": lagged.n_members,
+        "lagged_first_member": PD["nowcast_options"]["n_ens_members"] + 1,
+        "lagged_startdate": f"{prev_start:%Y%m%d%H%M}",
+        "lagged_minutes": lag_minutes,
+    }
+    log("info", f"Using {lagged.n_members} time-lagged members from run {prev_start:%Y%m%d%H%M}")
+
+def close_lagged_members():
+    """Close the previous run's output opened by load_lagged_ensemble"""
+    lagged = PD_callback.pop("lagged", None)
+    if lagged is not None:
+        lagged.close()
+
+def _product_members(n_timestep, field):
+    """Return the members of `field` (member, y, x) used for ensemble products
+    at leadtime `n_timestep`. Time-lagged members are left out after the end
+    of the previous run's forecast."""
+    if "lagged" in PD_callback and n_timestep >= PD_callback["lagged_leadtimes"]:
+        return field[:field.shape[0] - PD_callback["lagged"].n_members]
+    return field
+
+def _observation_rainrate(observation, nodata=None):
+    """Convert observation field to thresholded rain rate (mm/h). Pixels of
+    `nodata` (boolean mask from read_observations) are set to NaN."""
+    observation, obs_meta = convert_callback_output(np.array(observation, copy=True))
+    rate = _to_rainrate(observation, obs_meta["unit"])
+    if nodata is not None:
+        rate[nodata] = np.nan
+    return rate
+
+def update_observed_accumulation(observations, nodata, input_files):
+    """Add observations to the rolling observed accumulation (see obs_acc.py)
+    and write accumulations when the newest observation is at an output time.
+    Missing observations are not added, they are reported as missing."""
+    acc_options = PD["observed_accumulation"]
+    if acc_options.get("state_dir") is None:
+        raise ValueError("observed_accumulation.state_dir must be set when observed_accumulation.compute is true")
+    rolling = obs_acc.RollingAccumulation(acc_options["state_dir"],
+                                          field_shape=observations.shape[1:],
+                                          timestep=PD["data_source"]["timestep"],
+                                          window_minutes=acc_options.get("window_minutes", 60))
+    fnames, obstimes = input_files
+    for observation, obs_nodata, fname, obstime in zip(observations, nodata, fnames, obstimes):
+        # Observations of earlier runs are already in the window
+        if fname is None or rolling.has_slot(obstime):
+            continue
+        rolling.update(obstime, _observation_rainrate(observation, obs_nodata))
+    rolling.flush()
+
+    latest = obstimes[-1]
+    if (latest.hour * 60 + latest.minute) % acc_options.get("output_interval", 60):
+        return
+    folder = acc_options.get("path") or PD["output_options"]["path"]
+    for minutes in acc_options.get("output_minutes", [60]):
+        accumulation, n_missing = rolling.accumulation(latest, minutes)
+        if n_missing:
+            log("warning", f"{n_missing} observations missing from {minutes} minute accumulation")
+        fname = Path(folder).joinpath(acc_options["filename"].format(date=latest, minutes=minutes,
+                                                                     config=PD["config"]))
+        obs_acc.write_acc_pgm(record_output(fname), accumulation)
+        log("info", f"Observed accumulation written to {fname}")
+
+def _past_forecast_paths(startdate, n_timestep, fc_type, nc_fname_templ):
+    """Return output file, or list of callback files, of the run at `startdate`
+    containing leadtime `n_timestep`. Return None if not found."""
+    path = PD["verification"].get("path") or PD["output_options"]["path"]
+    fname = Path(path).joinpath(nc_fname_templ.format(date=startdate, tag=fc_type, config=PD["config"]))
+    if fname.exists():
+        return fname
+    if fc_type == "det":
+        fname = callback_filename(n_timestep, tag="det", startdate=startdate)
+        return [fname] if fname.exists() else None
+    fnames = []
+    while True:
+        fname = callback_filename(n_timestep, member=len(fnames) + 1, startdate=startdate)
+        if not fname.exists():
+            break
+        fnames.append(fname)
+    return fnames or None
+
+def verify_past_forecasts(observation, nodata, obstime, nc_fname_templ):
+    """Verify nowcasts of earlier runs valid at the newest observation
+    against it and update the verification state (see verification.py).
+    Pixels of `nodata` are left out."""
+    options = PD["verification"]
+    if options.get("state_file") is None:
+        raise ValueError("verification.state_file must be set when verification.compute is true")
+    timestep = get_timesteps()
+    max_leadtime = (options.get("max_leadtime") or PD["run_options"].get("max_leadtime") or
+                    timestep * _n_leadtimes())
+    out_qty = PD["output_options"].get("as_quantity", None) or PD["input_quantity"]
+    unit = "dBZ" if utils.quantity_is_dbzh(out_qty) else "mm/h"
+
+    observed = _observation_rainrate(observation, nodata)
+    verif = verification.Verification(options["state_file"], options.get("thresholds", [0.1, 1.0, 5.0]))
+    n_verified = 0
+    for leadtime in range(timestep, max_leadtime + 1, timestep):
+        startdate = obstime - dt.timedelta(minutes=leadtime)
+        for fc_type in options.get("products", ["det", "ens"]):
+            if verif.is_verified(fc_type, startdate, obstime):
+                continue
+            paths = _past_forecast_paths(startdate, leadtime // timestep - 1, fc_type, nc_fname_templ)
+            if paths is None:
+                continue
+            try:
+                fields = verification.read_valid_field(paths, obstime,
+                                                       undetect_value=PD["out_norain_value"])
+            except (OSError, KeyError, ValueError) as error:
+                log("warning", f"Cannot read {fc_type} nowcast of {startdate:%Y%m%d%H%M} for "
+                               f"verification: {error}")
+                continue
+            if fields is not None:
+                n_verified += verif.add(fc_type, leadtime, startdate, obstime,
+                                        _to_rainrate(fields, unit), observed)
+
+    verif.save()
+    if options.get("scores_file") and n_verified:
+        verif.write_slot_scores(options["scores_file"], obstime, config=PD["config"])
+    log("info", f"Verified {n_verified} past nowcasts valid at {obstime:%Y%m%d%H%M}")
+    for fc_type, leadtimes in verif.slot_scores.items():
+        for leadtime, values in sorted(leadtimes.items()):
+            log("debug", f"Verification {fc_type} +{leadtime} min: " +
+                         ", ".join(f"{key}={value:.3f}" for key, value in values.items()
+                                   if isinstance(value, float)))
+
+def setup_accumulation_interpolation(last_observation, motion_field, ensemble_motion):
+    """Initialise accumulation interpolation along motion (see motion_interp.py).
+    Trajectory tables of the shared motion are calculated here once (tables of
+    perturbed member motion chunk by chunk when needed), accumulations are updated
+    for each leadtime in cb_nowcast or after generate()."""
+    interp_options = PD["accumulation_interpolation"]
+    member_motion = None
+    if ensemble_motion is not None and interp_options.get("use_ensemble_motion", True):
+        member_motion = list(ensemble_motion)
+
+    PD_callback["acc_interp"] = motion_interp.AccumulationInterpolator(
+        initial_rate=_observation_rainrate(last_observation),
+        motion=motion_field,
+        member_motion=member_motion,
+        timestep=get_timesteps(),
+        n_members=odim_io.get_ensemble_size(PD),
+        intsteps=interp_options.get("intsteps", 10),
+        chunk_size=interp_options.get("chunk_size"),
+    )
+    log("debug", "Trajectory tables for accumulation interpolation calculated")
+
+def update_accumulation_interpolation(n_timestep, field, unit):
+    """Add one leadtime of ensemble nowcast (member, y, x) to interpolated
+    accumulations and write the RAVAKE accumulation file of the leadtime."""
+    interp_options = PD["accumulation_interpolation"]
+    accumulations = PD_callback["acc_interp"].add(n_timestep, _to_rainrate(field, unit))
+
+    timestep = get_timesteps()
+    validtime = PD["startdate"] + (n_timestep + 1) * dt.timedelta(minutes=timestep)
+    area = interp_options.get("area") or PD["config"]
+    folder = interp_options.get("path") or PD["output_options"]["path"]
+    fname = (f"{interp_options.get('acc_prefix', 'RAVACC')}_{PD['startdate']:%Y%m%d%H%M}-"
+             f"{validtime:%Y%m%d%H%M}+{(n_timestep+1)*timestep:03}_{area}.dat")
+    motion_interp.write_ravake_accumulation(record_output(Path(folder).joinpath(fname)), accumulations)
+
+def reproject_output_files(product_files, projection_meta, field_shape):
+    """Write reprojected copies of existing output files, see reproject.py.
+    The index table is read from reprojection.cache_dir if available."""
+    reproj_options = PD["reprojection"]
+    if reproj_options.get("target_grid") is None:
+        raise ValueError("reprojection.target_grid must be set when reprojection.compute is true")
+    target_grid = reproject.read_grid_cfg(reproj_options["target_grid"])
+    reprojector = reproject.Reprojector.cached(
+        reproject.grid_from_projection_meta(projection_meta, field_shape),
+        target_grid,
+        method=reproj_options.get("method", "nearest"),
+        cache_dir=reproj_options.get("cache_dir"),
+    )
+
+    suffix = reproj_options.get("tag_suffix")
+    if suffix is None:
+        suffix = f"epsg{target_grid['epsg']}" if "epsg" in target_grid else "reproj"
+    for tag in reproj_options.get("products", []):
+        fname = product_files.get(tag)
+        if fname is None or not Path(fname).exists():
+            continue
+        out_fname = Path(fname).with_name(Path(fname).name.replace(
+            f".{tag}_conf=", f".{tag}_{suffix}_conf="))
+        log("info", f"Writing reprojected {tag} output to {out_fname}")
+        odim_io.write_reprojected_file(reprojector, fname, record_output(out_fname),
+                                       batch_size=reproj_options.get("batch_size", 16))
+
+def setup_nowcast_accumulations(field_shape):
+    """Initialise windowed ensemble mean accumulations (see acc_products.py).
+    They are updated with the ensemble mean of each leadtime."""
+    acc_options = PD["nowcast_accumulations"]
+    PD_callback["nowcast_acc"] = acc_products.WindowedAccumulations(
+        field_shape=field_shape,
+        timestep=get_timesteps(),
+        window_ends=acc_options.get("window_ends", [60, 120, 180, 240]),
+        window_length=acc_options.get("window_length", 60),
+        replace_range=acc_options.get("replace_range"),
+        replace_value=acc_options.get("replace_value", 0.0),
+    )
+    if acc_options.get("coverage_mask_file"):
+        for start, end in PD_callback["nowcast_acc"].windows:
+            fname = Path(acc_options["coverage_mask_file"].format(
+                start=PD["startdate"] + dt.timedelta(minutes=start),
+                end=PD["startdate"] + dt.timedelta(minutes=end), config=PD["config"]))
+            if not fname.exists():
+                log("warning", f"Coverage mask {fname} not found, using nowcast nodata only")
+                continue
+            mask, _ = pgm_io.read_pgm(fname)
+            PD_callback["nowcast_acc"].set_coverage_mask(end, mask == 0)
+
+def update_nowcast_accumulations(n_timestep, mean):
+    """Add ensemble mean rain rate of one leadtime to windowed accumulations
+    and write the products when all windows are complete."""
+    write_nowcast_accumulations(PD_callback["nowcast_acc"].add(n_timestep, mean))
+
+def finish_nowcast_accumulations(n_computed):
+    """Write windowed accumulations that are complete after a nowcast stopped
+    at `n_computed` leadtimes, and log the windows that are skipped."""
+    nowcast_acc = PD_callback["nowcast_acc"]
+    complete = nowcast_acc.complete_windows(n_computed)
+    skipped = [window for window in nowcast_acc.windows if window not in complete]
+    if skipped:
+        log("warning", "Nowcast stopped early, skipping accumulations " +
+                       ", ".join(f"+{start}-{end} min" for start, end in skipped))
+    write_nowcast_accumulations(nowcast_acc.products(n_computed))
+
+def write_nowcast_accumulations(products):
+    acc_options = PD["nowcast_accumulations"]
+    folder = acc_options.get("path") or PD["output_options"]["path"]
+    for product in products:
+        start = PD["startdate"] + dt.timedelta(minutes=product["start"])
+        end = PD["startdate"] + dt.timedelta(minutes=product["end"])
+        fname = Path(folder).joinpath(acc_options["filename"].format(
+            start=start, end=end, minutes=product["end"] - product["start"], config=PD["config"]))
+        obs_acc.write_acc_pgm(record_output(fname), product["accumulation"])
+        log("debug", f"Nowcast accumulation written to {fname}")
+
+def update_ensemble_quantiles(n_timestep, field, unit):
+    """Add one leadtime of ensemble nowcast (member, y, x) to quantile buffer.
+    Returns quantiles of rain rate (fractile, y, x), see ens_quantiles.py."""
+    field = _product_members(n_timestep, field)
+    return PD_callback["ens_quantiles"].add(n_timestep, _to_rainrate(field, unit),
+                                            n_members=field.shape[0])
+
+def update_exceedance_probabilities(n_timestep, field, unit, folder):
+    """Add one leadtime of ensemble nowcast (member, y, x) to exceedance
+    probabilities and write completed products to `folder`."""
+    rates = _to_rainrate(_product_members(n_timestep, field), unit)
+    for product in PD_callback["ens_prob"].update(n_timestep, rates, n_members=rates.shape[0]):
+        if product["kind"] == "rate":
+            tag = "prob"
+        else:
+            tag = f"accprob{product['acc_minutes']:03}min"
+        fname = callback_filename(product["end"] - 1, tag=tag, folder=folder)
+        odim_io.write_probabilities_to_file(PD, product, record_output(fname), PD["startdate"])
+
+def write_ensemble_statistics(ensemble_forecast, unit, filename):
+    """Calculate ensemble statistics for all leadtimes of a complete ensemble
+    nowcast (member, leadtime, y, x) and write them to a single file."""
+    stats = PD_callback["ens_stats"]
+    mean, spread = [], []
+    for index in range(ensemble_forecast.shape[1]):
+        lt_mean, lt_spread = stats.update(index, _product_members(index, ensemble_forecast[:, index]),
+                                          unit)
+        if "nowcast_acc" in PD_callback:
+            update_nowcast_accumulations(index, lt_mean)
+        mean.append(lt_mean)
+        spread.append(lt_spread)
+    odim_io.write_ensemble_statistics_to_file(PD, mean, spread, record_output(filename),
+                                              metadata={"startdate": PD["startdate"]})
+
 def regenerate_ensemble_motion(motion_field, nowcast_kwargs):
     """Generate motion perturbations the same way as pysteps.nowcasts.steps function.
 
@@ -618,6 +1349,7 @@ def regenerate_ensemble_motion(motion_field, nowcast_kwargs):
 
     return ensemble_motions
 
+@metrics.timed("quantization")
 def prepare_data_for_writing(forecast):
     """Convert and scale ensemble and deterministic forecast data to uint16 type"""
     # Actual method moved to utils.py
@@ -637,17 +1369,13 @@ def write_deterministic_separate_odim_output(field, metadata, store_meta):
     """Write deterministic forecast single dataset per file.
     """
 
-    folder = PD["callback_options"]["tmp_folder"]
-    
     for i in range(field.shape[0]):
-        timestep=PD["run_options"]["nowcast_timestep"]
-        timestamp = (PD["startdate"] + (i+1) * dt.timedelta(minutes=timestep)).strftime('%Y%m%d%H%M')
-        fname = f"{PD['startdate']:%Y%m%d%H%M}_{timestamp}_nclen={(i+1)*timestep:03}min_radar.fmippn.det_conf={PD['config']}.h5"
-        with h5py.File(folder.joinpath(fname), 'w') as f:
+        with h5py.File(record_output(callback_filename(i, tag="det")), 'w') as f:
             write_odim_output_separately(f, i, field[i,:,:], metadata, store_meta, fc_type="det")
 
 
 
+@metrics.timed("leadtime")
 def cb_nowcast(field):
     """Callback function for pysteps.                                             
     Store calculated fields to their own hdf5 files.
@@ -655,27 +1383,209 @@ def cb_nowcast(field):
     # Count calls from pysteps, used for calculating the timestamp.
     n_timestep = cb_nowcast.counter
     cb_nowcast.counter += 1
-    
-    timestep=PD["run_options"]["nowcast_timestep"]
-    timestamp = (PD["startdate"] + cb_nowcast.counter * dt.timedelta(minutes=timestep)).strftime('%Y%m%d%H%M')
-    folder = PD["callback_options"]["tmp_folder"]
 
     # Process data to wanted output format
-    field, metadata, store_meta = process_callback_output(field)
-    
-    # Store each ensemble member separately
+    field, metadata = convert_callback_output(field)
+    if "lagged" in PD_callback:
+        field = np.concatenate((field, PD_callback["lagged"].leadtime(n_timestep)))
+
+    if "ens_stats" in PD_callback:
+        mean, spread = PD_callback["ens_stats"].update(n_timestep, _product_members(n_timestep, field),
+                                                       metadata["unit"])
+        if "nowcast_acc" in PD_callback:
+            update_nowcast_accumulations(n_timestep, mean)
+        fname = callback_filename(n_timestep, tag="ensstat")
+        odim_io.write_ensemble_statistics_to_file(PD, [mean], [spread], record_output(fname),
+                                                  metadata={"startdate": PD["startdate"],
+                                                            "first_index": n_timestep})
+
+    if "ens_prob" in PD_callback:
+        update_exceedance_probabilities(n_timestep, field, metadata["unit"],
+                                        folder=PD["callback_options"]["tmp_folder"])
+
+    if "ens_quantiles" in PD_callback:
+        quantiles = update_ensemble_quantiles(n_timestep, field, metadata["unit"])
+        if quantiles is not None:
+            odim_io.write_quantiles_to_file(PD, [quantiles],
+                                            record_output(callback_filename(n_timestep, tag="ensquant")),
+                                            metadata={"startdate": PD["startdate"],
+                                                      "first_index": n_timestep})
+
+    if "acc_interp" in PD_callback:
+        update_accumulation_interpolation(n_timestep, field, metadata["unit"])
+
+    field, store_meta = prepare_data_for_writing(field)
+    if "arena_ens" in PD_callback:
+        PD_callback["arena_ens"].put(n_timestep, field, store_meta)
+
+    archive(write_callback_members, n_timestep, field, dict(metadata), store_meta)
+
+    if ("deadline" in PD_callback and cb_nowcast.counter < _n_leadtimes() and
+            not PD_callback["deadline"].check(PD["scheduling"].get("reserve_seconds", 0))):
+        raise scheduler.DeadlineReached()
+
+
+# Initialize callback function counter
+cb_nowcast.counter = 0
+
+
+def write_callback_members(n_timestep, field, metadata, store_meta):
+    """Store each ensemble member of a leadtime separately"""
     for i in range(field.shape[0]):
         member=i+1
-        fname = f"{PD['startdate']:%Y%m%d%H%M}_{timestamp}_nclen={cb_nowcast.counter*timestep:03}min_radar.fmippn.ens_conf={PD['config']}_ensmem={member}.h5"
-        with h5py.File(folder.joinpath(fname), 'w') as f:
+        fname = record_output(callback_filename(n_timestep, member=member))
+        with tracing.span("write_member", leadtime=n_timestep, member=member), h5py.File(fname, 'w') as f:
 
             write_odim_output_separately(f, n_timestep, field[i,:,:], metadata, store_meta, fc_type="ens")
-            
-            
-# Initialize callback function counter                                                                                                    
-cb_nowcast.counter = 0
 
 
+def setup_output_arenas(field_shape, projection_meta):
+    """Create shared memory arenas for the ensemble and deterministic output
+    of this run, and the background writer for the files (see output_arena.py)"""
+    options = PD["shared_memory_output"]
+    prefix = options.get("prefix") or output_arena.default_prefix(PD["config"])
+    timestep = dt.timedelta(minutes=get_timesteps())
+    out_qty = PD["output_options"].get("as_quantity") or PD["input_quantity"]
+    descriptor = {
+        "config": PD["config"],
+        "startdate": f"{PD['startdate']:%Y%m%d%H%M}",
+        "valid_times": [f"{PD['startdate'] + (index + 1) * timestep:%Y%m%d%H%M}"
+                        for index in range(_n_leadtimes())],
+        "quantity": out_qty,
+        "unit": "dBZ" if utils.quantity_is_dbzh(out_qty) else "mm/h",
+        "projection": projection_meta,
+    }
+    dtype = PD["output_options"].get("convert_to_dtype")
+    if dtype is None or np.dtype(dtype).kind not in "iu":
+        # Unquantized output of a 51 member ensemble would take several GB of /dev/shm
+        raise ValueError("shared_memory_output needs integer output, "
+                         "set output_options.convert_to_dtype (e.g. uint16)")
+    products = {
+        "ens": (PD["run_options"].get("run_ensemble") and PD["output_options"].get("store_ensemble"),
+                odim_io.get_ensemble_size(PD)),
+        "det": (PD["run_options"].get("run_deterministic") and PD["output_options"].get("store_deterministic"),
+                1),
+    }
+    for tag, (store, n_members) in products.items():
+        if not store:
+            continue
+        name = output_arena.arena_name(prefix, tag, PD["startdate"])
+        PD_callback[f"arena_{tag}"] = output_arena.OutputArena.create(
+            name, _n_leadtimes(), n_members, field_shape, dtype, dict(descriptor, tag=tag))
+        log("info", f"Output of {tag} nowcast in shared memory {name}")
+    if options.get("async_archive", True):
+        PD_callback["archive"] = output_arena.ArchiveWriter(
+            max_pending=options.get("max_pending_writes", 2))
+
+
+def publish_to_arena(tag, forecast, scale_meta):
+    """Copy quantized output (leadtime, member, y, x) or (leadtime, y, x) to the arena"""
+    arena = PD_callback.get(f"arena_{tag}")
+    if arena is None:
+        return
+    if forecast.ndim == 3:
+        forecast = forecast[:, None]
+    for index in range(forecast.shape[0]):
+        arena.put(index, forecast[index], scale_meta)
+    arena.finish(output_arena.COMPLETE)
+
+
+def finish_arena(tag, state=output_arena.COMPLETE):
+    if f"arena_{tag}" in PD_callback:
+        PD_callback[f"arena_{tag}"].finish(state)
+
+
+def close_output_arenas():
+    """Detach from the arenas, they stay for the consumers. Arenas that were
+    not completed (the run failed) are marked failed."""
+    for tag in ("ens", "det"):
+        arena = PD_callback.pop(f"arena_{tag}", None)
+        if arena is not None:
+            if arena.state == output_arena.WRITING:
+                arena.finish(output_arena.FAILED)
+            arena.close()
+
+
+def archive(func, *args, **kwargs):
+    """Write output file with `func`, in the background writer if there is one"""
+    if "archive" in PD_callback:
+        PD_callback["archive"].submit(func, *args, **kwargs)
+    else:
+        func(*args, **kwargs)
+
+
+def wait_for_archive(shutdown=False):
+    """Wait for output files submitted to the background writer"""
+    writer = PD_callback.get("archive")
+    if writer is None:
+        return
+    with metrics.stage("archive_wait"):
+        writer.wait()
+    if shutdown:
+        stop_archive()
+
+
+def stop_archive():
+    """Stop the background writer after its submitted writes"""
+    writer = PD_callback.pop("archive", None)
+    if writer is not None:
+        writer.shutdown()
+
+
+def callback_filename(n_timestep, member=None, tag="ens", folder=None, startdate=None):
+    """Return the full path of a single leadtime output file.
+
+    Input:
+        n_timestep -- leadtime number (starting from 0)
+        member -- ensemble member number (starting from 1), None for products
+                  that are not ensemble members (default=None)
+        tag -- product tag, e.g. "ens", "det" or "ensstat" (default="ens")
+        folder -- output folder, if None use callback_options.tmp_folder (default=None)
+        startdate -- analysis time of the run, if None use this run's (default=None)
+    """
+    if startdate is None:
+        startdate = PD["startdate"]
+    timestep = PD["run_options"]["nowcast_timestep"]
+    timestamp = (startdate + (n_timestep + 1) * dt.timedelta(minutes=timestep)).strftime('%Y%m%d%H%M')
+    fname = (f"{startdate:%Y%m%d%H%M}_{timestamp}_nclen={(n_timestep+1)*timestep:03}min_"
+             f"radar.fmippn.{tag}_conf={PD['config']}")
+    if member is not None:
+        fname += f"_ensmem={member}"
+    if folder is None:
+        folder = PD["callback_options"]["tmp_folder"]
+    return Path(folder).joinpath(fname + ".h5")
+
+
+def consolidate_callback_output(filename):
+    """Combine the per-member and per-leadtime files written by cb_nowcast
+    into a single ODIM HDF5 ensemble file. The data is not copied, the
+    output file contains virtual datasets that point to the callback files.
+
+    Input:
+        filename -- filename for the consolidated ensemble HDF5 file
+    """
+    if PD["output_options"].get("field_encoding", "dense") != "dense":
+        log("warning", "Virtual datasets need dense callback output, skipping consolidation.")
+        return None
+
+    n_members = odim_io.get_ensemble_size(PD)
+    n_leadtimes = cb_nowcast.counter
+    part_files = [[callback_filename(lt, member) for lt in range(n_leadtimes)]
+                  for member in range(1, n_members + 1)]
+
+    missing = [str(fname) for member_files in part_files for fname in member_files
+               if not fname.exists()]
+    if missing:
+        log("error", f"Cannot consolidate callback output, {len(missing)} files are missing: "
+                     f"{missing[:5]}")
+        return None
+
+    log("info", f"Consolidating {n_members}x{n_leadtimes} callback files into {filename}")
+    odim_io.write_ensemble_virtual_file(PD, part_files, record_output(filename))
+    return None
+
+
+@metrics.timed("write_callback")
 def write_odim_output_separately(f, n_timestep, n_field, metadata, store_meta, fc_type=False):
     """    Write single dataset per ODIM HDF5 file.
 
@@ -697,7 +1607,7 @@ def write_odim_output_separately(f, n_timestep, n_field, metadata, store_meta, f
 
     # Create /dataset1/data1 group and store dataset and attributes
     data_grp=dset_grp.create_group("data1")
-    data_grp.create_dataset("data",data=n_field)
+    odim_io.store_field(data_grp, n_field, store_meta, PD)
 
     # Store attributes in /dataset1/data1/what (offset, gain, nodata, undetect etc)
     utils.store_odim_data_what_attrs(data_grp, metadata, store_meta)
@@ -712,14 +1622,26 @@ def write_odim_output_separately(f, n_timestep, n_field, metadata, store_meta, f
 
     #Store ensemble forecast specific metadata
     if fc_type == "ens":
-        how_grp.attrs["ensemble_size"] = PD["nowcast_options"]["n_ens_members"]
+        how_grp.attrs["ensemble_size"] = odim_io.get_ensemble_size(PD)
         how_grp.attrs["seed"] = PD["nowcast_options"]["seed"]
+        odim_io.store_lagged_how_attrs(how_grp, PD)
+    odim_io.store_schedule_how_attrs(how_grp, PD)
+    odim_io.store_fingerprint_how_attrs(how_grp, PD)
     
 
 def process_callback_output(forecast):
     """
     Copied everything except pysteps call from generate function.
     """
+    forecast, meta = convert_callback_output(forecast)
+    forecast, store_meta = prepare_data_for_writing(forecast)
+    return forecast, meta, store_meta
+
+
+def convert_callback_output(forecast):
+    """Convert callback output to output quantity and threshold it.
+    Returns data in physical units, see process_callback_output.
+    """
 
     # Get metadata from PD_callback global dictionary
     metadata = PD_callback['obs_metadata']
@@ -739,6 +1661,21 @@ def process_callback_output(forecast):
     elif utils.quantity_is_rate(out_qty) and metadata["unit"] == "dBZ":
         forecast, meta = dbz_to_rrate(forecast, meta)
             # Might need to convert the norain value and threshold, too                        
+    _set_output_thresholds(out_qty)
+
+    rain_threshold = PD["out_rain_threshold"]
+    norain_for_output = PD["out_norain_value"]
+    
+    forecast, meta = thresholding(forecast, meta, threshold=rain_threshold,
+                                  norain_value=norain_for_output, fill_nan=False)
+
+    if meta is None:
+        meta = dict()
+    return forecast, meta
+
+
+def _set_output_thresholds(out_qty):
+    """Store rain threshold and norain value in output quantity units to PD"""
     if "out_rain_threshold" not in PD:
         _rain_threshold = PD["data_options"].get("rain_threshold")
         PD["out_rain_threshold"] = _convert_for_output(_rain_threshold, out_qty)
@@ -751,18 +1688,6 @@ def process_callback_output(forecast):
         else:
             PD["out_norain_value"] = _norain
 
-    rain_threshold = PD["out_rain_threshold"]
-    norain_for_output = PD["out_norain_value"]
-    
-    forecast, meta = thresholding(forecast, meta, threshold=rain_threshold,
-                                  norain_value=norain_for_output, fill_nan=False)
-
-    forecast, store_meta = prepare_data_for_writing(forecast)
-    
-    if meta is None:
-        meta = dict()
-    return forecast, meta, store_meta
-
 
 def write_to_file(startdate, gen_output, nc_fname, metadata=None):
     """Write output to a HDF5 file.
@@ -795,7 +1720,7 @@ def write_to_file(startdate, gen_output, nc_fname, metadata=None):
     ensemble_forecast, ens_scale_meta = prepare_data_for_writing(ensemble_forecast)
     deterministic, det_scale_meta = prepare_data_for_writing(deterministic)
 
-    with h5py.File(output_options["path"].joinpath(nc_fname), 'w') as outf:
+    with h5py.File(record_output(output_options["path"].joinpath(nc_fname)), 'w') as outf:
         if ensemble_forecast is not None and output_options["store_ensemble"]:
             for eidx in range(PD["ensemble_size"]):
                 ens_grp = outf.create_group("member-{:0>2}".format(eidx))
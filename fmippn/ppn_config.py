@@ -17,6 +17,7 @@ generating the file is to run following command on command line:
 
 /path/to/fmippn/source$ python -c "import ppn_config; ppn_config.dump_defaults()"
 """
+import copy
 import logging
 import json
 from pathlib import Path
@@ -27,7 +28,8 @@ def get_config(override_name=None):
     """Get configuration parameters from ppn_config.py.
 
     If override_name is given, function updates non-default values."""
-    params = defaults.copy()
+    # Deep copy, runs in the same process must not change the defaults
+    params = copy.deepcopy(defaults)
 
     if override_name is not None:
         override_params = get_params(override_name)
@@ -221,6 +223,11 @@ defaults = {
         "write_log": False,
         "log_level": logging.INFO,
         "log_folder": "/tmp",
+        "queued": False,  # format and write the log in a background thread
+        "queue_size": 10000,  # queued records, more are dropped instead of blocking
+        "json_format": False,  # JSON lines instead of text
+        "max_bytes": 0,  # rotate log file at this size, 0 = no rotation
+        "backup_count": 5,  # rotated log files kept
     },
 
     "motion_options": {
@@ -275,6 +282,7 @@ defaults = {
         "write_leadtimes_separately": False, # Store each leadtime after calculating it instead of everything at the end
         "write_asap": True,
         "use_old_format": False,  # Remove when postprocessing can use ODIM format
+        "field_encoding": "dense",  # "dense" or "sparse" (wet pixel runs only, see sparse_io.py)
     },
 
     "run_options": {
@@ -301,7 +309,178 @@ defaults = {
     # Used when writing ensemble nowcasts after each timestep with callback function
     "callback_options": {
         "tmp_folder": "tmp",  # relative to output_options.path (or absolute path)
-    }
+        # Combine callback files into one ensemble file using HDF5 virtual datasets (no data copy)
+        "consolidate_ensemble": False,
+    },
+
+    # Deterministically weighted ensemble mean and spread, calculated while nowcasting
+    # (same weighting as DETERM_INITWEIGHT/DETERM_WEIGHTSPAN in ensmean_determweighted.c)
+    "ensemble_statistics": {
+        "compute": False,
+        "determ_initweight": 100,  # percent of ensemble size, weight of deterministic at first leadtime
+        "determ_weightspan": 150,  # percent of nowcast length, <= 0 means constant weight
+        # Output is rain rate (mm/h), packed like this
+        "convert_to_dtype": "uint16",
+        "gain": 0.01,
+        "offset": 0,
+    },
+
+    # Exceedance probabilities calculated while nowcasting (see ens_prob.py)
+    "exceedance_probabilities": {
+        "compute": False,
+        "rate_thresholds": [],  # mm/h, probabilities for each leadtime
+        # Accumulation periods in PROB_THRCFG format, e.g. "30+10/5:0.5,1,2" (thresholds in mm)
+        "accumulation_periods": [],
+        "threshold_file": None,  # or read accumulation periods from a PROB_THRCFG file
+        # Accumulation periods keep a running sum per member and a snapshot per
+        # member for each open window start, so their memory grows with ensemble
+        # size (rate products do not). Runs needing more than this are refused.
+        "max_accumulation_state_mb": 2048,  # None = no limit
+    },
+
+    # Per-pixel ensemble quantiles of rain rate, calculated while nowcasting (see ens_quantiles.py)
+    "ensemble_quantiles": {
+        "compute": False,
+        "fractiles": [0.1, 0.25, 0.5, 0.75, 0.9],
+        "block_rows": 64,  # rows processed at once, bounds temporary memory use
+        # Output is rain rate (mm/h), packed like this
+        "convert_to_dtype": "uint16",
+        "gain": 0.01,
+        "offset": 0,
+    },
+    # Accumulations interpolated along motion between nowcast timesteps,
+    # written as RAVAKE accumulation files (see motion_interp.py)
+    "accumulation_interpolation": {
+        "compute": False,
+        "intsteps": 10,  # interpolation sub-steps per nowcast timestep
+        "acc_prefix": "RAVACC",
+        "area": None,  # area name in filenames, None = configuration name
+        "path": None,  # output folder, None = output_options.path
+        "include_deterministic": True,  # deterministic nowcast first, if it is run
+        "use_ensemble_motion": True,  # use regenerated perturbed motion, if available
+        "chunk_size": 262144,  # pixels processed at once, also bounds per-member trajectory tables
+    },
+    # Reprojected copies of output files for distribution (see reproject.py)
+    "reprojection": {
+        "compute": False,
+        "target_grid": None,  # reprojection_radardata cfg file, e.g. config/RAVAKE_3067.cfg
+        "method": "nearest",  # "nearest" or "bilinear"
+        "cache_dir": None,  # folder for cached index tables, None = no caching
+        "products": ["det", "ens", "ensstat", "ensquant"],  # output file tags
+        "tag_suffix": None,  # added to output tag, None = "epsg<EPSG>" or "reproj"
+        "batch_size": 16,  # fields reprojected at once, bounds memory use per file
+    },
+    # Rolling observed accumulation, updated from the observations of each run
+    # (see obs_acc.py)
+    "observed_accumulation": {
+        "compute": False,
+        "state_dir": None,  # folder for persistent state, required
+        "window_minutes": 60,
+        "output_minutes": [60],  # accumulations written, each <= window_minutes
+        "output_interval": 60,  # write when observation time is divisible by this (minutes)
+        "path": None,  # output folder, None = output_options.path
+        "filename": "{date:%Y%m%d%H%M}_obsacc{minutes:03}min_conf={config}.pgm",
+    },
+    # Windowed accumulations of the ensemble mean with nodata masking, needs
+    # ensemble_statistics (see acc_products.py)
+    "nowcast_accumulations": {
+        "compute": False,
+        "window_ends": [60, 120, 180, 240],  # minutes after analysis time
+        "window_length": 60,
+        "replace_range": [192.7, 650.0],  # accumulations (mm) replaced like replace_grey, null = off
+        "replace_value": 0.0,
+        "path": None,  # output folder, None = output_options.path
+        "filename": "{start:%Y%m%d%H%M}-{end:%Y%m%d%H%M}_acc{minutes:03}min_conf={config}.pgm",
+        # Optional radar coverage mask PGM per window (0 = covered, like the mask1h
+        # files of hourmask), e.g. "/path/mask1h_{start:%Y%m%d%H%M}-{end:%Y%m%d%H%M}.pgm".
+        # Nodata of the nowcast fields always masks the window. None = no extra mask
+        "coverage_mask_file": None,
+    },
+    # Members of the previous run appended as extra members (see lagged_ensemble.py)
+    "lagged_ensemble": {
+        "compute": False,
+        "lag_minutes": None,  # None = nowcast timestep
+        "max_members": None,  # None = n_ens_members
+        "path": None,  # previous run's ensemble file or callback folder, None = from output settings
+    },
+    # Fit the run into a wall-clock deadline using timings of recent runs (see scheduler.py)
+    "scheduling": {
+        "deadline_seconds": None,  # None = no deadline, can be given with run_ppn.py --deadline
+        "history_file": None,  # JSON lines file of run timings, None = no history
+        "history_runs": 20,  # number of recent runs used in the cost estimate
+        "reduce_order": ["members", "leadtimes"],  # what is reduced first
+        "min_members": 1,
+        "min_leadtimes": 1,
+        "safety_factor": 1.1,  # multiplier for predicted run time
+        "reserve_seconds": 0,  # time kept for writing output after the nowcast
+    },
+    # One run at a time per configuration, used by run_ppn.py (see run_lock.py)
+    "run_lock": {
+        "enabled": False,
+        "lock_dir": "/tmp",
+        "policy": "queue_latest",  # "skip", "queue_latest" or "preempt"
+        "poll_interval": 1.0,  # seconds between lock attempts while waiting
+        "max_wait": None,  # seconds, None = wait until the lock is free
+        "preempt_timeout": 30.0,  # seconds to wait for a preempted run to exit
+        "skip_exit_code": 0,  # exit code of runs that are not started
+    },
+    # CPU and thread assignment for concurrent runs on one node, used by
+    # run_ppn.py (see resources.py). Overrides nowcast_options.num_workers.
+    "resources": {
+        "enabled": False,
+        "state_dir": "/tmp",  # folder of the node-level CPU registry
+        "total_cores": None,  # None = all CPUs available to the process
+        "reserved_cores": 0,  # CPUs left out of the budget (from the start)
+        "weights": {},  # config name: weight for sharing the budget, {} = first come first served
+        "min_cores": 1,
+        "pin_cpus": True,  # set CPU affinity to the assigned CPUs
+        "blas_threads": 1,  # OpenMP/BLAS threads, more conflicts with dask workers
+    },
+    # Per-stage timing and memory metrics (see metrics.py)
+    "metrics": {
+        "enabled": False,
+        "json_file": None,  # JSON lines file, one record per run appended
+        "exposition_file": None,  # Prometheus text format file for a local scraper, replaced each run
+        "trace_allocations": False,  # tracemalloc allocated bytes per stage (slow)
+    },
+    # Trace events for chrome://tracing / Perfetto (see tracing.py)
+    "tracing": {
+        "enabled": False,  # always enabled when $FMIPPN_TRACE_FILE is set
+        "trace_file": None,  # JSON lines trace file, None = $FMIPPN_TRACE_FILE
+    },
+    # Decoded observations published in POSIX shared memory by the preprocess
+    # stage (see shm_io.py). Files are used for observations without a segment.
+    "shared_memory_input": {
+        "enabled": False,
+        "prefix": None,  # segment name prefix, None = fmippn_<config>
+    },
+    # Quantized output in POSIX shared memory for postprocessing on the same
+    # host, each leadtime as soon as it is computed (see output_arena.py).
+    # Needs an integer output_options.convert_to_dtype.
+    "shared_memory_output": {
+        "enabled": False,
+        "prefix": None,  # arena name prefix, None = fmippn_<config>_out
+        "async_archive": True,  # write the output files in a background thread
+        "max_pending_writes": 2,  # leadtimes queued for the writer before the nowcast waits
+    },
+    # Scores of past nowcasts against the newest observation, accumulated per
+    # leadtime over runs (see verification.py)
+    "verification": {
+        "compute": False,
+        "state_file": None,  # JSON file of accumulated scores, required
+        "scores_file": None,  # JSON lines file, scores of each run appended, None = not written
+        "thresholds": [0.1, 1.0, 5.0],  # mm/h, for CSI, POD and FAR
+        "products": ["det", "ens"],
+        "max_leadtime": None,  # minutes, None = run_options.max_leadtime
+        "path": None,  # folder of past output files, None = output_options.path
+    },
+    # Skip reruns with the same inputs, configuration and code (see run_cache.py).
+    # Needs a fixed nowcast_options.seed. run_ppn.py --force runs anyway.
+    "run_cache": {
+        "enabled": False,
+        "cache_dir": None,  # index folder, None = <output_options.path>/.run_cache
+        "hash_inputs": "stat",  # "stat" (size and modification time) or "content"
+    },
 }
 
 # Test cases
@@ -1,8 +1,25 @@
-"""Logging functions for FMI-PPN"""
+"""Logging functions for FMI-PPN
 
+With `queued=True`, log records are put in a queue on the calling thread
+and a background thread (logging.handlers.QueueListener) formats them and
+writes the file. The queue is bounded: if the writer cannot keep up, records
+are dropped instead of blocking the nowcast, and the number of dropped
+records is logged when the queue is stopped. The queue is flushed at exit.
+While logging is configured, unhandled exceptions are logged before that.
+"""
+
+import atexit
+import datetime as dt
+import json
 import logging
+import logging.handlers
+import queue
+import sys
 
 _logger = None
+_listener = None
+_handlers = []
+_original_excepthook = None
 
 _logger_severity = {
     'critical': logging.CRITICAL,
@@ -12,24 +29,119 @@ _logger_severity = {
     'warning': logging.WARNING,
 }
 
-def config_logging(fname, level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S"):
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines"""
+    def format(self, record):
+        entry = {
+            "time": dt.datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: records are dropped when the queue is full"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _file_handler(fname, max_bytes, backup_count):
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(fname, maxBytes=max_bytes,
+                                                    backupCount=backup_count)
+    return logging.FileHandler(fname)
+
+
+def config_logging(fname, level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", queued=False,
+                   json_format=False, max_bytes=0, backup_count=5, queue_size=10000):
     """Setup logger object using logging.basicConfig.
 
     Input:
         fname -- name of the log file (str)
+        queued -- write the log in a background thread (default=False)
+        json_format -- write JSON lines instead of text (default=False)
+        max_bytes -- rotate the log file at this size, 0 = no rotation (default=0)
+        backup_count -- number of rotated files kept (default=5)
+        queue_size -- maximum number of queued records (default=10000)
 
     `level` and `datefmt` arguments correspond to logging.basicConfig arguments.
+    Calling this again replaces the handlers of the previous call.
     """
-    global _logger
-    formatter = logging.Formatter(
-        fmt="%(asctime)s (%(name)s) %(levelname)s: %(message)s",
-        datefmt=datefmt
-    )
-    handler = logging.FileHandler(fname)
+    global _logger, _listener, _original_excepthook
+    stop_logging()
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            fmt="%(asctime)s (%(name)s) %(levelname)s: %(message)s",
+            datefmt=datefmt
+        )
+    handler = _file_handler(fname, max_bytes, backup_count)
     handler.setFormatter(formatter)
     _logger = logging.getLogger("FMIPPN")
-    _logger.addHandler(handler)
+    if queued:
+        queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        _listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+        _listener.start()
+        _handlers.extend([queue_handler, handler])
+        _logger.addHandler(queue_handler)
+    else:
+        _handlers.append(handler)
+        _logger.addHandler(handler)
     _logger.setLevel(level)
+    _original_excepthook = sys.excepthook
+    sys.excepthook = _log_unhandled_exception
+
+
+def stop_logging():
+    """Flush queued records and close log handlers"""
+    global _listener, _original_excepthook
+    if _original_excepthook is not None:
+        if sys.excepthook is _log_unhandled_exception:
+            sys.excepthook = _original_excepthook
+        _original_excepthook = None
+    if _logger is None:
+        return
+    for handler in _handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            _logger.removeHandler(handler)
+            if handler.dropped:
+                # Written directly, the queue is being stopped
+                record = _logger.makeRecord(_logger.name, logging.WARNING, __file__, 0,
+                                            f"Log queue was full, dropped {handler.dropped} records",
+                                            None, None)
+                handler.queue.put(record)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for handler in _handlers:
+        _logger.removeHandler(handler)
+        handler.close()
+    _handlers.clear()
+
+
+def _log_unhandled_exception(exc_type, exc_value, exc_traceback):
+    if _logger is not None and _handlers and not issubclass(exc_type, KeyboardInterrupt):
+        _logger.critical("Unhandled exception", exc_info=(exc_type, exc_value, exc_traceback))
+    (_original_excepthook or sys.__excepthook__)(exc_type, exc_value, exc_traceback)
+
+
+atexit.register(stop_logging)
+
 
 def write_to_log(level, msg, *args, **kwargs):
     """Write `msg` at logging level `level` to log.
@@ -0,0 +1,388 @@
+"""Lazy reader for FMI-PPN output files.
+
+All three output layouts written by PPN can be opened behind one interface:
+
+    old format      -- single file with member-XX/leadtime-XX and
+                       deterministic/leadtime-XX datasets (ppn.write_to_file)
+    ODIM            -- single file with /datasetN/dataM groups
+                       (odim_io.write_ensemble_to_file and friends)
+    callback output -- folder with one ODIM file per member and leadtime
+                       (ppn.cb_nowcast)
+
+Example:
+
+    with ppn_reader.open_output("/output/202004161300_radar.fmippn.ens_conf=ravake.h5") as out:
+        # Nothing is read yet
+        ens = out.ensemble                 # shape (member, leadtime, y, x)
+        block = ens[:, 0:3, 100:200, 50:80]  # reads only these slices
+        dbz = out.ensemble_decoded[:, -1]  # physical units, nodata as NaN
+
+Fields are fetched only when the array is sliced. Contiguous uncompressed
+datasets are read through numpy.memmap, other datasets through h5py hyperslab
+selections. Gain, offset, nodata and undetect are applied only when decoded
+values are requested.
+"""
+import os
+import re
+import datetime as dt
+from pathlib import Path
+
+import numpy as np
+import h5py
+
+import utils
+import sparse_io
+
+# Filenames written by ppn.cb_nowcast() and ppn.write_deterministic_separate_odim_output()
+CALLBACK_FNAME_PATTERN = re.compile(
+    r"^(?P<startdate>\d{12})_(?P<validtime>\d{12})_nclen=(?P<leadtime>\d+)min_"
+    r"radar\.fmippn\.(?P<fc_type>ens|det)_conf=(?P<config>.*?)(?:_ensmem=(?P<member>\d+))?\.h5$"
+)
+
+
+class FieldRef:
+    """Reference to a single 2D field in a HDF5 file.
+
+    Attributes `gain`, `offset`, `nodata` and `undetect` are the scaling
+    metadata stored alongside the field.
+    """
+    def __init__(self, fname, path, attrs):
+        self.fname = str(fname)
+        self.path = path
+        self.gain = attrs.get("gain", 1.0)
+        self.offset = attrs.get("offset", 0.0)
+        self.nodata = attrs.get("nodata")
+        self.undetect = attrs.get("undetect")
+
+    def decode(self, raw, undetect_value=None):
+        """Convert stored values to physical units.
+
+        Nodata pixels are set to NaN. Undetect pixels are set to
+        `undetect_value`, or unpacked like other pixels if it is None.
+        """
+        gain = 1.0 if self.gain is None else self.gain
+        offset = 0.0 if self.offset is None else self.offset
+        data = utils.unpack_value(np.asarray(raw, dtype=np.float64), gain, offset)
+        if self.nodata is not None:
+            data[raw == self.nodata] = np.nan
+        if undetect_value is not None and self.undetect is not None:
+            data[raw == self.undetect] = undetect_value
+        return data
+
+
+class _FieldSource:
+    """Open file handles and memory maps shared by the arrays of one output"""
+    def __init__(self, use_mmap=True):
+        self.use_mmap = use_mmap
+        self._files = dict()
+        self._fields = dict()
+
+    def _file(self, fname):
+        if fname not in self._files:
+            self._files[fname] = h5py.File(fname, "r")
+        return self._files[fname]
+
+    def _resolve(self, ref):
+        """Return an object supporting 2D slicing for the field `ref`"""
+        key = (ref.fname, ref.path)
+        if key in self._fields:
+            return self._fields[key]
+
+        grp_path = ref.path.rsplit("/", 1)[0]
+        f = self._file(ref.fname)
+        if grp_path in f and sparse_io.is_sparse(f[grp_path]):
+            field = sparse_io.SparseField(f[grp_path])
+        else:
+            field = f[ref.path]
+            if self.use_mmap:
+                field = self._try_mmap(ref.fname, field)
+        self._fields[key] = field
+        return field
+
+    def _try_mmap(self, fname, dset):
+        """Return numpy.memmap for contiguous uncompressed datasets, else the h5py dataset.
+
+        Virtual datasets (see odim_io.write_ensemble_virtual_file) are
+        followed to their source dataset when they map one whole dataset.
+        """
+        if dset.is_virtual:
+            sources = dset.virtual_sources()
+            if len(sources) != 1:
+                return dset
+            src_fname = sources[0].file_name
+            if not os.path.isabs(src_fname):
+                src_fname = os.path.join(os.path.dirname(os.path.abspath(fname)), src_fname)
+            src_dset = self._file(src_fname)[sources[0].dset_name]
+            if src_dset.shape != dset.shape:
+                return dset
+            return self._try_mmap(src_fname, src_dset)
+
+        if dset.chunks is not None or dset.compression is not None or dset.dtype.kind not in "uif":
+            return dset
+        offset = dset.id.get_offset()
+        if offset is None:
+            # Storage is not allocated (empty dataset)
+            return dset
+        return np.memmap(fname, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+
+    def read(self, ref, key):
+        return np.asarray(self._resolve(ref)[key])
+
+    def close(self):
+        self._fields.clear()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+class LazyArray:
+    """Lazily evaluated array of 2D fields.
+
+    The leading dimensions (e.g. member, leadtime) index FieldRef objects,
+    the last two dimensions are the field (y, x). Slicing reads only the
+    selected fields and only the selected part of each field.
+    """
+    def __init__(self, refs, field_shape, dtype, source, decode=False, undetect_value=None):
+        self._refs = refs
+        self._source = source
+        self._decode = decode
+        self._undetect_value = undetect_value
+        self.shape = refs.shape + tuple(field_shape)
+        self.dtype = np.dtype(np.float64) if decode else np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def decoded(self, undetect_value=None):
+        """Return a view of this array that returns values in physical units"""
+        return LazyArray(self._refs, self.shape[-2:], self.dtype, self._source,
+                         decode=True, undetect_value=undetect_value)
+
+    def _split_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        nlead = self._refs.ndim
+        return key[:nlead], key[nlead:]
+
+    def __getitem__(self, key):
+        lead_key, field_key = self._split_key(key)
+        selected = self._refs[lead_key]
+        if not isinstance(selected, np.ndarray):
+            return self._read_one(selected, field_key)
+
+        fields = [self._read_one(ref, field_key) for ref in selected.ravel()]
+        if not fields:
+            sub_shape = np.empty(self.shape[-2:], dtype=bool)[field_key].shape
+            return np.empty(selected.shape + sub_shape, dtype=self.dtype)
+        return np.stack(fields).reshape(selected.shape + fields[0].shape)
+
+    def _read_one(self, ref, field_key):
+        raw = self._source.read(ref, field_key)
+        if self._decode:
+            return ref.decode(raw, undetect_value=self._undetect_value)
+        return np.array(raw, copy=True)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
+class PPNOutput:
+    """Handle to one PPN output (a file or a callback output folder).
+
+    Attributes:
+        ensemble -- LazyArray (member, leadtime, y, x) of stored values, or None
+        deterministic -- LazyArray (leadtime, y, x) of stored values, or None
+        valid_times -- list of datetime objects, one for each leadtime
+        layout -- "old", "odim" or "callback"
+    """
+    def __init__(self, layout, ens_refs, det_refs, valid_times, field_shape, dtype, use_mmap=True):
+        self.layout = layout
+        self.valid_times = valid_times
+        self._source = _FieldSource(use_mmap=use_mmap)
+        self.ensemble = None
+        self.deterministic = None
+        if ens_refs is not None:
+            self.ensemble = LazyArray(ens_refs, field_shape, dtype, self._source)
+        if det_refs is not None:
+            self.deterministic = LazyArray(det_refs, field_shape, dtype, self._source)
+
+    @property
+    def ensemble_decoded(self):
+        return None if self.ensemble is None else self.ensemble.decoded()
+
+    @property
+    def deterministic_decoded(self):
+        return None if self.deterministic is None else self.deterministic.decoded()
+
+    def close(self):
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _ref_array(nested):
+    """Build an object array of FieldRefs from a list or a list of lists"""
+    if isinstance(nested[0], list):
+        shape = (len(nested), len(nested[0]))
+    else:
+        shape = (len(nested),)
+    arr = np.empty(shape, dtype=object)
+    for idx in np.ndindex(shape):
+        item = nested
+        for i in idx:
+            item = item[i]
+        arr[idx] = item
+    return arr
+
+
+def _odim_valid_time(dset_grp):
+    what = dset_grp["what"].attrs
+    return dt.datetime.strptime(f"{int(what['enddate']):08d}{int(what['endtime']):06d}",
+                                "%Y%m%d%H%M%S")
+
+
+def _odim_field_info(f, grp_path):
+    """Return (data path, what attributes, field shape, dtype) of ODIM data group"""
+    grp = f[grp_path]
+    attrs = dict(grp["what"].attrs) if "what" in grp else dict()
+    if sparse_io.is_sparse(grp):
+        shape = tuple(int(n) for n in grp.attrs["shape"])
+        dtype = grp["values"].dtype
+    else:
+        shape, dtype = grp["data"].shape, grp["data"].dtype
+    return f"{grp_path}/data", attrs, shape, dtype
+
+
+def _dataset_index(name):
+    return int(re.sub(r"\D", "", name))
+
+
+def _open_old_format(fname, f):
+    """Old format, see ppn.write_to_file()"""
+    def _series(grp):
+        names = sorted((n for n in grp if n.startswith("leadtime-")), key=_dataset_index)
+        return [FieldRef(fname, f"{grp.name}/{n}", dict(grp[n].attrs)) for n in names]
+
+    members = sorted((n for n in f if n.startswith("member-")), key=_dataset_index)
+    ens = [_series(f[m]) for m in members]
+    ens = [s for s in ens if s] or None
+    det = _series(f["deterministic"]) if "deterministic" in f else None
+
+    series = ens[0] if ens else det
+    dset = f[series[0].path]
+    valid_times = []
+    for ref in series:
+        stamp = str(int(f[ref.path].attrs["Valid for"]))
+        valid_times.append(dt.datetime.strptime(stamp, "%Y%m%d%H%M%S"))
+    return ("old", None if ens is None else _ref_array(ens), None if det is None else _ref_array(det),
+            valid_times, dset.shape, dset.dtype)
+
+
+def _open_odim(fname, f):
+    """Single file ODIM output, see odim_io._write()"""
+    dsets = sorted((n for n in f if n.startswith("dataset")), key=_dataset_index)
+    if not dsets:
+        raise ValueError(f"No datasets found in {fname}")
+    is_ensemble = "how" in f and "ensemble_size" in f["how"].attrs
+
+    rows = []
+    for dset in dsets:
+        datas = sorted((n for n in f[dset] if n.startswith("data")), key=_dataset_index)
+        row = []
+        for data in datas:
+            path, attrs, shape, dtype = _odim_field_info(f, f"/{dset}/{data}")
+            row.append(FieldRef(fname, path, attrs))
+        rows.append(row)
+    valid_times = [_odim_valid_time(f[dset]) for dset in dsets]
+
+    if is_ensemble:
+        # File is organised by leadtime, reader returns (member, leadtime)
+        n_members = len(rows[0])
+        ens = [[rows[lt][m] for lt in range(len(rows))] for m in range(n_members)]
+        return "odim", _ref_array(ens), None, valid_times, shape, dtype
+    det = [row[0] for row in rows]
+    return "odim", None, _ref_array(det), valid_times, shape, dtype
+
+
+def _open_callback_folder(folder, startdate=None, config=None):
+    """Callback output folder, see ppn.cb_nowcast()"""
+    found = []
+    for entry in os.scandir(folder):
+        match = CALLBACK_FNAME_PATTERN.match(entry.name)
+        if match is None:
+            continue
+        if startdate is not None and match["startdate"] != f"{startdate:%Y%m%d%H%M}":
+            continue
+        if config is not None and match["config"] != str(config):
+            continue
+        found.append((match, entry.path))
+    if not found:
+        raise ValueError(f"No callback output files found in {folder}")
+
+    runs = {(m["startdate"], m["config"]) for m, _ in found}
+    if len(runs) > 1:
+        raise ValueError(f"Folder {folder} contains output from several runs {sorted(runs)}, "
+                         f"select one with 'startdate' and 'config' arguments")
+
+    leadtimes = sorted({int(m["leadtime"]) for m, _ in found})
+    lt_index = {lt: i for i, lt in enumerate(leadtimes)}
+    members = sorted({int(m["member"]) for m, _ in found if m["fc_type"] == "ens"})
+    m_index = {mem: i for i, mem in enumerate(members)}
+
+    ens = [[None] * len(leadtimes) for _ in members]
+    det = [None] * len(leadtimes)
+    valid_times = [None] * len(leadtimes)
+    shape = dtype = None
+    for match, fname in found:
+        lt = lt_index[int(match["leadtime"])]
+        valid_times[lt] = dt.datetime.strptime(match["validtime"], "%Y%m%d%H%M")
+        with h5py.File(fname, "r") as f:
+            path, attrs, shape, dtype = _odim_field_info(f, "/dataset1/data1")
+        ref = FieldRef(fname, path, attrs)
+        if match["fc_type"] == "ens":
+            ens[m_index[int(match["member"])]][lt] = ref
+        else:
+            det[lt] = ref
+
+    if any(ref is None for row in ens for ref in row):
+        raise ValueError(f"Incomplete ensemble callback output in {folder}")
+    ens = _ref_array(ens) if members else None
+    det = _ref_array(det) if all(ref is not None for ref in det) else None
+    return "callback", ens, det, valid_times, shape, dtype
+
+
+def open_output(path, startdate=None, config=None, use_mmap=True):
+    """Open PPN output for lazy reading.
+
+    Input:
+        path -- output HDF5 file, or callback output folder (tmp_folder)
+        startdate -- select run from a callback folder (datetime, optional)
+        config -- select config name from a callback folder (str, optional)
+        use_mmap -- use numpy.memmap for contiguous uncompressed datasets (default=True)
+
+    Output:
+        PPNOutput object
+    """
+    path = Path(path)
+    if path.is_dir():
+        info = _open_callback_folder(path, startdate=startdate, config=config)
+    else:
+        with h5py.File(path, "r") as f:
+            if any(name.startswith("member-") for name in f) or "deterministic" in f:
+                info = _open_old_format(str(path), f)
+            else:
+                info = _open_odim(str(path), f)
+    return PPNOutput(*info, use_mmap=use_mmap)
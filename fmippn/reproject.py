@@ -0,0 +1,235 @@
+"""Reprojection of PPN output fields with a cached index table.
+
+postprocess/bin/reprojection_radardata maps every output pixel to a source
+pixel with PROJ each time it is run. The mapping only depends on the source
+and target grids, so here it is calculated once per grid pair and stored in
+a cache folder as .npy files, which are memory-mapped on later runs:
+
+    reproj_<key>_index.npy  -- int64 (k, ny*nx), flat source pixel indices,
+                               -1 for target pixels outside the source grid
+    reproj_<key>_weight.npy -- float32 (k, ny*nx), interpolation weights
+
+k is 1 for nearest neighbour and 4 for bilinear interpolation. Applying the
+table to fields of shape (..., y, x) is a single indexed gather, so whole
+ensembles are reprojected without any coordinate transforms.
+
+Grids are described with dictionaries like the `projection` metadata of
+ppn.run():
+
+    projstr -- PROJ definition
+    x1, y1, x2, y2 -- grid corner coordinates in projection units
+    xsize, ysize -- grid dimensions in pixels
+    origin -- "upper" if the first row is the northernmost (default)
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+METHODS = {"nearest": 1, "bilinear": 4}
+
+
+def grid_from_projection_meta(projection_meta, shape):
+    """Return grid dictionary from ppn.run() projection metadata and field shape (y, x)"""
+    return {
+        "projstr": projection_meta["projstr"],
+        "x1": float(projection_meta["x1"]),
+        "y1": float(projection_meta["y1"]),
+        "x2": float(projection_meta["x2"]),
+        "y2": float(projection_meta["y2"]),
+        "xsize": int(shape[1]),
+        "ysize": int(shape[0]),
+        "origin": projection_meta.get("origin", "upper"),
+    }
+
+
+def read_grid_cfg(fname):
+    """Read target grid from a reprojection_radardata configuration file
+    (e.g. config/RAVAKE_3067.cfg, keys outproj, outSW/NE lon/lat, outX/Ydim)."""
+    import pyproj
+
+    cfg = dict()
+    with open(fname, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            cfg[key.strip()] = value.strip().strip("'")
+
+    proj = pyproj.Proj(cfg["outproj"])
+    x1, y1 = proj(float(cfg["outSWlon"]), float(cfg["outSWlat"]))
+    x2, y2 = proj(float(cfg["outNElon"]), float(cfg["outNElat"]))
+    grid = {
+        "projstr": cfg["outproj"],
+        "x1": x1, "y1": y1, "x2": x2, "y2": y2,
+        "xsize": int(cfg["outXdim"]),
+        "ysize": int(cfg["outYdim"]),
+        "origin": "upper",
+    }
+    if "EPSG" in cfg:
+        grid["epsg"] = int(cfg["EPSG"])
+    return grid
+
+
+def _pixel_centres(grid):
+    """Return projected x and y coordinates of pixel centres, shape (ysize, xsize)"""
+    xres = (grid["x2"] - grid["x1"]) / grid["xsize"]
+    yres = (grid["y2"] - grid["y1"]) / grid["ysize"]
+    x = grid["x1"] + (np.arange(grid["xsize"]) + 0.5) * xres
+    y = grid["y1"] + (np.arange(grid["ysize"]) + 0.5) * yres
+    if grid.get("origin", "upper") == "upper":
+        y = y[::-1]
+    return np.meshgrid(x, y)
+
+
+def _fractional_pixel(grid, x, y):
+    """Return fractional column and row of projected coordinates in `grid`,
+    pixel centres being at integer values."""
+    xres = (grid["x2"] - grid["x1"]) / grid["xsize"]
+    yres = (grid["y2"] - grid["y1"]) / grid["ysize"]
+    col = (x - grid["x1"]) / xres - 0.5
+    row = (y - grid["y1"]) / yres - 0.5
+    if grid.get("origin", "upper") == "upper":
+        row = grid["ysize"] - 1 - row
+    return col, row
+
+
+def compute_index(source_grid, target_grid, method="nearest"):
+    """Calculate reprojection table.
+
+    Output:
+        tuple (index, weight), see module docstring
+    """
+    import pyproj
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown reprojection method '{method}'. Valid options are {list(METHODS)}")
+    transformer = pyproj.Transformer.from_crs(pyproj.CRS(target_grid["projstr"]),
+                                              pyproj.CRS(source_grid["projstr"]),
+                                              always_xy=True)
+    tx, ty = _pixel_centres(target_grid)
+    sx, sy = transformer.transform(tx.ravel(), ty.ravel())
+    col, row = _fractional_pixel(source_grid, np.asarray(sx), np.asarray(sy))
+    xsize, ysize = source_grid["xsize"], source_grid["ysize"]
+
+    if method == "nearest":
+        icol = np.floor(col + 0.5).astype(np.int64)
+        irow = np.floor(row + 0.5).astype(np.int64)
+        inside = (icol >= 0) & (icol < xsize) & (irow >= 0) & (irow < ysize)
+        index = np.where(inside, irow * xsize + icol, -1)[np.newaxis]
+        weight = np.ones(index.shape, dtype=np.float32)
+        return index, weight
+
+    col0 = np.floor(col).astype(np.int64)
+    row0 = np.floor(row).astype(np.int64)
+    fx = (col - col0).astype(np.float32)
+    fy = (row - row0).astype(np.float32)
+    inside = (col0 >= 0) & (col0 < xsize - 1) & (row0 >= 0) & (row0 < ysize - 1)
+    base = row0 * xsize + col0
+    index = np.stack((base, base + 1, base + xsize, base + xsize + 1))
+    weight = np.stack(((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy))
+    index[:, ~inside] = -1
+    weight[:, ~inside] = 0.0
+    return index, weight.astype(np.float32)
+
+
+def _cache_key(source_grid, target_grid, method):
+    description = json.dumps([source_grid, target_grid, method], sort_keys=True, default=str)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:16]
+
+
+class Reprojector:
+    """Reprojection table for one (source grid, target grid, method).
+
+    Usage:
+        rep = Reprojector.cached(source_grid, target_grid, cache_dir="/var/tmp/LUT")
+        out = rep.apply(fields, nodata=65535)  # fields: (..., y, x)
+    """
+    def __init__(self, index, weight, source_grid, target_grid, method="nearest"):
+        self.index = index
+        self.weight = weight
+        self.source_grid = source_grid
+        self.target_grid = target_grid
+        self.method = method
+        self.shape = (target_grid["ysize"], target_grid["xsize"])
+
+    @classmethod
+    def cached(cls, source_grid, target_grid, method="nearest", cache_dir=None):
+        """Load table from `cache_dir`, or calculate and store it there.
+        Without `cache_dir` the table is always calculated."""
+        if cache_dir is None:
+            index, weight = compute_index(source_grid, target_grid, method)
+            return cls(index, weight, source_grid, target_grid, method)
+
+        cache_dir = Path(cache_dir)
+        key = _cache_key(source_grid, target_grid, method)
+        index_fname = cache_dir.joinpath(f"reproj_{key}_index.npy")
+        weight_fname = cache_dir.joinpath(f"reproj_{key}_weight.npy")
+        if not (index_fname.exists() and weight_fname.exists()):
+            index, weight = compute_index(source_grid, target_grid, method)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write under temporary names first, concurrent runs may read the cache
+            for fname, array in ((index_fname, index), (weight_fname, weight)):
+                tmp_fname = fname.with_name(f"{fname.stem}.{os.getpid()}.tmp.npy")
+                np.save(tmp_fname, array)
+                os.replace(tmp_fname, fname)
+        index = np.load(index_fname, mmap_mode="r")
+        weight = np.load(weight_fname, mmap_mode="r")
+        return cls(index, weight, source_grid, target_grid, method)
+
+    def apply(self, fields, nodata=np.nan):
+        """Reproject fields of shape (..., y, x) of the source grid.
+
+        Nearest neighbour keeps the data type, so packed fields can be
+        reprojected as such. Bilinear interpolation returns float32, and
+        target pixels are `nodata` if any of their source pixels is `nodata`.
+        """
+        fields = np.asarray(fields)
+        lead_shape = fields.shape[:-2]
+        flat = fields.reshape(lead_shape + (-1,))
+        index = np.asarray(self.index)
+        outside = index[0] < 0
+        safe_index = np.where(index < 0, 0, index)
+
+        if self.method == "nearest":
+            out = flat[..., safe_index[0]]
+            out[..., outside] = nodata
+            return out.reshape(lead_shape + self.shape)
+
+        weight = np.asarray(self.weight)
+        gathered = flat[..., safe_index].astype(np.float32)  # (..., k, pixels)
+        if np.isnan(nodata):
+            invalid = np.isnan(gathered).any(axis=-2)
+        else:
+            invalid = (gathered == nodata).any(axis=-2)
+        out = np.einsum("...kp,kp->...p", gathered, weight)
+        out[..., invalid | outside] = nodata
+        return out.reshape(lead_shape + self.shape)
+
+    def where_attrs(self):
+        """ODIM /where attributes of the target grid"""
+        import pyproj
+
+        grid = self.target_grid
+        proj = pyproj.Proj(grid["projstr"])
+        corners = {
+            "LL": (grid["x1"], grid["y1"]),
+            "UL": (grid["x1"], grid["y2"]),
+            "UR": (grid["x2"], grid["y2"]),
+            "LR": (grid["x2"], grid["y1"]),
+        }
+        attrs = {
+            "projdef": grid["projstr"],
+            "xsize": grid["xsize"],
+            "ysize": grid["ysize"],
+            "xscale": (grid["x2"] - grid["x1"]) / grid["xsize"],
+            "yscale": (grid["y2"] - grid["y1"]) / grid["ysize"],
+        }
+        for name, (x, y) in corners.items():
+            lon, lat = proj(x, y, inverse=True)
+            attrs[f"{name}_lon"] = lon
+            attrs[f"{name}_lat"] = lat
+        return attrs
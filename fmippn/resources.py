@@ -0,0 +1,150 @@
+"""CPU partitioning between concurrent FMI-PPN runs on one node.
+
+Each run registers in a node-level registry file the CPUs it uses. A new run
+gets its CPUs from the node budget (CPUs available to the process, minus
+reserved ones) that are not used by other live runs. When weights are given
+per configuration, a run gets at most its weighted share of the budget
+among the configurations that are running.
+
+The assignment must be applied before numpy, pyfftw and pysteps are
+imported, because OpenMP and BLAS read their thread counts from the
+environment only when they are loaded. pysteps workers and FFTW threads
+both come from nowcast_options.num_workers, which is set to the number of
+assigned CPUs. OpenMP/BLAS threads are kept separate (default 1), as
+OpenMP threads conflict with the dask workers of pysteps.
+"""
+import fcntl
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+THREAD_ENV_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                        "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+
+def node_cpus(total_cores=None, reserved_cores=0):
+    """Return sorted list of CPUs in the node budget"""
+    cpus = sorted(os.sched_getaffinity(0))
+    if total_cores is not None:
+        cpus = cpus[:total_cores]
+    return cpus[reserved_cores:] if reserved_cores < len(cpus) else cpus[-1:]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CpuAllocation:
+    """CPUs assigned to one run.
+
+    Usage:
+        alloc = CpuAllocation.acquire("/tmp", "ravake", wanted=15)
+        alloc.apply(blas_threads=1)
+        import ppn  # heavy imports only after apply()
+        ...
+        alloc.release()
+        print(alloc.utilization())
+    """
+    def __init__(self, registry_fname, name, cpus):
+        self.registry_fname = registry_fname
+        self.name = name
+        self.cpus = cpus
+        self._start_wall = time.monotonic()
+        self._start_cpu = self._cpu_seconds()
+
+    @staticmethod
+    def _cpu_seconds():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+    @classmethod
+    def acquire(cls, state_dir, name, wanted, weights=None, min_cores=1, total_cores=None,
+                reserved_cores=0):
+        """Assign CPUs for run of configuration `name`.
+
+        Input:
+            state_dir -- folder of the node-level registry file
+            name -- configuration name
+            wanted -- number of CPUs the run would use (num_workers)
+            weights -- optional dictionary of configuration name: weight
+            min_cores -- CPUs given even when the budget is used up (shared
+                         with the least loaded runs)
+            total_cores, reserved_cores -- node budget, see node_cpus()
+        """
+        budget = node_cpus(total_cores, reserved_cores)
+        registry_fname = Path(state_dir).joinpath("fmippn_cpus.json")
+        registry_fname.parent.mkdir(parents=True, exist_ok=True)
+        with open(registry_fname, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                runs = json.load(f)
+            except ValueError:
+                runs = dict()
+            runs = {pid: run for pid, run in runs.items() if _pid_alive(int(pid))}
+
+            n_cpus = min(wanted, len(budget))
+            if weights:
+                names = {run["name"] for run in runs.values()} | {name}
+                total_weight = sum(weights.get(other, 1.0) for other in names)
+                share = int(len(budget) * weights.get(name, 1.0) / total_weight)
+                n_cpus = min(n_cpus, share)
+            n_cpus = max(n_cpus, min_cores)
+
+            load = {cpu: 0 for cpu in budget}
+            for run in runs.values():
+                for cpu in run["cpus"]:
+                    if cpu in load:
+                        load[cpu] += 1
+            # Free CPUs first, then the least loaded
+            cpus = sorted(sorted(budget, key=lambda cpu: load[cpu])[:n_cpus])
+
+            runs[str(os.getpid())] = {"name": name, "cpus": cpus, "started": time.time()}
+            f.seek(0)
+            f.truncate()
+            json.dump(runs, f)
+        return cls(registry_fname, name, cpus)
+
+    def apply(self, blas_threads=1, pin=True):
+        """Pin process to assigned CPUs and set thread counts of OpenMP/BLAS.
+        Must be called before numpy and pysteps are imported."""
+        if pin:
+            os.sched_setaffinity(0, self.cpus)
+        for variable in THREAD_ENV_VARIABLES:
+            os.environ[variable] = str(blas_threads)
+        os.environ["PYFFTW_NUM_THREADS"] = str(len(self.cpus))
+
+    def release(self):
+        """Remove run from the registry"""
+        with open(self.registry_fname, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                runs = json.load(f)
+            except ValueError:
+                runs = dict()
+            runs.pop(str(os.getpid()), None)
+            f.seek(0)
+            f.truncate()
+            json.dump(runs, f)
+
+    def utilization(self):
+        """Return dictionary of wall time, CPU time and utilization of the
+        assigned CPUs since acquire()"""
+        wall = time.monotonic() - self._start_wall
+        cpu = self._cpu_seconds() - self._start_cpu
+        return {
+            "cpus": len(self.cpus),
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "utilization": cpu / (wall * len(self.cpus)) if wall > 0 else 0.0,
+        }
@@ -0,0 +1,119 @@
+"""Content-addressed cache of nowcast runs.
+
+With a fixed nowcast_options.seed, a nowcast is determined by its input
+composites, the effective configuration and the code. `fingerprint()`
+hashes these, and RunCache stores an index file per fingerprint listing the
+output files of the run, as recorded by the writers of the run (see
+ppn.record_output). A rerun of the same slot (cron retry, manual rerun,
+duplicate trigger) with the same fingerprint finds its outputs in the index
+and is skipped, if the files are still there and unchanged in size.
+
+The fingerprint is also stored in the /how group of the ODIM outputs
+(attribute `run_fingerprint`), so an output file can be traced to the
+inputs and configuration that produced it.
+"""
+import hashlib
+import json
+import os
+import platform
+from pathlib import Path
+
+FMIPPN_DIR = Path(__file__).resolve().parent
+
+# Configuration keys which do not change the nowcast
+OPERATIONAL_KEYS = ("logging", "metrics", "tracing", "run_lock", "resources", "run_cache",
+                    "scheduling", "schedule_info", "run_fingerprint", "verification",
+                    "shared_memory_input", "shared_memory_output")
+
+_code_version = None
+
+
+def code_version():
+    """Hash of the FMI-PPN source files and library versions"""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for fname in sorted(FMIPPN_DIR.glob("*.py")):
+            digest.update(fname.name.encode())
+            digest.update(fname.read_bytes())
+        import numpy
+        import pysteps
+        digest.update(f"{platform.python_version()} {numpy.__version__} "
+                      f"{pysteps.__version__}".encode())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def _file_digest(fname, hash_inputs):
+    if hash_inputs == "content":
+        digest = hashlib.sha256()
+        with open(fname, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    stat = os.stat(fname)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def fingerprint(input_files, configuration, config_name, startdate, hash_inputs="stat"):
+    """Return fingerprint (hex string) of a run.
+
+    Input:
+        input_files -- list of input file names
+        configuration -- effective configuration (ppn.PD after get_config)
+        config_name -- name of the configuration, it is part of output names
+        startdate -- nowcast initialization time (datetime)
+        hash_inputs -- "stat" (size and modification time) or "content" (default="stat")
+    """
+    effective = {key: value for key, value in configuration.items()
+                 if key not in OPERATIONAL_KEYS}
+    # Same result with any number of workers
+    effective["nowcast_options"] = {key: value for key, value in effective["nowcast_options"].items()
+                                    if key != "num_workers"}
+    document = {
+        "code": code_version(),
+        "config_name": config_name,
+        "startdate": f"{startdate:%Y%m%d%H%M}",
+        "config": effective,
+        "inputs": [(str(fname), None if fname is None else _file_digest(fname, hash_inputs))
+                   for fname in input_files],
+    }
+    # str() for paths and other values that are not JSON types
+    text = json.dumps(document, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RunCache:
+    """Index of runs by fingerprint, one JSON file per fingerprint in `cache_dir`"""
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir).expanduser()
+
+    def _index_fname(self, run_fingerprint):
+        return self.cache_dir.joinpath(f"{run_fingerprint}.json")
+
+    def lookup(self, run_fingerprint):
+        """Return index entry of the run if all its output files exist unchanged, else None"""
+        try:
+            with open(self._index_fname(run_fingerprint), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for fname, size in entry["outputs"].items():
+            try:
+                if os.path.getsize(fname) != size:
+                    return None
+            except OSError:
+                return None
+        return entry if entry["outputs"] else None
+
+    def record(self, run_fingerprint, output_files, **info):
+        """Store output files of a run"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = dict(info, fingerprint=run_fingerprint,
+                     outputs={str(fname): os.path.getsize(fname) for fname in output_files})
+        fname = self._index_fname(run_fingerprint)
+        tmp_fname = fname.with_name(f".{fname.name}.{os.getpid()}")
+        with open(tmp_fname, "w") as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp_fname, fname)
+        return entry
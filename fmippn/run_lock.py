@@ -0,0 +1,169 @@
+"""Per-domain run lock for FMI-PPN.
+
+Only one run per configuration (domain) is allowed at a time. The lock is
+an fcntl lock on `<lock_dir>/fmippn_<config>.lock`, so it is released by
+the operating system if the process dies. The lock file contains the pid
+and the nowcast timestamp of the run holding it.
+
+When a run is started while another run of the same domain is active, the
+policy decides what happens:
+
+    skip          -- the new run exits without nowcasting
+    queue_latest  -- the new run waits for the lock, but only the latest
+                     waiting run is kept: a newer slot arriving while one is
+                     waiting replaces it (the older waiting run exits)
+    preempt       -- the active run is terminated if its timestamp is older
+                     than the new one, and the new run takes the lock
+
+The time spent waiting for the lock is reported as queueing delay.
+"""
+import fcntl
+import json
+import os
+import signal
+import time
+from pathlib import Path
+
+POLICIES = ("skip", "queue_latest", "preempt")
+
+
+class RunLock:
+    """Lock of one domain.
+
+    Usage:
+        lock = RunLock("/var/lock/fmippn", "ravake")
+        if lock.acquire("202101011200", policy="queue_latest"):
+            try:
+                ...  # run nowcast
+            finally:
+                lock.release()
+        print(lock.queue_delay)
+    """
+    def __init__(self, lock_dir, name, poll_interval=1.0, max_wait=None, preempt_timeout=30.0):
+        self.lock_dir = Path(lock_dir)
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.lock_fname = self.lock_dir.joinpath(f"fmippn_{name}.lock")
+        self.pending_fname = self.lock_dir.joinpath(f"fmippn_{name}.pending")
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.preempt_timeout = preempt_timeout
+        self.queue_delay = None
+        self.reason = None
+        self._file = None
+
+    def _try_lock(self, timestamp):
+        """Try to take the lock without blocking"""
+        f = open(self.lock_fname, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        json.dump({"pid": os.getpid(), "timestamp": timestamp, "locked_at": time.time()}, f)
+        f.flush()
+        self._file = f
+        return True
+
+    def holder(self):
+        """Return dictionary with pid and timestamp of the active run, None if
+        the lock file is empty or unreadable"""
+        try:
+            with open(self.lock_fname, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _set_pending(self, timestamp):
+        """Register as the latest waiting run. Return False if a newer run is
+        already waiting."""
+        try:
+            with open(self.pending_fname, "r") as f:
+                if json.load(f).get("timestamp", "") > timestamp:
+                    return False
+        except (OSError, ValueError):
+            pass
+        tmp_fname = self.pending_fname.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_fname, "w") as f:
+            json.dump({"pid": os.getpid(), "timestamp": timestamp}, f)
+        os.replace(tmp_fname, self.pending_fname)
+        return True
+
+    def _is_pending(self):
+        """True if this process is still the latest waiting run"""
+        try:
+            with open(self.pending_fname, "r") as f:
+                return json.load(f).get("pid") == os.getpid()
+        except (OSError, ValueError):
+            return False
+
+    def _clear_pending(self):
+        if self._is_pending():
+            try:
+                self.pending_fname.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _wait(self, timestamp, start, still_wanted):
+        """Poll the lock until it is free, `still_wanted()` turns False or
+        max_wait is exceeded"""
+        while still_wanted():
+            if self._try_lock(timestamp):
+                return True
+            if self.max_wait is not None and time.monotonic() - start > self.max_wait:
+                self.reason = f"waited over {self.max_wait} s"
+                return False
+            time.sleep(self.poll_interval)
+        return False
+
+    def acquire(self, timestamp, policy="queue_latest"):
+        """Take the lock for the run of `timestamp` (YYYYMMDDHHMM).
+
+        Output:
+            True if the run can start. If False, `reason` tells why.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown run lock policy '{policy}'. Valid options are {POLICIES}")
+        start = time.monotonic()
+        acquired = self._try_lock(timestamp)
+
+        if not acquired and policy == "skip":
+            holder = self.holder() or dict()
+            self.reason = f"run {holder.get('timestamp')} (pid {holder.get('pid')}) is active"
+        elif not acquired and policy == "queue_latest":
+            if self._set_pending(timestamp):
+                acquired = self._wait(timestamp, start, self._is_pending)
+            if not acquired and self.reason is None:
+                self.reason = "a newer run is waiting"
+            self._clear_pending()
+        elif not acquired and policy == "preempt":
+            holder = self.holder() or dict()
+            if holder.get("timestamp") is not None and holder["timestamp"] >= timestamp:
+                self.reason = f"run {holder['timestamp']} (pid {holder.get('pid')}) is not older"
+            else:
+                self._terminate(holder.get("pid"))
+                deadline = time.monotonic() + self.preempt_timeout
+                acquired = self._wait(timestamp, start, lambda: time.monotonic() < deadline)
+                if not acquired and self.reason is None:
+                    self.reason = f"run (pid {holder.get('pid')}) did not exit in {self.preempt_timeout} s"
+
+        self.queue_delay = time.monotonic() - start
+        return acquired
+
+    @staticmethod
+    def _terminate(pid):
+        if pid is None or pid == os.getpid():
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def release(self):
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
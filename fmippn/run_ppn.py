@@ -10,8 +10,26 @@ Author: Petteri Karsisto
 Year: 2019
 """
 import argparse
+import concurrent.futures
+import datetime as dt
+import os
+import signal
+import sys
+import time
+import traceback
 
-import ppn
+# numpy, pysteps etc. are imported in run() after CPU assignment, see resources.py
+import ppn_config
+import resources
+import run_lock
+
+# Features whose state is carried from one run to the next. With any of them
+# enabled, batch runs are made one at a time in time order.
+SEQUENTIAL_FEATURES = (
+    ("verification", "compute"),
+    ("observed_accumulation", "compute"),
+    ("lagged_ensemble", "compute"),
+)
 
 
 def get_input_arguments():
@@ -24,17 +42,179 @@ def get_input_arguments():
     parser.add_argument("-c", "--config", help="Select configuration settings")
     parser.add_argument("-t", "--timestamp", help="Nowcast initialization time",
                         metavar="YYYYMMDDHHMM")
+    parser.add_argument("-d", "--deadline", type=float, metavar="SECONDS",
+                        help="Wall-clock time available for the run, reduce ensemble size "
+                             "and leadtimes if needed")
+    parser.add_argument("--lock-policy", dest="lock_policy", choices=run_lock.POLICIES,
+                        help="What to do if a run of the same configuration is active "
+                             "(overrides run_lock.policy)")
+    parser.add_argument("--force", action="store_true",
+                        help="Run even if the run cache has outputs of an identical run")
+    batch = parser.add_argument_group("batch mode", "Run nowcasts for a time range in one process "
+                                                    "(without run lock and CPU registry)")
+    batch.add_argument("--start", metavar="YYYYMMDDHHMM", help="First nowcast initialization time")
+    batch.add_argument("--end", metavar="YYYYMMDDHHMM", help="Last nowcast initialization time")
+    batch.add_argument("--step", type=int, default=5, metavar="MINUTES",
+                       help="Minutes between nowcasts (default=5)")
+    batch.add_argument("--processes", type=int, default=1,
+                       help="Run consecutive blocks of the time range in this many processes. "
+                            "Ignored (one process) if verification, observed_accumulation "
+                            "or lagged_ensemble is enabled, they need the runs in time order")
+
+    args = parser.parse_args()
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end must be given together")
+    if args.start is not None and args.timestamp is not None:
+        parser.error("--timestamp cannot be used with --start and --end")
+    return vars(args)
+
+
+def batch_timestamps(start, end, step):
+    """Return nowcast initialization times from `start` to `end` (inclusive)"""
+    first = dt.datetime.strptime(start, "%Y%m%d%H%M")
+    last = dt.datetime.strptime(end, "%Y%m%d%H%M")
+    if last < first or step <= 0:
+        raise ValueError(f"Invalid time range {start}-{end} with step {step} min")
+    count = int((last - first) / dt.timedelta(minutes=step)) + 1
+    return [f"{first + i * dt.timedelta(minutes=step):%Y%m%d%H%M}" for i in range(count)]
+
+
+def sequential_features(configuration):
+    """Return names of enabled features that need batch runs in time order"""
+    return [group for group, key in SEQUENTIAL_FEATURES
+            if configuration.get(group, dict()).get(key, False)]
+
+
+def run_timestamps(config, timestamps, deadline=None, num_workers=None, force=False):
+    """Run nowcasts for `timestamps` in this process. Input composites are
+    decoded once and reused by the following runs (obs_window.py).
 
-    return vars(parser.parse_args())
+    Output:
+        list of (timestamp, error message or None)
+    """
+    import ppn
+    import obs_window
+    capacity = ppn_config.get_config(config)["run_options"]["num_prev_observations"] + 1
+    window = obs_window.ObservationWindow(capacity)
+    results = []
+    for timestamp in timestamps:
+        try:
+            ppn.run(timestamp=timestamp, config=config, deadline=deadline,
+                    num_workers=num_workers, observation_window=window, force=force)
+            results.append((timestamp, None))
+        except Exception:  # pylint: disable=broad-except
+            # One missing composite must not stop the whole range
+            results.append((timestamp, traceback.format_exc(limit=3)))
+            print(f"Run {timestamp} of config {config} failed:\n{results[-1][1]}", file=sys.stderr)
+            # Files of the failed run may be partly decoded, start over
+            window.clear()
+    return results
+
+
+def run_batch(args):
+    """Run nowcasts from args["start"] to args["end"], optionally in a process pool.
+    Each process runs a consecutive block of timestamps so that the observation
+    window is reused. Return number of failed runs."""
+    timestamps = batch_timestamps(args["start"], args["end"], args["step"])
+    processes = max(1, min(args["processes"], len(timestamps)))
+    sequential = sequential_features(ppn_config.get_config(args["config"]))
+    if processes > 1 and sequential:
+        print(f"Running the batch in one process instead of {processes}: "
+              f"{', '.join(sequential)} need the runs in time order")
+        processes = 1
+    start = time.monotonic()
+    if processes == 1:
+        results = run_timestamps(args["config"], timestamps, deadline=args["deadline"],
+                                 force=args["force"])
+    else:
+        # Share the CPUs between the processes
+        num_workers = max(1, (os.cpu_count() or 1) // processes)
+        block = -(-len(timestamps) // processes)
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(run_timestamps, args["config"], timestamps[i:i + block],
+                                   args["deadline"], num_workers, args["force"])
+                       for i in range(0, len(timestamps), block)]
+            for future in futures:
+                results.extend(future.result())
+
+    failed = [timestamp for timestamp, error in results if error is not None]
+    elapsed = time.monotonic() - start
+    print(f"Batch {args['start']}-{args['end']} of config {args['config']}: "
+          f"{len(results) - len(failed)}/{len(results)} runs in {elapsed:.1f} s "
+          f"({elapsed / len(results):.1f} s per run, {processes} processes)")
+    if failed:
+        print(f"Failed runs: {' '.join(failed)}")
+    return len(failed)
+
+
+def run(args, queue_delay=None):
+    """Assign CPUs and threads for the run and call ppn.run()"""
+    resource_options = ppn_config.get_config(args["config"])["resources"]
+    if not resource_options["enabled"]:
+        import ppn
+        ppn.run(queue_delay=queue_delay, **args)
+        return
+
+    wanted = ppn_config.get_config(args["config"])["nowcast_options"]["num_workers"]
+    allocation = resources.CpuAllocation.acquire(resource_options["state_dir"], args["config"],
+                                                 wanted,
+                                                 weights=resource_options["weights"],
+                                                 min_cores=resource_options["min_cores"],
+                                                 total_cores=resource_options["total_cores"],
+                                                 reserved_cores=resource_options["reserved_cores"])
+    allocation.apply(blas_threads=resource_options["blas_threads"],
+                     pin=resource_options["pin_cpus"])
+    print(f"Config {args['config']} assigned {len(allocation.cpus)} CPUs {allocation.cpus}, "
+          f"OpenMP/BLAS threads {resource_options['blas_threads']}")
+    try:
+        import ppn
+        ppn.run(queue_delay=queue_delay, num_workers=len(allocation.cpus), **args)
+    finally:
+        allocation.release()
+        usage = allocation.utilization()
+        print(f"Config {args['config']} used {usage['cpu_seconds']:.1f} CPU seconds in "
+              f"{usage['wall_seconds']:.1f} s on {usage['cpus']} CPUs, "
+              f"utilization {100 * usage['utilization']:.0f} %")
 
 
 def main():
     """Pass commandline arguments to ppn.run() method."""
     # Read command line arguments
     args = get_input_arguments()
-    # Unpack dictionary into keyword arguments
-    # Unused arguments should be ignored silently.
-    ppn.run(**args)
+    if args["start"] is not None:
+        sys.exit(1 if run_batch(args) else 0)
+    for key in ("start", "end", "step", "processes"):
+        args.pop(key)
+    lock_options = ppn_config.get_config(args["config"])["run_lock"]
+    lock_policy = args.pop("lock_policy") or lock_options["policy"]
+    if not lock_options["enabled"]:
+        # Unpack dictionary into keyword arguments
+        # Unused arguments should be ignored silently.
+        run(args)
+        return
+
+    if args["timestamp"] is None:
+        # Fix the slot now, a queued run must not move to a later slot
+        # (same as utils.utcnow_floored, utils imports numpy)
+        now = dt.datetime.utcnow()
+        args["timestamp"] = f"{now.replace(minute=now.minute - now.minute % 5):%Y%m%d%H%M}"
+    lock = run_lock.RunLock(lock_options["lock_dir"], args["config"],
+                            poll_interval=lock_options["poll_interval"],
+                            max_wait=lock_options["max_wait"],
+                            preempt_timeout=lock_options["preempt_timeout"])
+    if not lock.acquire(args["timestamp"], policy=lock_policy):
+        print(f"Run {args['timestamp']} of config {args['config']} not started "
+              f"({lock_policy}): {lock.reason}. Waited {lock.queue_delay:.1f} s.")
+        sys.exit(lock_options["skip_exit_code"])
+    print(f"Run {args['timestamp']} of config {args['config']} started, "
+          f"queueing delay {lock.queue_delay:.1f} s")
+    # Preempted by a newer run: exit through SystemExit so that the lock is released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        run(args, queue_delay=lock.queue_delay)
+    finally:
+        lock.release()
 
 
 if __name__ == "__main__":
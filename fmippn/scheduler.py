@@ -0,0 +1,156 @@
+"""Deadline-aware sizing of FMI-PPN runs.
+
+Run time is modelled from the timings of recent runs as
+
+    total = setup + cost_per_field * n_members * n_leadtimes
+
+where `setup` covers everything except the ensemble nowcast (input,
+motion, deterministic nowcast, writing) and `cost_per_field` is the time
+of one member for one leadtime. Both are medians over the recent runs of
+the same configuration, read from a JSON lines history file.
+
+Before the run, `plan()` reduces the number of members and then the number
+of leadtimes (or in the configured order) until the predicted time fits in
+the deadline. During a callback run, `Deadline.check()` tells if the next
+leadtime would still finish in time, so the nowcast can be cut short.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+class DeadlineReached(Exception):
+    """Raised from the nowcast callback to stop computing further leadtimes"""
+
+
+def read_history(fname, config=None, max_runs=20):
+    """Return the latest `max_runs` timing records of `config` from history file"""
+    if fname is None or not Path(fname).exists():
+        return []
+    records = []
+    with open(fname, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if config is None or record.get("config") == config:
+                records.append(record)
+    return records[-max_runs:]
+
+
+def append_history(fname, record):
+    """Append timing record to history file"""
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+class CostModel:
+    """Run time model estimated from history records, see module docstring"""
+    def __init__(self, setup_seconds, field_seconds):
+        self.setup_seconds = setup_seconds
+        self.field_seconds = field_seconds
+
+    @classmethod
+    def from_history(cls, records):
+        """Estimate model from records, None if there are no usable records"""
+        usable = [r for r in records if r.get("n_members") and r.get("n_leadtimes")
+                  and r.get("nowcast_seconds") is not None and r.get("total_seconds") is not None]
+        if not usable:
+            return None
+        field_seconds = np.median([r["nowcast_seconds"] / (r["n_members"] * r["n_leadtimes"])
+                                   for r in usable])
+        setup_seconds = np.median([r["total_seconds"] - r["nowcast_seconds"] for r in usable])
+        return cls(float(max(setup_seconds, 0.0)), float(field_seconds))
+
+    def predict(self, n_members, n_leadtimes):
+        return self.setup_seconds + self.field_seconds * n_members * n_leadtimes
+
+
+def plan(model, deadline_seconds, n_members, n_leadtimes, min_members=1, min_leadtimes=1,
+         order=("members", "leadtimes"), safety_factor=1.1):
+    """Choose ensemble size and number of leadtimes that fit in the deadline.
+
+    Input:
+        model -- CostModel, or None when there is no history (no degradation)
+        deadline_seconds -- time available for the whole run
+        n_members, n_leadtimes -- requested size
+        min_members, min_leadtimes -- lower limits for degradation
+        order -- which dimension is reduced first
+        safety_factor -- multiplier for predicted times
+
+    Output:
+        dictionary with keys n_members, n_leadtimes, predicted_seconds and
+        degraded (bool)
+    """
+    result = {"n_members": n_members, "n_leadtimes": n_leadtimes,
+              "predicted_seconds": None, "degraded": False}
+    if model is None:
+        return result
+    budget = deadline_seconds / safety_factor
+
+    def _fits(members, leadtimes):
+        return model.predict(members, leadtimes) <= budget
+
+    members, leadtimes = n_members, n_leadtimes
+    for dimension in order:
+        if _fits(members, leadtimes):
+            break
+        available = (budget - model.setup_seconds) / max(model.field_seconds, 1e-9)
+        if dimension == "members":
+            members = int(np.clip(available // leadtimes, min_members, members))
+        elif dimension == "leadtimes":
+            leadtimes = int(np.clip(available // members, min_leadtimes, leadtimes))
+        else:
+            raise ValueError(f"Unknown dimension '{dimension}' in scheduling order")
+
+    result["n_members"] = members
+    result["n_leadtimes"] = leadtimes
+    result["predicted_seconds"] = model.predict(members, leadtimes)
+    result["degraded"] = (members, leadtimes) != (n_members, n_leadtimes)
+    return result
+
+
+class Deadline:
+    """Wall-clock deadline of a run.
+
+    `check()` is called after each leadtime of a callback run. It returns
+    False when the next leadtime, at the pace measured so far, would end
+    after the deadline.
+    """
+    def __init__(self, deadline_seconds, start=None):
+        self.start = time.monotonic() if start is None else start
+        self.deadline = self.start + deadline_seconds
+        self._first_step = None
+        self._steps = 0
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def check(self, reserve_seconds=0.0):
+        now = time.monotonic()
+        if self._first_step is None:
+            # Time to the first leadtime includes the nowcast setup
+            self._first_step = now
+            self._steps = 0
+            return now + reserve_seconds < self.deadline
+        self._steps += 1
+        step_seconds = (now - self._first_step) / self._steps
+        return now + step_seconds + reserve_seconds < self.deadline
+
+
+def history_record(config, startdate, n_members, n_leadtimes, nowcast_seconds, total_seconds):
+    """Return timing record for the history file"""
+    return {
+        "config": config,
+        "startdate": f"{startdate:%Y%m%d%H%M}",
+        "n_members": n_members,
+        "n_leadtimes": n_leadtimes,
+        "nowcast_seconds": round(nowcast_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "pid": os.getpid(),
+    }
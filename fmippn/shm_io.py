@@ -0,0 +1,282 @@
+"""Decoded observations in POSIX shared memory for FMI-PPN.
+
+A producer (e.g. the preprocess stage of run_fmippn_common.sh) decodes each
+composite once and publishes the field and its importer metadata into a
+named shared memory segment (/dev/shm/<prefix>_<YYYYMMDDHHMM>).
+read_observations() in ppn.py maps the segments of the input timestamps
+directly instead of decoding the files again. Composites without a segment
+are decoded from the files as before.
+
+Segment layout:
+    bytes 0-7    -- magic b"FMIPPNS1"
+    bytes 8-15   -- ready flag (uint64), set to 1 after the data is written
+    bytes 16-23  -- header length (uint64)
+    header       -- JSON: shape, dtype, data offset and importer metadata
+    data         -- field, C order, 64 byte aligned
+
+Segments stay until they are removed with `cleanup` (or `unlink`), they are
+not removed when the producer or a reader exits.
+
+Command line (run from fmippn source folder):
+    $ python shm_io.py publish --config ravake --timestamp 202301011200
+    $ python shm_io.py list --prefix fmippn_ravake
+    $ python shm_io.py cleanup --prefix fmippn_ravake --older-than 120
+"""
+import _posixshmem
+import argparse
+import datetime as dt
+import json
+import os
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+MAGIC = b"FMIPPNS1"
+_PREFIX_BYTES = 24
+_ALIGN = 64
+SHM_DIR = "/dev/shm"
+
+
+def default_prefix(config):
+    return f"fmippn_{config}"
+
+
+def segment_name(prefix, timestamp):
+    return f"{prefix}_{timestamp:%Y%m%d%H%M}"
+
+
+def open_segment(name, create=False, size=0):
+    """Open segment without registering it to the resource tracker, which
+    would remove it when this process exits"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")  # pylint: disable=protected-access
+    return shm
+
+
+def json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def publish(name, field, metadata):
+    """Publish `field` (2D array) and `metadata` (importer metadata dictionary)
+    as segment `name`. An existing segment with the same name is replaced."""
+    if isinstance(field, np.ma.MaskedArray):
+        field = field.filled(np.nan)
+    field = np.ascontiguousarray(field)
+    header = {"shape": list(field.shape), "dtype": field.dtype.str, "metadata": metadata}
+    header_bytes = json.dumps(header, default=json_value).encode()
+    # Data offset depends on the header length, reserve space for the number
+    data_offset = -(-(_PREFIX_BYTES + len(header_bytes) + 32) // _ALIGN) * _ALIGN
+    header["data_offset"] = data_offset
+    header_bytes = json.dumps(header, default=json_value).encode()
+
+    unlink(name)
+    shm = open_segment(name, create=True, size=data_offset + field.nbytes)
+    try:
+        shm.buf[:8] = MAGIC
+        struct.pack_into("<QQ", shm.buf, 8, 0, len(header_bytes))
+        shm.buf[_PREFIX_BYTES:_PREFIX_BYTES + len(header_bytes)] = header_bytes
+        target = np.ndarray(field.shape, dtype=field.dtype, buffer=shm.buf, offset=data_offset)
+        target[...] = field
+        del target
+        struct.pack_into("<Q", shm.buf, 8, 1)
+    finally:
+        shm.close()
+    return name
+
+
+class SharedField:
+    """Field attached from a segment. `data` is a read-only view of the
+    shared memory, valid until close()."""
+    def __init__(self, shm, header):
+        self._shm = shm
+        self.name = shm.name
+        self.metadata = header["metadata"]
+        self.data = np.ndarray(tuple(header["shape"]), dtype=np.dtype(header["dtype"]),
+                               buffer=shm.buf, offset=header["data_offset"])
+        self.data.flags.writeable = False
+
+    def close(self):
+        self.data = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(name):
+    """Return SharedField of segment `name`, or None if the segment does not
+    exist or is not completely written"""
+    try:
+        shm = open_segment(name)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        ready, header_length = struct.unpack_from("<QQ", shm.buf, 8)
+        if bytes(shm.buf[:8]) != MAGIC or ready != 1:
+            shm.close()
+            return None
+        header = json.loads(bytes(shm.buf[_PREFIX_BYTES:_PREFIX_BYTES + header_length]))
+    except (struct.error, ValueError):
+        shm.close()
+        return None
+    return SharedField(shm, header)
+
+
+def unlink(name):
+    """Remove segment `name` if it exists. Attached readers keep their mapping."""
+    try:
+        shm = open_segment(name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    if sys.version_info >= (3, 13):
+        shm.unlink()
+    else:
+        # SharedMemory.unlink() would also unregister the untracked segment
+        _posixshmem.shm_unlink(shm._name)  # pylint: disable=protected-access
+    return True
+
+
+def list_segments(prefix):
+    """Return {timestamp: segment name} of the segments with `prefix`"""
+    segments = dict()
+    try:
+        names = os.listdir(SHM_DIR)
+    except OSError:
+        return segments
+    for name in names:
+        if not name.startswith(prefix + "_"):
+            continue
+        try:
+            segments[dt.datetime.strptime(name[len(prefix) + 1:], "%Y%m%d%H%M")] = name
+        except ValueError:
+            continue
+    return segments
+
+
+def cleanup(prefix, older_than_minutes, now=None):
+    """Remove segments of observations older than `older_than_minutes`"""
+    now = now or dt.datetime.utcnow()
+    removed = []
+    for timestamp, name in list_segments(prefix).items():
+        if now - timestamp > dt.timedelta(minutes=older_than_minutes):
+            unlink(name)
+            removed.append(name)
+    return removed
+
+
+class SharedMemoryReader:
+    """Read observations from segments, like pysteps.io.readers.read_timeseries.
+
+    Input:
+        prefix -- segment name prefix
+        fallback -- obs_window.ObservationWindow for composites without a
+                    segment, None = decode them with the importer (default=None)
+    """
+    def __init__(self, prefix, fallback=None):
+        self.prefix = prefix
+        self.fallback = fallback
+        self.attached = 0
+        self.decoded = 0
+
+    def read_timeseries(self, inputfns, importer, **importer_kwargs):
+        fnames, timestamps = inputfns
+        segments = []
+        fields = []
+        metadata = None
+        try:
+            for fname, timestamp in zip(fnames, timestamps):
+                segment = attach(segment_name(self.prefix, timestamp))
+                if segment is not None:
+                    segments.append(segment)
+                    field, field_metadata = segment.data, segment.metadata
+                    self.attached += 1
+                elif fname is None:
+                    fields.append(None)
+                    continue
+                elif self.fallback is not None:
+                    field, field_metadata = self.fallback.read_file(fname, importer, importer_kwargs)
+                    self.decoded += 1
+                else:
+                    field, _, field_metadata = importer(fname, **importer_kwargs)
+                    self.decoded += 1
+                fields.append(field)
+                if metadata is None:
+                    metadata = dict(field_metadata)
+            if metadata is None:
+                return None, None, None
+            shape = next(field.shape for field in fields if field is not None)
+            # One copy out of the shared memory, the caller modifies the observations
+            observations = np.stack([np.full(shape, np.nan) if field is None else field
+                                     for field in fields])
+        finally:
+            # Views must be released before the segments are closed
+            fields.clear()
+            field = None
+            for segment in segments:
+                segment.close()
+        metadata["timestamps"] = np.array(timestamps)
+        return observations, None, metadata
+
+
+def _publish_from_config(config, timestamp, prefix):
+    """Decode the composite of `timestamp` with the importer of `config` and publish it"""
+    import pysteps
+    import ppn_config
+    import pgm_io
+
+    datasource = ppn_config.get_config(config)["data_source"]
+    fnames, _ = pysteps.io.find_by_date(timestamp, datasource["root_path"], datasource["path_fmt"],
+                                        datasource["fn_pattern"], datasource["fn_ext"],
+                                        datasource["timestep"], num_prev_files=0)
+    if datasource["importer"] in pgm_io.IMPORTERS:
+        importer = pgm_io.get_importer(datasource["importer"])
+    else:
+        importer = pysteps.io.get_method(datasource["importer"], "importer")
+    field, _, metadata = importer(fnames[-1], **datasource["importer_kwargs"])
+    return publish(segment_name(prefix, timestamp), field, metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FMI-PPN observations in shared memory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    publish_parser = subparsers.add_parser("publish", help="Decode a composite and publish it")
+    publish_parser.add_argument("--config", required=True)
+    publish_parser.add_argument("--timestamp", required=True, metavar="YYYYMMDDHHMM")
+    publish_parser.add_argument("--prefix", help="Segment name prefix, default fmippn_<config>")
+    list_parser = subparsers.add_parser("list", help="List published observations")
+    list_parser.add_argument("--prefix", required=True)
+    cleanup_parser = subparsers.add_parser("cleanup", help="Remove old segments")
+    cleanup_parser.add_argument("--prefix", required=True)
+    cleanup_parser.add_argument("--older-than", type=float, default=120, metavar="MINUTES")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        timestamp = dt.datetime.strptime(args.timestamp, "%Y%m%d%H%M")
+        name = _publish_from_config(args.config, timestamp,
+                                    args.prefix or default_prefix(args.config))
+        print(f"Published {name}")
+    elif args.command == "list":
+        for timestamp, name in sorted(list_segments(args.prefix).items()):
+            print(name)
+    elif args.command == "cleanup":
+        removed = cleanup(args.prefix, args.older_than)
+        print(f"Removed {len(removed)} segments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Sparse rain-mask encoding for PPN output fields.
+
+Most output pixels are dry, i.e. equal to the undetect value set in
+thresholding. Instead of a dense array, a sparse field is stored as runs of
+wet pixels in the flattened (row-major) field:
+
+    run_start  -- flat index of the first pixel of each wet run (uint32)
+    run_length -- number of pixels in each run (uint32)
+    values     -- values of all wet pixels, in flat order (original dtype)
+
+Group attributes `encoding`, `shape` and `fill_value` are needed for decoding.
+All other pixels are `fill_value`.
+"""
+import numpy as np
+
+ENCODING = "sparse_rle"
+
+
+def _wet_mask(flat, fill_value):
+    """Return boolean mask of pixels that differ from `fill_value`"""
+    if np.asarray(fill_value).dtype.kind == "f" and np.isnan(fill_value):
+        return ~np.isnan(flat)
+    return flat != fill_value
+
+
+def encode(field, fill_value):
+    """Encode 2D field into run-length coded wet pixels.
+
+    Input:
+        field -- 2D numpy array
+        fill_value -- value of the dry pixels (usually undetect)
+
+    Output:
+        tuple (run_start, run_length, values)
+    """
+    flat = np.ascontiguousarray(field).ravel()
+    wet = _wet_mask(flat, fill_value)
+    # Rising and falling edges of the wet mask give the runs
+    edges = np.diff(wet.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+    run_start = np.flatnonzero(edges == 1)
+    run_end = np.flatnonzero(edges == -1)
+    run_length = run_end - run_start
+    values = flat[wet]
+    return run_start.astype(np.uint32), run_length.astype(np.uint32), values
+
+
+def decode(run_start, run_length, values, shape, fill_value, dtype=None):
+    """Decode run-length coded wet pixels into a dense 2D array"""
+    dtype = values.dtype if dtype is None else dtype
+    out = np.full(int(np.prod(shape)), fill_value, dtype=dtype)
+    out[_run_indices(run_start, run_length)] = values
+    return out.reshape(shape)
+
+
+def _run_indices(run_start, run_length):
+    """Flat pixel indices covered by the runs"""
+    run_start = run_start.astype(np.int64)
+    run_length = run_length.astype(np.int64)
+    total = int(run_length.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    # Offset of each run's first value in the values array
+    value_offset = np.cumsum(run_length) - run_length
+    return np.arange(total, dtype=np.int64) + np.repeat(run_start - value_offset, run_length)
+
+
+def store_sparse_field(data_grp, field, fill_value):
+    """Store field into HDF5 group using sparse encoding.
+
+    Input:
+        data_grp -- HDF5 group object (e.g. /dataset1/data1)
+        field -- 2D numpy array
+        fill_value -- value of the dry pixels (usually undetect)
+    """
+    run_start, run_length, values = encode(field, fill_value)
+    data_grp.create_dataset("run_start", data=run_start)
+    data_grp.create_dataset("run_length", data=run_length)
+    data_grp.create_dataset("values", data=values)
+    data_grp.attrs["encoding"] = ENCODING
+    data_grp.attrs["shape"] = field.shape
+    data_grp.attrs["fill_value"] = np.asarray(fill_value, dtype=field.dtype)
+
+
+def is_sparse(data_grp):
+    """Return True if HDF5 group contains a sparse encoded field"""
+    encoding = data_grp.attrs.get("encoding", b"")
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    return encoding == ENCODING
+
+
+class SparseField:
+    """Lazily decoded sparse field.
+
+    Nothing is decoded when the object is created. Run tables are read from
+    file the first time they are needed and only the requested rows are
+    reconstructed when the field is sliced:
+
+        field = SparseField(f["/dataset1/data1"])
+        block = field[100:200, 50:80]
+        dense = np.asarray(field)
+
+    The HDF5 file must stay open until the run tables have been loaded.
+    """
+    def __init__(self, data_grp):
+        self._grp = data_grp
+        self.shape = tuple(int(n) for n in data_grp.attrs["shape"])
+        self.dtype = data_grp["values"].dtype
+        self.fill_value = data_grp.attrs["fill_value"]
+        self.ndim = 2
+        self._runs = None
+
+    def _load(self):
+        if self._runs is None:
+            run_start = self._grp["run_start"][...].astype(np.int64)
+            run_length = self._grp["run_length"][...].astype(np.int64)
+            values = self._grp["values"][...]
+            self._runs = (run_start, run_length, np.cumsum(run_length) - run_length, values)
+        return self._runs
+
+    def _decode_rows(self, row_start, row_stop):
+        """Decode full rows [row_start, row_stop) into a dense array"""
+        ncols = self.shape[1]
+        lo, hi = row_start * ncols, row_stop * ncols
+        out = np.full(hi - lo, self.fill_value, dtype=self.dtype)
+        run_start, run_length, value_offset, values = self._load()
+
+        # Runs overlapping the flat range [lo, hi)
+        first = np.searchsorted(run_start + run_length, lo, side="right")
+        last = np.searchsorted(run_start, hi, side="left")
+        if last > first:
+            starts = run_start[first:last]
+            ends = starts + run_length[first:last]
+            # Clip runs to the requested range
+            clip_starts = np.maximum(starts, lo)
+            lengths = np.minimum(ends, hi) - clip_starts
+            src_base = value_offset[first:last] + (clip_starts - starts)
+            dst_base = clip_starts - lo
+            # Position of each pixel within its run
+            within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            out[np.repeat(dst_base, lengths) + within] = values[np.repeat(src_base, lengths) + within]
+        return out.reshape(row_stop - row_start, ncols)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows = key[0]
+        if isinstance(rows, (int, np.integer)):
+            row = rows % self.shape[0]
+            return self._decode_rows(row, row + 1)[(0,) + key[1:]]
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step == 1:
+                block = self._decode_rows(start, max(stop, start))
+                return block[(slice(None),) + key[1:]]
+        # Fancy row indexing, decode everything
+        return self.__array__()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self._decode_rows(0, self.shape[0])
+        if dtype is not None:
+            dense = dense.astype(dtype)
+        return dense
+
+
+def read_field(data_grp, lazy=False):
+    """Read a dense or sparse field from an ODIM data group.
+
+    Input:
+        data_grp -- HDF5 group object (e.g. /dataset1/data1)
+        lazy -- if True, return an object that decodes on slicing instead of
+                a numpy array (default=False)
+    """
+    if is_sparse(data_grp):
+        field = SparseField(data_grp)
+        return field if lazy else np.asarray(field)
+    if lazy:
+        return data_grp["data"]
+    return data_grp["data"][...]
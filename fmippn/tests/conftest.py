@@ -0,0 +1,6 @@
+"""FMI-PPN modules are run from the fmippn directory and import each other
+as top-level modules, so tests do the same."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
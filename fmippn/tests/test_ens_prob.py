@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import ens_prob
+
+
+def test_accumulation_period_from_string():
+    period = ens_prob.AccumulationPeriod.from_string("30+10/3:0.5,1,")
+    assert (period.acc_minutes, period.interval, period.n_fields) == (30, 10, 3)
+    assert period.thresholds == [0.5, 1.0]
+    assert period.windows(5) == [(0, 6), (2, 8), (4, 10)]
+    with pytest.raises(ValueError):
+        period.windows(20)
+
+
+def test_rate_probabilities():
+    rates = np.array([[[0.0, 1.0]], [[0.5, 2.0]], [[1.0, 2.0]], [[2.0, np.nan]]])
+    engine = ens_prob.ExceedanceProbabilities(4, (1, 2), 5, rate_thresholds=[0.5, 2.0])
+    products = engine.update(0, rates)
+    assert len(products) == 1
+    product = products[0]
+    assert (product["kind"], product["start"], product["end"]) == ("rate", 1, 1)
+    assert product["probabilities"].dtype == np.uint8
+    np.testing.assert_array_equal(product["probabilities"],
+                                  [[[75, ens_prob.PROB_NODATA]], [[25, ens_prob.PROB_NODATA]]])
+
+
+def test_members_one_at_a_time():
+    rng = np.random.default_rng(2)
+    rates = rng.gamma(1.0, 2.0, size=(3, 4, 5, 6)).astype(np.float32)  # (leadtime, member, y, x)
+    period = ens_prob.AccumulationPeriod.from_string("10+5/2:0.5,1")
+    at_once = ens_prob.ExceedanceProbabilities(4, (5, 6), 5, [1.0], [period])
+    streamed = ens_prob.ExceedanceProbabilities(4, (5, 6), 5, [1.0], [period])
+
+    expected, got = [], []
+    for member in range(4):
+        for leadtime in range(3):
+            got.extend(streamed.update(leadtime, rates[leadtime, member], member_index=member))
+    for leadtime in range(3):
+        expected.extend(at_once.update(leadtime, rates[leadtime]))
+
+    key = lambda product: (product["kind"], product["start"], product["end"])
+    assert sorted(map(key, got)) == sorted(map(key, expected))
+    for a, b in zip(sorted(got, key=key), sorted(expected, key=key)):
+        np.testing.assert_array_equal(a["probabilities"], b["probabilities"])
+
+
+def test_accumulation_windows():
+    n_members, timestep = 3, 5
+    rates = np.array([6.0, 12.0, 24.0], dtype=np.float32)[:, np.newaxis, np.newaxis]
+    period = ens_prob.AccumulationPeriod.from_string("10+5/2:1,3")
+    engine = ens_prob.ExceedanceProbabilities(n_members, (1, 1), timestep,
+                                              accumulation_periods=[period])
+    assert engine.accumulation_state_bytes() == 2 * n_members * 4
+
+    products = []
+    for leadtime in range(3):
+        products.extend(engine.update(leadtime, rates * (leadtime + 1)))
+    assert [(p["start"], p["end"], p["acc_minutes"]) for p in products] == [(0, 2, 10), (1, 3, 10)]
+    # Window (0, 2): 0.5 + 1.0, 1.0 + 2.0, 2.0 + 4.0 mm
+    np.testing.assert_array_equal(products[0]["probabilities"][:, 0, 0], [100, 66])
+    # Window (1, 3): 1.0 + 1.5, 2.0 + 3.0, 4.0 + 6.0 mm
+    np.testing.assert_array_equal(products[1]["probabilities"][:, 0, 0], [100, 66])
+    # State is released after the last window
+    assert engine._cumulative is None and not engine._snapshots
+
+
+def test_fewer_members_at_later_leadtimes():
+    engine = ens_prob.ExceedanceProbabilities(4, (1, 1), 5, rate_thresholds=[1.0])
+    rates = np.array([2.0, 0.0, 2.0, 2.0], dtype=np.float32)[:, np.newaxis, np.newaxis]
+    (product,) = engine.update(0, rates)
+    assert product["probabilities"][0, 0, 0] == 75
+    (product,) = engine.update(1, rates[:2], n_members=2)
+    assert product["probabilities"][0, 0, 0] == 50
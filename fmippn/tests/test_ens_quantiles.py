@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import ens_quantiles
+
+FRACTILES = [0.0, 0.05, 0.25, 0.5, 0.9, 1.0]
+
+
+@pytest.mark.parametrize("n_members", [1, 2, 11, 51])
+def test_matches_numpy_quantile(n_members):
+    rng = np.random.default_rng(n_members)
+    members = rng.gamma(0.5, 3.0, size=(n_members, 37, 23)).astype(np.float32)
+    result = ens_quantiles.ensemble_quantiles(members, FRACTILES, block_rows=8)
+    assert result.shape == (len(FRACTILES), 37, 23) and result.dtype == np.float32
+    np.testing.assert_allclose(result, np.quantile(members, FRACTILES, axis=0), rtol=1e-6)
+
+
+def test_members_are_not_reordered():
+    members = np.random.default_rng(3).random((5, 4, 4)).astype(np.float32)
+    original = members.copy()
+    ens_quantiles.ensemble_quantiles(members, [0.5])
+    np.testing.assert_array_equal(members, original)
+
+
+def test_nan_member_gives_nan():
+    members = np.ones((4, 2, 2), dtype=np.float32)
+    members[2, 0, 1] = np.nan
+    result = ens_quantiles.ensemble_quantiles(members, [0.0, 0.5, 1.0])
+    assert np.isnan(result[:, 0, 1]).all()
+    assert (result[:, [0, 1, 1], [0, 0, 1]] == 1).all()
+
+
+def test_invalid_fractile():
+    with pytest.raises(ValueError):
+        ens_quantiles.ensemble_quantiles(np.zeros((3, 2, 2)), [0.5, 1.5])
+
+
+def test_quantile_buffer():
+    members = np.random.default_rng(4).random((2, 6, 5, 4)).astype(np.float32)  # (leadtime, member, y, x)
+    buffer = ens_quantiles.QuantileBuffer(6, (5, 4), FRACTILES, block_rows=2)
+    for leadtime in range(2):
+        for member in range(5):
+            assert buffer.add(leadtime, members[leadtime, member]) is None
+        result = buffer.add(leadtime, members[leadtime, 5])
+        np.testing.assert_allclose(result, np.quantile(members[leadtime], FRACTILES, axis=0),
+                                   rtol=1e-6)
+
+    # Fewer members, and a leadtime must be complete before the next one
+    result = buffer.add(2, members[0, :3], n_members=4)
+    assert result is None
+    with pytest.raises(ValueError):
+        buffer.add(3, members[0, 3])
+    result = buffer.add(2, members[0, 3], n_members=4)
+    np.testing.assert_allclose(result, np.quantile(members[0, :4], FRACTILES, axis=0), rtol=1e-6)
@@ -0,0 +1,54 @@
+import datetime as dt
+
+import h5py
+import numpy as np
+import pytest
+
+import lagged_ensemble
+
+STARTDATE = dt.datetime(2021, 1, 1, 12, 5)
+
+
+@pytest.fixture
+def previous_run(tmp_path):
+    """Old format output of the run 5 minutes earlier, 3 members and 3 leadtimes"""
+    fname = tmp_path / "previous.h5"
+    prev_start = STARTDATE - dt.timedelta(minutes=5)
+    with h5py.File(fname, "w") as f:
+        for member in range(3):
+            for leadtime in range(3):
+                validtime = prev_start + (leadtime + 1) * dt.timedelta(minutes=5)
+                data = np.full((2, 4), 10 * member + leadtime, dtype=np.uint16)
+                data[0, 0] = 65535
+                dset = f.create_dataset(f"member-{member:02}/leadtime-{leadtime:02}", data=data)
+                dset.attrs["Valid for"] = int(f"{validtime:%Y%m%d%H%M%S}")
+                dset.attrs["gain"] = 0.5
+                dset.attrs["offset"] = 0.0
+                dset.attrs["nodata"] = 65535
+    return fname
+
+
+def test_leadtimes_are_aligned(previous_run):
+    lagged = lagged_ensemble.open_lagged_members(previous_run, STARTDATE, 5, 5, n_leadtimes=4,
+                                                 max_members=2)
+    try:
+        assert lagged.n_members == 2
+        assert lagged.valid_leadtimes == 2
+        # Leadtime 0 of this run is leadtime 1 of the previous run
+        fields = lagged.leadtime(0)
+        assert fields.shape == (2, 2, 4) and fields.dtype == np.float32
+        assert np.isnan(fields[:, 0, 0]).all()
+        np.testing.assert_array_equal(fields[:, 1, 1], [0.5, 5.5])
+        assert np.isnan(lagged.leadtime(2)).all()
+
+        full = lagged.load()
+        assert full.shape == (2, 4, 2, 4)
+        for index in range(4):
+            np.testing.assert_array_equal(full[:, index], lagged.leadtime(index))
+    finally:
+        lagged.close()
+
+
+def test_lag_must_be_multiple_of_timestep(previous_run):
+    with pytest.raises(ValueError):
+        lagged_ensemble.open_lagged_members(previous_run, STARTDATE, 7, 5, n_leadtimes=4)
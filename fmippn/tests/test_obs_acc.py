@@ -0,0 +1,63 @@
+import datetime as dt
+
+import numpy as np
+
+import obs_acc
+
+END = dt.datetime(2021, 1, 1, 12)
+
+
+def test_nodata_and_missing_observations(tmp_path):
+    acc = obs_acc.RollingAccumulation(tmp_path, (1, 2), timestep=5, window_minutes=15)
+    # Observation at END-10min is missing
+    for minutes in (20, 15, 5, 0):
+        rate = np.array([[12.0, 12.0]])
+        if minutes == 15:
+            rate[0, 1] = np.nan
+        acc.update(END - dt.timedelta(minutes=minutes), rate)
+
+    field, n_missing = acc.accumulation(END)
+    assert n_missing == 1
+    assert field[0, 0] == np.float32(2.0)
+    assert np.isnan(field[0, 1])
+
+    pgm = tmp_path / "acc.pgm"
+    obs_acc.write_acc_pgm(pgm, field)
+    assert pgm.read_bytes().endswith(b"\x00\xc8\xff\xff")
+
+
+def test_observation_is_added_once(tmp_path):
+    acc = obs_acc.RollingAccumulation(tmp_path, (2, 2), timestep=5, window_minutes=15)
+    obstime = END - dt.timedelta(minutes=5)
+    assert not acc.has_slot(obstime)
+    assert acc.update(obstime, np.full((2, 2), 6.0))
+    assert acc.has_slot(obstime)
+    assert not acc.update(obstime, np.full((2, 2), 60.0))
+    # State is kept between runs
+    acc.flush()
+    acc = obs_acc.RollingAccumulation(tmp_path, (2, 2), timestep=5, window_minutes=15)
+    assert acc.has_slot(obstime)
+    assert not acc.has_slot(obstime + dt.timedelta(minutes=15))
+
+
+def test_window_is_acc1h_hour(tmp_path):
+    acc = obs_acc.RollingAccumulation(tmp_path, (1, 1), timestep=5, window_minutes=60)
+    for minutes in range(70, -1, -5):
+        # 1 mm per observation, plus minutes / 100 mm to tell observations apart
+        acc.update(END - dt.timedelta(minutes=minutes), np.full((1, 1), 12.0 + 0.12 * minutes))
+
+    # Observations at END-60min ... END-5min, like acc1h
+    expected = sum(1.0 + minutes / 100.0 for minutes in range(60, 0, -5))
+    field, n_missing = acc.accumulation(END)
+    assert n_missing == 0
+    np.testing.assert_allclose(field[0, 0], expected, rtol=1e-6)
+    # Same result without the running sum
+    field, _ = acc.accumulation(END - dt.timedelta(minutes=5), 55)
+    np.testing.assert_allclose(field[0, 0], expected - 1.05, rtol=1e-6)
+
+    field, _ = acc.accumulation(END, 15)
+    np.testing.assert_allclose(field[0, 0], 3.3, rtol=1e-6)
+    # Next window includes the newest observation
+    field, n_missing = acc.accumulation(END + dt.timedelta(minutes=5), 60)
+    assert n_missing == 0
+    np.testing.assert_allclose(field[0, 0], expected - 1.6 + 1.0, rtol=1e-6)
@@ -0,0 +1,81 @@
+import datetime as dt
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import output_arena
+import shm_io
+
+
+@pytest.fixture
+def name():
+    name = output_arena.arena_name(f"fmippn_test_{os.getpid()}_out", "ens",
+                                   dt.datetime(2021, 1, 1, 12))
+    yield name
+    shm_io.unlink(name)
+
+
+def test_put_attach(name):
+    scale_meta = {"gain": 0.01, "offset": 0.0, "undetect": 0, "nodata": 65535}
+    arena = output_arena.OutputArena.create(name, 3, 2, (4, 5), "uint16", {"unit": "mm/h"})
+    try:
+        with output_arena.attach(name) as view:
+            assert view.completed == 0 and view.state == output_arena.WRITING
+            assert view.descriptor["unit"] == "mm/h"
+            assert view.data.shape == (3, 2, 4, 5) and view.data.dtype == np.uint16
+
+            fields = np.arange(40, dtype=np.uint16).reshape(2, 4, 5)
+            fields[1, 3, 4] = 65535
+            arena.put(0, fields, scale_meta)
+            assert view.completed == 1
+            np.testing.assert_array_equal(view.data[0], fields)
+            assert view.scale(0) == {"gain": 0.01, "offset": 0.0, "undetect": 0.0, "nodata": 65535.0}
+            decoded = view.decoded(0)
+            assert np.isnan(decoded[1, 3, 4])
+            np.testing.assert_allclose(decoded[0], fields[0] * 0.01)
+            assert np.isnan(view.scale(1)["gain"])
+
+            arena.finish(output_arena.STOPPED)
+            assert view.state == output_arena.STOPPED
+            # A stopped run does not block the consumer
+            assert view.wait(3, timeout=5) == 1
+    finally:
+        arena.close()
+
+
+def test_wait(name):
+    arena = output_arena.OutputArena.create(name, 2, 1, (2, 2), "uint8", dict())
+    view = output_arena.attach(name)
+    try:
+        writer = threading.Timer(0.1, arena.put, (1, np.ones((1, 2, 2)), {"gain": 1, "offset": 0}))
+        writer.start()
+        assert view.wait(2, timeout=5, poll_interval=0.01) == 2
+        writer.join()
+        assert view.wait(3, timeout=0.05, poll_interval=0.01) == 2
+    finally:
+        view.close()
+        arena.close()
+
+
+def test_attach_missing(name):
+    assert output_arena.attach(name) is None
+
+
+def test_archive_writer_order():
+    written = []
+    writer = output_arena.ArchiveWriter(max_pending=2)
+    try:
+        for index in range(5):
+            writer.submit(written.append, index)
+        writer.wait()
+        assert written == list(range(5))
+
+        def fail():
+            raise OSError("disk full")
+        writer.submit(fail)
+        with pytest.raises(OSError):
+            writer.wait()
+    finally:
+        writer.shutdown()
@@ -0,0 +1,74 @@
+import datetime as dt
+
+import pytest
+
+import run_cache
+
+STARTDATE = dt.datetime(2021, 1, 1, 12)
+
+
+@pytest.fixture(autouse=True)
+def code_version(monkeypatch):
+    # code_version() imports pysteps
+    monkeypatch.setattr(run_cache, "_code_version", "test")
+
+
+@pytest.fixture
+def configuration():
+    return {
+        "nowcast_options": {"n_ens_members": 51, "num_workers": 4},
+        "run_options": {"leadtimes": 12},
+        "logging": {"write_log": True},
+    }
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    fname = tmp_path / "input.h5"
+    fname.write_bytes(b"composite")
+    return fname
+
+
+def test_fingerprint_is_stable(configuration, input_file):
+    first = run_cache.fingerprint([input_file, None], configuration, "ravake", STARTDATE)
+    configuration = {key: dict(value) for key, value in reversed(configuration.items())}
+    assert run_cache.fingerprint([input_file, None], configuration, "ravake", STARTDATE) == first
+
+
+def test_fingerprint_ignores_operational_options(configuration, input_file):
+    first = run_cache.fingerprint([input_file], configuration, "ravake", STARTDATE)
+    configuration["logging"]["write_log"] = False
+    configuration["nowcast_options"]["num_workers"] = 1
+    configuration["run_lock"] = {"policy": "skip"}
+    assert run_cache.fingerprint([input_file], configuration, "ravake", STARTDATE) == first
+
+
+def test_fingerprint_changes(configuration, input_file):
+    first = run_cache.fingerprint([input_file], configuration, "ravake", STARTDATE)
+    assert run_cache.fingerprint([input_file], configuration, "europe", STARTDATE) != first
+    assert run_cache.fingerprint([input_file], configuration, "ravake",
+                                 STARTDATE + dt.timedelta(minutes=5)) != first
+    changed = dict(configuration, nowcast_options={"n_ens_members": 25, "num_workers": 4})
+    assert run_cache.fingerprint([input_file], changed, "ravake", STARTDATE) != first
+
+    content = run_cache.fingerprint([input_file], configuration, "ravake", STARTDATE, "content")
+    input_file.write_bytes(b"composit2")
+    assert run_cache.fingerprint([input_file], configuration, "ravake", STARTDATE, "content") != content
+
+
+def test_run_cache(tmp_path):
+    output = tmp_path / "nowcast.h5"
+    output.write_bytes(b"nowcast")
+    cache = run_cache.RunCache(tmp_path / "cache")
+    assert cache.lookup("abc") is None
+
+    cache.record("abc", [output], timestamp="202101011200")
+    entry = cache.lookup("abc")
+    assert entry["timestamp"] == "202101011200"
+    assert entry["outputs"] == {str(output): len(b"nowcast")}
+
+    # Changed or removed outputs are not reused
+    output.write_bytes(b"truncated nowcast")
+    assert cache.lookup("abc") is None
+    output.unlink()
+    assert cache.lookup("abc") is None
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import run_lock
+
+
+def test_skip(tmp_path):
+    first = run_lock.RunLock(tmp_path, "ravake")
+    second = run_lock.RunLock(tmp_path, "ravake")
+    assert first.acquire("202101011200", policy="skip")
+    assert first.holder()["timestamp"] == "202101011200"
+    assert first.holder()["pid"] == os.getpid()
+
+    assert not second.acquire("202101011205", policy="skip")
+    assert second.reason == f"run 202101011200 (pid {os.getpid()}) is active"
+    # Other domains are not locked
+    other = run_lock.RunLock(tmp_path, "europe")
+    assert other.acquire("202101011205", policy="skip")
+    other.release()
+
+    first.release()
+    assert first.holder() is None
+    assert second.acquire("202101011205", policy="skip")
+    second.release()
+
+
+def test_queue_latest(tmp_path):
+    first = run_lock.RunLock(tmp_path, "ravake")
+    assert first.acquire("202101011200")
+    # A newer run is already waiting
+    newer = run_lock.RunLock(tmp_path, "ravake")
+    assert newer._set_pending("202101011210")
+    older = run_lock.RunLock(tmp_path, "ravake", poll_interval=0.01)
+    assert not older.acquire("202101011205", policy="queue_latest")
+    assert older.reason == "a newer run is waiting"
+
+    waiting = run_lock.RunLock(tmp_path, "ravake", poll_interval=0.01, max_wait=0.05)
+    assert not waiting.acquire("202101011215", policy="queue_latest")
+    assert waiting.reason == "waited over 0.05 s"
+    first.release()
+
+
+def test_preempt_newer_run(tmp_path):
+    first = run_lock.RunLock(tmp_path, "ravake")
+    assert first.acquire("202101011205")
+    older = run_lock.RunLock(tmp_path, "ravake")
+    assert not older.acquire("202101011200", policy="preempt")
+    assert older.reason.endswith("is not older")
+    first.release()
+
+
+def test_unknown_policy(tmp_path):
+    with pytest.raises(ValueError):
+        run_lock.RunLock(tmp_path, "ravake").acquire("202101011200", policy="wait")
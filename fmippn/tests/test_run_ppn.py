@@ -0,0 +1,26 @@
+import pytest
+
+import run_ppn
+
+
+def test_batch_timestamps():
+    assert run_ppn.batch_timestamps("202012312350", "202101010005", 5) == [
+        "202012312350", "202012312355", "202101010000", "202101010005"]
+    assert run_ppn.batch_timestamps("202101011200", "202101011200", 5) == ["202101011200"]
+    # End is not on the step
+    assert run_ppn.batch_timestamps("202101011200", "202101011214", 5) == [
+        "202101011200", "202101011205", "202101011210"]
+
+
+@pytest.mark.parametrize("start, end, step", [
+    ("202101011200", "202101011155", 5),
+    ("202101011200", "202101011300", 0),
+])
+def test_batch_timestamps_invalid(start, end, step):
+    with pytest.raises(ValueError):
+        run_ppn.batch_timestamps(start, end, step)
+
+
+def test_sequential_features():
+    configuration = {"verification": {"compute": True}, "lagged_ensemble": {"compute": False}}
+    assert run_ppn.sequential_features(configuration) == ["verification"]
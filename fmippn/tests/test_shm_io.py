@@ -0,0 +1,50 @@
+import datetime as dt
+import os
+
+import numpy as np
+import pytest
+
+import shm_io
+
+
+@pytest.fixture
+def prefix():
+    prefix = f"fmippn_test_{os.getpid()}"
+    yield prefix
+    for name in shm_io.list_segments(prefix).values():
+        shm_io.unlink(name)
+
+
+def test_publish_attach(prefix):
+    timestamp = dt.datetime(2021, 1, 1, 12)
+    name = shm_io.segment_name(prefix, timestamp)
+    field = np.ma.masked_invalid(np.array([[0.5, np.nan], [1.0, 2.0]], dtype=np.float32))
+    metadata = {"unit": "mm/h", "xpixelsize": np.float64(1000.0), "timestamps": [timestamp]}
+    shm_io.publish(name, field, metadata)
+
+    with shm_io.attach(name) as shared:
+        assert shared.data.dtype == np.float32
+        np.testing.assert_array_equal(shared.data, field.filled(np.nan))
+        assert not shared.data.flags.writeable
+        assert shared.metadata == {"unit": "mm/h", "xpixelsize": 1000.0,
+                                   "timestamps": [timestamp.isoformat()]}
+    assert shm_io.list_segments(prefix) == {timestamp: name}
+
+    # Republishing replaces the segment
+    shm_io.publish(name, np.zeros((3, 3), dtype=np.uint8), dict())
+    with shm_io.attach(name) as shared:
+        assert shared.data.shape == (3, 3)
+
+    assert shm_io.unlink(name)
+    assert not shm_io.unlink(name)
+    assert shm_io.attach(name) is None
+
+
+def test_cleanup(prefix):
+    now = dt.datetime(2021, 1, 1, 12)
+    for minutes in (0, 5, 30):
+        shm_io.publish(shm_io.segment_name(prefix, now - dt.timedelta(minutes=minutes)),
+                       np.zeros((1, 1)), dict())
+    removed = shm_io.cleanup(prefix, 10, now=now)
+    assert removed == [shm_io.segment_name(prefix, now - dt.timedelta(minutes=30))]
+    assert sorted(shm_io.list_segments(prefix)) == [now - dt.timedelta(minutes=5), now]
@@ -0,0 +1,66 @@
+import h5py
+import numpy as np
+import pytest
+
+import sparse_io
+
+
+@pytest.fixture
+def field():
+    rng = np.random.default_rng(1)
+    data = np.full((40, 30), 0, dtype=np.uint16)
+    wet = rng.random(data.shape) > 0.8
+    data[wet] = rng.integers(1, 1000, size=np.count_nonzero(wet))
+    # Runs crossing row boundaries and touching both ends of the field
+    data[0, :5] = 7
+    data[9, 25:] = 8
+    data[10, :3] = 9
+    data[-1, -4:] = 10
+    return data
+
+
+def test_encode_decode_roundtrip(field):
+    run_start, run_length, values = sparse_io.encode(field, 0)
+    assert run_start.dtype == np.uint32 and run_length.dtype == np.uint32
+    assert run_length.sum() == values.size == np.count_nonzero(field)
+    decoded = sparse_io.decode(run_start, run_length, values, field.shape, 0)
+    np.testing.assert_array_equal(decoded, field)
+    assert decoded.dtype == field.dtype
+
+
+def test_encode_decode_nan_fill():
+    field = np.full((5, 6), np.nan, dtype=np.float32)
+    field[1, 2:5] = [0.0, 1.5, 2.5]
+    field[4, 5] = 3.0
+    run_start, run_length, values = sparse_io.encode(field, np.nan)
+    np.testing.assert_array_equal(run_start, [8, 29])
+    np.testing.assert_array_equal(run_length, [3, 1])
+    decoded = sparse_io.decode(run_start, run_length, values, field.shape, np.nan)
+    np.testing.assert_array_equal(decoded, field)
+
+
+def test_all_dry_field():
+    field = np.zeros((4, 4), dtype=np.uint8)
+    run_start, run_length, values = sparse_io.encode(field, 0)
+    assert run_start.size == run_length.size == values.size == 0
+    np.testing.assert_array_equal(
+        sparse_io.decode(run_start, run_length, values, field.shape, 0), field)
+
+
+def test_hdf5_roundtrip(tmp_path, field):
+    fname = tmp_path / "sparse.h5"
+    with h5py.File(fname, "w") as f:
+        sparse_io.store_sparse_field(f.create_group("dataset1/data1"), field, 0)
+        f.create_group("dataset1/data2").create_dataset("data", data=field)
+
+    with h5py.File(fname, "r") as f:
+        assert sparse_io.is_sparse(f["dataset1/data1"])
+        assert not sparse_io.is_sparse(f["dataset1/data2"])
+        np.testing.assert_array_equal(sparse_io.read_field(f["dataset1/data1"]), field)
+        np.testing.assert_array_equal(sparse_io.read_field(f["dataset1/data2"]), field)
+
+        lazy = sparse_io.read_field(f["dataset1/data1"], lazy=True)
+        assert isinstance(lazy, sparse_io.SparseField)
+        assert lazy.shape == field.shape and lazy.dtype == field.dtype
+        np.testing.assert_array_equal(lazy[9:11, 2:28], field[9:11, 2:28])
+        np.testing.assert_array_equal(lazy[-1], field[-1])
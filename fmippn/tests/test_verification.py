@@ -0,0 +1,75 @@
+import datetime as dt
+
+import numpy as np
+
+import verification
+
+
+def test_crps_ensemble_matches_pairwise_definition():
+    rng = np.random.default_rng(5)
+    members = rng.gamma(0.7, 2.0, size=(7, 50))
+    observation = rng.gamma(0.7, 2.0, size=50)
+    expected = (np.abs(members - observation).mean(axis=0)
+                - 0.5 * np.abs(members[:, np.newaxis] - members[np.newaxis]).mean(axis=(0, 1)))
+    np.testing.assert_allclose(verification.crps_ensemble(members, observation), expected)
+
+
+def test_crps_single_member_is_absolute_error():
+    members = np.array([[1.0, 4.0, 0.0]])
+    observation = np.array([2.0, 1.0, 0.0])
+    np.testing.assert_allclose(verification.crps_ensemble(members, observation), [1.0, 3.0, 0.0])
+
+
+def test_contingency():
+    forecasts = np.array([[0.0, 1.0, 2.0, 5.0],
+                          [1.0, 0.0, 2.0, 0.0]])
+    observation = np.array([0.0, 1.0, 1.0, 0.5])
+    table = verification.contingency(forecasts, observation, [1.0, 3.0])
+    assert table.dtype == np.int64
+    # hits, misses, false alarms, correct negatives over both forecasts
+    np.testing.assert_array_equal(table, [[3, 1, 2, 2], [0, 0, 1, 7]])
+    assert table.sum(axis=1).tolist() == [forecasts.size] * 2
+
+
+def test_verification_state(tmp_path):
+    state_file = tmp_path / "verif.json"
+    startdate = dt.datetime(2021, 1, 1, 12)
+    validtime = startdate + dt.timedelta(minutes=15)
+    members = np.array([[[1.0, 2.0]], [[3.0, np.nan]], [[np.nan, np.nan]]])
+    observation = np.array([[2.0, 0.0]])
+
+    verif = verification.Verification(state_file, thresholds=[1.5])
+    assert verif.add("ens", 15, startdate, validtime, members, observation)
+    # The same run and valid time is verified only once
+    assert not verif.add("ens", 15, startdate, validtime, members, observation)
+    verif.save()
+
+    # Member without data is left out, and the pixel where a member is nodata
+    scores = verification.Verification(state_file, thresholds=[1.5]).scores()["ens"][15]
+    assert scores["n_pixels"] == 1 and scores["n_forecasts"] == 1
+    assert scores["mae"] == 0.0
+    assert scores["crps"] == 0.5
+    assert scores["pod_1.5"] == 0.5 and scores["far_1.5"] == 0.0
+
+    # Changed thresholds start over
+    assert verification.Verification(state_file, thresholds=[1.0]).scores() == {"det": {}, "ens": {}}
+
+
+def test_observation_nodata_is_left_out(tmp_path):
+    startdate = dt.datetime(2021, 1, 1, 12)
+    validtime = startdate + dt.timedelta(minutes=5)
+    forecast = np.array([[[2.0, 0.0, 0.0]]])
+    observation = np.array([[2.0, np.nan, np.nan]])
+
+    verif = verification.Verification(tmp_path / "verif.json", thresholds=[1.0])
+    assert verif.add("det", 5, startdate, validtime, forecast, observation)
+    scores = verif.scores()["det"][5]
+    assert scores["n_pixels"] == 1
+    assert scores["mae"] == 0.0
+    # Out-of-coverage pixels are not counted as correct negatives
+    np.testing.assert_array_equal(verif._accumulators["det"][5].table, [[1, 0, 0, 0]])
+
+    # Nothing is added when the observation has no data at all
+    observation[...] = np.nan
+    assert not verif.add("det", 10, startdate - dt.timedelta(minutes=5), validtime,
+                         forecast, observation)
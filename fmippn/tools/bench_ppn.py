@@ -0,0 +1,152 @@
+"""End-to-end FMI-PPN benchmark on synthetic radar data.
+
+Generates a composite sequence with synthetic_radar.py and runs run_ppn.py
+for each combination of ensemble size, number of leadtimes and output mode.
+Each case runs in its own process with a generated configuration (based on
+--config) and metrics enabled, so stage timings and peak memory come from
+the metrics record of the run (see metrics.py).
+
+Output modes:
+    asap      -- write each product as soon as it is ready (write_asap)
+    end       -- write all output at the end of the run
+    callback  -- write each leadtime in the pysteps callback
+
+Run from fmippn source folder:
+    $ python tools/bench_ppn.py --domain ravake --members 6 12 --leadtimes 12 \
+        --modes asap callback --workdir /tmp/ppn_bench --results bench.json
+"""
+import argparse
+import copy
+import datetime as dt
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+FMIPPN_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(FMIPPN_DIR))
+import ppn_config  # pylint: disable=wrong-import-position
+import synthetic_radar  # pylint: disable=wrong-import-position
+
+OUTPUT_MODES = {
+    "asap": {"write_asap": True, "write_leadtimes_separately": False},
+    "end": {"write_asap": False, "write_leadtimes_separately": False},
+    "callback": {"write_asap": False, "write_leadtimes_separately": True},
+}
+
+
+def case_config(base, data_source, members, leadtimes, mode, output_dir, metrics_file):
+    """Return configuration of one benchmark case"""
+    config = copy.deepcopy(base)
+    config["data_source"] = data_source
+    config.setdefault("nowcast_options", dict())["n_ens_members"] = members
+    run_options = config.setdefault("run_options", dict())
+    run_options["leadtimes"] = leadtimes
+    run_options["nowcast_timestep"] = data_source["timestep"]
+    run_options["max_leadtime"] = leadtimes * data_source["timestep"]
+    output_options = config.setdefault("output_options", dict())
+    output_options["path"] = str(output_dir)
+    output_options.update(OUTPUT_MODES[mode])
+    if data_source["fn_ext"] == "pgm":
+        output_options["use_old_format"] = True
+    config["metrics"] = {"enabled": True, "json_file": str(metrics_file)}
+    config.setdefault("logging", dict())["write_log"] = False
+    return config
+
+
+def run_case(workdir, name, config, timestamp, timeout=None):
+    """Run run_ppn.py with `config` in a separate process.
+
+    Output:
+        metrics record of the run, with wall time of the process added
+    """
+    config_fname = workdir.joinpath(f"{name}.json")
+    with open(config_fname, "w") as f:
+        json.dump(config, f, indent=2)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(FMIPPN_DIR)] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+    start = time.perf_counter()
+    # Relative config name, it is used in output filenames
+    completed = subprocess.run([sys.executable, str(FMIPPN_DIR.joinpath("run_ppn.py")),
+                                "--config", name, "--timestamp", timestamp],
+                               cwd=workdir, env=env, capture_output=True, text=True,
+                               timeout=timeout)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark case {name} failed:\n{completed.stderr[-2000:]}")
+    with open(config["metrics"]["json_file"], "r") as f:
+        record = json.loads(f.readlines()[-1])
+    record["process_seconds"] = wall
+    return record
+
+
+def summarize(record, members, leadtimes, mode):
+    stages = record["stages"]
+    nowcast_seconds = stages.get("ensemble_nowcast", {}).get("seconds")
+    return {
+        "members": members,
+        "leadtimes": leadtimes,
+        "mode": mode,
+        "total_seconds": record["total_seconds"],
+        "process_seconds": record["process_seconds"],
+        "peak_rss_mb": record["peak_rss_bytes"] / 1e6,
+        "fields_per_second": (members * leadtimes / nowcast_seconds) if nowcast_seconds else None,
+        "stage_seconds": {name: stage["seconds"] for name, stage in stages.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--domain", default="ravake", help="Grid template config/template_DOMAIN=<domain>.h5")
+    parser.add_argument("--format", dest="fmt", choices=["odim", "pgm"], default="odim")
+    parser.add_argument("--config", default="ravake", help="Base configuration")
+    parser.add_argument("--members", nargs="+", type=int, default=[6])
+    parser.add_argument("--leadtimes", nargs="+", type=int, default=[12])
+    parser.add_argument("--modes", nargs="+", choices=list(OUTPUT_MODES), default=["asap"])
+    parser.add_argument("--wet", type=float, default=0.1, help="Fraction of wet pixels")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workdir", required=True)
+    parser.add_argument("--results", help="Write results as JSON to this file")
+    parser.add_argument("--timeout", type=float, help="Seconds per case")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    base = ppn_config.get_params(args.config)
+    end_time = dt.datetime(2023, 1, 1, 12, 0)
+    n_obs = base.get("run_options", dict()).get(
+        "num_prev_observations", ppn_config.defaults["run_options"]["num_prev_observations"]) + 1
+    synthetic = synthetic_radar.generate(workdir.joinpath("input"), domain=args.domain,
+                                         fmt=args.fmt, end_time=end_time, count=n_obs,
+                                         wet_fraction=args.wet, seed=args.seed)
+
+    results = []
+    print(f"{'members':>8}{'leadtimes':>10}{'mode':>10}{'total s':>10}{'fields/s':>10}{'peak MB':>10}")
+    for mode in args.modes:
+        for members in args.members:
+            for leadtimes in args.leadtimes:
+                for repeat in range(args.repeat):
+                    name = f"bench_{mode}_m{members}_l{leadtimes}_r{repeat}"
+                    config = case_config(base, synthetic["data_source"], members, leadtimes, mode,
+                                         workdir.joinpath("output", name),
+                                         workdir.joinpath(f"{name}_metrics.jsonl"))
+                    record = run_case(workdir, name, config, f"{end_time:%Y%m%d%H%M}",
+                                      timeout=args.timeout)
+                    result = summarize(record, members, leadtimes, mode)
+                    results.append(result)
+                    fields_per_second = result["fields_per_second"] or float("nan")
+                    print(f"{members:>8}{leadtimes:>10}{mode:>10}{result['total_seconds']:>10.1f}"
+                          f"{fields_per_second:>10.2f}{result['peak_rss_mb']:>10.0f}")
+
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump({"domain": args.domain, "format": args.fmt, "config": args.config,
+                       "shape": list(synthetic["shape"]), "wet_fraction": args.wet,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
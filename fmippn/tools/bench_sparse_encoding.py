@@ -0,0 +1,105 @@
+"""Compare output file size and encode/decode throughput of dense, compressed
+and sparse (rain-mask) encodings of PPN output fields.
+
+Run from fmippn source folder:
+    $ python tools/bench_sparse_encoding.py --shape 1226 760 --wet 0.1 --fields 12
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sparse_io  # pylint: disable=wrong-import-position
+
+
+def synthetic_fields(shape, wet_fraction, n_fields, undetect=0, seed=0):
+    """Generate uint16 fields with smooth rain areas covering `wet_fraction` of pixels"""
+    rng = np.random.default_rng(seed)
+    fields = []
+    for _ in range(n_fields):
+        noise = rng.standard_normal(shape)
+        # Smooth white noise in spectral domain to get rain cells instead of salt and pepper
+        ky = np.fft.fftfreq(shape[0])[:, None]
+        kx = np.fft.rfftfreq(shape[1])[None, :]
+        spectrum = np.fft.rfft2(noise) * np.exp(-(kx**2 + ky**2) / 0.0005)
+        smooth = np.fft.irfft2(spectrum, s=shape)
+        threshold = np.quantile(smooth, 1.0 - wet_fraction)
+        field = np.full(shape, undetect, dtype=np.uint16)
+        wet = smooth > threshold
+        field[wet] = 3300 + (smooth[wet] - threshold) / smooth.std() * 1000
+        fields.append(field)
+    return fields
+
+
+def _write_dense(fname, fields, **kwargs):
+    with h5py.File(fname, "w") as f:
+        for i, field in enumerate(fields):
+            f.create_group(f"dataset{i+1}/data1").create_dataset("data", data=field, **kwargs)
+
+
+def _read_dense(fname, n_fields):
+    with h5py.File(fname, "r") as f:
+        return [f[f"dataset{i+1}/data1/data"][...] for i in range(n_fields)]
+
+
+def _write_sparse(fname, fields, undetect):
+    with h5py.File(fname, "w") as f:
+        for i, field in enumerate(fields):
+            sparse_io.store_sparse_field(f.create_group(f"dataset{i+1}/data1"), field, undetect)
+
+
+def _read_sparse(fname, n_fields):
+    with h5py.File(fname, "r") as f:
+        return [sparse_io.read_field(f[f"dataset{i+1}/data1"]) for i in range(n_fields)]
+
+
+def _timed(func, *args, repeat=3):
+    best = np.inf
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shape", nargs=2, type=int, default=[1226, 760])
+    parser.add_argument("--wet", type=float, default=0.1, help="Fraction of wet pixels")
+    parser.add_argument("--fields", type=int, default=12)
+    parser.add_argument("--undetect", type=int, default=0)
+    args = parser.parse_args()
+
+    fields = synthetic_fields(tuple(args.shape), args.wet, args.fields, undetect=args.undetect)
+    raw_mbytes = sum(field.nbytes for field in fields) / 1e6
+
+    variants = {
+        "dense": (lambda fn: _write_dense(fn, fields), _read_dense),
+        "gzip-4": (lambda fn: _write_dense(fn, fields, compression="gzip", compression_opts=4,
+                                           chunks=True), _read_dense),
+        "sparse": (lambda fn: _write_sparse(fn, fields, args.undetect), _read_sparse),
+    }
+
+    print(f"{args.fields} fields of {args.shape[0]}x{args.shape[1]}, wet fraction {args.wet}, "
+          f"{raw_mbytes:.1f} MB raw")
+    print(f"{'encoding':<10}{'size MB':>10}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (writer, reader) in variants.items():
+            fname = os.path.join(tmpdir, f"{name}.h5")
+            t_write, _ = _timed(writer, fname)
+            t_read, decoded = _timed(reader, fname, args.fields)
+            if not all(np.array_equal(a, b) for a, b in zip(fields, decoded)):
+                raise RuntimeError(f"Decoded fields differ from input for encoding {name}")
+            size = os.path.getsize(fname) / 1e6
+            print(f"{name:<10}{size:>10.2f}{raw_mbytes / size:>8.1f}"
+                  f"{raw_mbytes / t_write:>12.0f}{raw_mbytes / t_read:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""Performance regression gate for FMI-PPN output and conversion functions.
+
+Benchmarks (synthetic data, see synthetic_radar.py):
+    prepare_data_for_writing    -- utils.prepare_data_for_writing (micro)
+    thresholding                -- ppn.thresholding (micro)
+    transform_to_decibels       -- ppn.transform_to_decibels (micro)
+    convert_callback_output     -- quantity conversion and thresholding of
+                                   callback fields (micro)
+    regenerate_ensemble_motion  -- ppn.regenerate_ensemble_motion (micro)
+    write_ensemble              -- odim_io.write_ensemble_to_file / _write (macro)
+    write_callback              -- ppn.write_odim_output_separately for all
+                                   members and leadtimes (macro)
+
+`record` runs the benchmarks and stores the timing samples and peak traced
+memory as the baseline of a machine profile (<baseline-dir>/<profile>.json).
+With --update-references it also stores the benchmark outputs
+(<baseline-dir>/reference/<benchmark>.npz), which do not depend on the
+machine.
+
+`compare` runs the benchmarks again. A benchmark fails when
+    - it is slower than the baseline by more than --tolerance (relative
+      median) and the slowdown is significant (one-sided Welch t-test,
+      p < --alpha)
+    - its peak memory grew by more than --memory-tolerance
+    - its output differs from the reference output
+The exit code is 1 if any benchmark fails.
+
+Run from fmippn source folder:
+    $ python tools/perf_gate.py record --profile node1 --update-references
+    $ python tools/perf_gate.py compare --profile node1
+"""
+import argparse
+import copy
+import datetime as dt
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import h5py
+
+FMIPPN_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(FMIPPN_DIR))
+import ppn_config  # pylint: disable=wrong-import-position
+import utils  # pylint: disable=wrong-import-position
+import odim_io  # pylint: disable=wrong-import-position
+import synthetic_radar  # pylint: disable=wrong-import-position
+
+STARTDATE = dt.datetime(2023, 1, 1, 12, 0)
+OUTPUT_OPTIONS = {
+    "convert_to_dtype": "uint16",
+    "gain": 0.01,
+    "offset": -327.68,
+    "set_undetect_value_to": 0,
+    "set_nodata_value_to": 65535,
+}
+
+BENCHMARKS = dict()
+
+
+def benchmark(name):
+    """Register benchmark setup function. Setup returns a function that runs
+    the benchmark once and returns a dictionary of output arrays."""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def default_profile():
+    return f"{platform.node()}-{os.cpu_count()}cpu-py{platform.python_version()}"
+
+
+def _configuration(case):
+    """Full configuration like ppn.PD during a run"""
+    configuration = copy.deepcopy(ppn_config.defaults)
+    configuration["nowcast_options"]["n_ens_members"] = case["members"]
+    configuration["nowcast_options"]["kmperpixel"] = 1.0
+    configuration["nowcast_options"]["timestep"] = 5
+    configuration["nowcast_options"]["seed"] = 1
+    configuration["run_options"]["leadtimes"] = case["leadtimes"]
+    configuration["run_options"]["nowcast_timestep"] = 5
+    configuration["run_options"]["max_leadtime"] = 5 * case["leadtimes"]
+    configuration["data_source"] = {"timestep": 5}
+    configuration["output_options"].update(OUTPUT_OPTIONS)
+    configuration["logging"]["write_log"] = False
+    configuration["odim_metadata"] = utils.get_odim_attrs_from_input(
+        str(synthetic_radar.template_fname(case["domain"])))
+    configuration["startdate"] = STARTDATE
+    configuration["config"] = "perfgate"
+    configuration["ensemble_size"] = case["members"]
+    configuration["out_norain_value"] = -32
+    configuration["callback_options"]["tmp_folder"] = Path(case["tmpdir"])
+    return configuration
+
+
+def _dbz_fields(case, count):
+    shape = tuple(case["shape"])
+    return np.stack(list(synthetic_radar.rain_sequence(shape, count, wet_fraction=case["wet"],
+                                                       nodata_fraction=0.02, seed=case["seed"])))
+
+
+def _ensemble(case):
+    """Ensemble forecast (member, leadtime, y, x) in dBZ"""
+    fields = _dbz_fields(case, case["members"] + case["leadtimes"])
+    return np.stack([fields[member:member + case["leadtimes"]]
+                     for member in range(case["members"])]).astype(np.float64)
+
+
+def _ppn(configuration):
+    import ppn  # pylint: disable=import-outside-toplevel
+    ppn.PD.clear()
+    ppn.PD.update(configuration)
+    ppn.PD_callback.clear()
+    return ppn
+
+
+def _read_datasets(fname):
+    """All data arrays of an HDF5 file, for output equivalence"""
+    arrays = dict()
+    with h5py.File(fname, "r") as f:
+        f.visititems(lambda name, obj: arrays.__setitem__(name, obj[...])
+                     if isinstance(obj, h5py.Dataset) else None)
+    return arrays
+
+
+@benchmark("prepare_data_for_writing")
+def _setup_prepare(case):
+    forecast = _ensemble(case)
+
+    def run():
+        data, meta = utils.prepare_data_for_writing(forecast.copy(), OUTPUT_OPTIONS,
+                                                    forecast_undetect=-32)
+        return {"data": data, "nodata": np.array(meta["nodata"])}
+    return run
+
+
+@benchmark("thresholding")
+def _setup_thresholding(case):
+    ppn = _ppn(_configuration(case))
+    observations = _dbz_fields(case, 4).astype(np.float64)
+
+    def run():
+        data, meta = ppn.thresholding(observations.copy(), {}, threshold=8.0, norain_value=-10)
+        return {"data": data}
+    return run
+
+
+@benchmark("transform_to_decibels")
+def _setup_decibels(case):
+    ppn = _ppn(_configuration(case))
+    observations = _dbz_fields(case, 4).astype(np.float64)
+    rate = np.where(np.isfinite(observations), 10.0 ** (observations / 16.0), np.nan)
+    rate[rate < 0.1] = 0.0
+    metadata = {"threshold": 0.1, "zerovalue": 0.0, "transform": None}
+
+    def run():
+        data, meta = ppn.transform_to_decibels(rate, metadata)
+        back, _ = ppn.transform_to_decibels(data, meta, inverse=True)
+        return {"data": data, "inverse": back}
+    return run
+
+
+@benchmark("convert_callback_output")
+def _setup_conversion(case):
+    configuration = _configuration(case)
+    configuration["input_quantity"] = "DBZH"
+    configuration["data_undetect"] = -32
+    configuration["output_options"]["as_quantity"] = "RATE"
+    configuration["output_options"]["set_undetect_value_to"] = 0
+    del configuration["out_norain_value"]
+    ppn = _ppn(configuration)
+    forecast = _ensemble(case)[:, 0]
+    metadata = {"unit": "dBZ", "transform": "dB", "threshold": 8.0, "zerovalue": -32.0,
+                "zr_a": 223.0, "zr_b": 1.53}
+
+    def run():
+        ppn.PD_callback["obs_metadata"] = dict(metadata)
+        data, _ = ppn.convert_callback_output(forecast.copy())
+        return {"data": data}
+    return run
+
+
+@benchmark("regenerate_ensemble_motion")
+def _setup_motion(case):
+    configuration = _configuration(case)
+    ppn = _ppn(configuration)
+    shape = tuple(case["shape"])
+    motion = np.stack([np.full(shape, 2.0), np.full(shape, -1.5)])
+
+    def run():
+        motions = ppn.regenerate_ensemble_motion(motion, configuration["nowcast_options"])
+        return {"motion": np.stack(motions)}
+    return run
+
+
+@benchmark("write_ensemble")
+def _setup_write_ensemble(case):
+    configuration = _configuration(case)
+    data, scale_meta = utils.prepare_data_for_writing(_ensemble(case), OUTPUT_OPTIONS,
+                                                      forecast_undetect=-32)
+    fname = Path(case["tmpdir"]).joinpath("write_ensemble.h5")
+    metadata = {"startdate": STARTDATE, "scale_meta": scale_meta, "unit": "dBZ", "seed": 1}
+
+    def run():
+        odim_io.write_ensemble_to_file(configuration, data, fname, metadata=metadata)
+        return _read_datasets(fname)
+    return run
+
+
+@benchmark("write_callback")
+def _setup_write_callback(case):
+    configuration = _configuration(case)
+    ppn = _ppn(configuration)
+    data, scale_meta = utils.prepare_data_for_writing(_ensemble(case), OUTPUT_OPTIONS,
+                                                      forecast_undetect=-32)
+    metadata = {"unit": "dBZ"}
+
+    def run():
+        outputs = dict()
+        for leadtime in range(data.shape[1]):
+            for member in range(data.shape[0]):
+                fname = ppn.callback_filename(leadtime, member=member + 1)
+                with h5py.File(fname, "w") as f:
+                    ppn.write_odim_output_separately(f, leadtime, data[member, leadtime], metadata,
+                                                     scale_meta, fc_type="ens")
+                outputs[f"{leadtime}/{member}"] = _read_datasets(fname)["dataset1/data1/data"]
+        return outputs
+    return run
+
+
+def measure(run, repeat):
+    """Run benchmark: `repeat` timed runs, then one run with tracemalloc.
+
+    Output:
+        tuple (timing samples in seconds, peak traced bytes, outputs)
+    """
+    outputs = run()  # warm-up
+    samples = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return samples, peak, outputs
+
+
+def welch_p_value(new, base):
+    """One-sided p-value of mean(new) > mean(base), Welch's t-test"""
+    from scipy import stats  # pylint: disable=import-outside-toplevel
+    new = np.asarray(new)
+    base = np.asarray(base)
+    var_new = new.var(ddof=1) / new.size
+    var_base = base.var(ddof=1) / base.size
+    if var_new + var_base == 0:
+        return 0.0 if new.mean() > base.mean() else 1.0
+    t_value = (new.mean() - base.mean()) / np.sqrt(var_new + var_base)
+    dof = (var_new + var_base)**2 / (var_new**2 / (new.size - 1) + var_base**2 / (base.size - 1))
+    return float(stats.t.sf(t_value, dof))
+
+
+def outputs_equal(outputs, reference_fname, rtol=1e-6):
+    """Compare outputs to reference file. Return list of differing output names."""
+    with np.load(reference_fname) as reference:
+        names = set(reference.files) | set(outputs)
+        differing = []
+        for name in sorted(names):
+            if name not in reference.files or name not in outputs:
+                differing.append(name)
+                continue
+            expected = reference[name]
+            actual = np.asarray(outputs[name])
+            if expected.shape != actual.shape or expected.dtype != actual.dtype:
+                differing.append(name)
+            elif np.issubdtype(expected.dtype, np.floating):
+                if not np.allclose(actual, expected, rtol=rtol, atol=0, equal_nan=True):
+                    differing.append(name)
+            elif not np.array_equal(actual, expected):
+                differing.append(name)
+    return differing
+
+
+def run_benchmarks(case, names, repeat):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        case = dict(case, tmpdir=tmpdir)
+        for name in names:
+            samples, peak, outputs = measure(BENCHMARKS[name](case), repeat)
+            results[name] = {"samples": samples, "median": float(np.median(samples)),
+                             "peak_bytes": peak, "outputs": outputs}
+            print(f"{name:<28}{results[name]['median'] * 1000:>10.1f} ms{peak / 1e6:>10.1f} MB")
+    return results
+
+
+def _reference_fname(baseline_dir, name):
+    return Path(baseline_dir).joinpath("reference", f"{name}.npz")
+
+
+def record(args, case):
+    results = run_benchmarks(case, args.benchmarks, args.repeat)
+    baseline = {
+        "profile": args.profile,
+        "created": dt.datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "case": case,
+        "benchmarks": {name: {key: value for key, value in result.items() if key != "outputs"}
+                       for name, result in results.items()},
+    }
+    fname = Path(args.baseline_dir).joinpath(f"{args.profile}.json")
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, "w") as f:
+        json.dump(baseline, f, indent=2)
+    print(f"Baseline written to {fname}")
+    if args.update_references:
+        for name, result in results.items():
+            reference_fname = _reference_fname(args.baseline_dir, name)
+            reference_fname.parent.mkdir(parents=True, exist_ok=True)
+            np.savez_compressed(reference_fname, **result["outputs"])
+        print(f"Reference outputs written to {reference_fname.parent}")
+    return 0
+
+
+def compare(args, case):
+    fname = Path(args.baseline_dir).joinpath(f"{args.profile}.json")
+    with open(fname, "r") as f:
+        baseline = json.load(f)
+    case = baseline["case"]
+    names = [name for name in args.benchmarks if name in baseline["benchmarks"]]
+    results = run_benchmarks(case, names, args.repeat)
+
+    failures = 0
+    print(f"\n{'benchmark':<28}{'time':>8}{'p':>8}{'memory':>8}  output")
+    for name in names:
+        base = baseline["benchmarks"][name]
+        result = results[name]
+        time_ratio = result["median"] / base["median"]
+        p_value = welch_p_value(result["samples"], base["samples"])
+        memory_ratio = result["peak_bytes"] / max(base["peak_bytes"], 1)
+        slower = time_ratio > 1.0 + args.tolerance and p_value < args.alpha
+        memory_grew = memory_ratio > 1.0 + args.memory_tolerance
+
+        reference_fname = _reference_fname(args.baseline_dir, name)
+        if reference_fname.exists():
+            differing = outputs_equal(result["outputs"], reference_fname)
+            output_status = "ok" if not differing else f"DIFFERS ({', '.join(differing[:3])})"
+        else:
+            differing = []
+            output_status = "no reference"
+
+        failed = slower or memory_grew or differing
+        failures += bool(failed)
+        print(f"{name:<28}{time_ratio:>7.2f}x{p_value:>8.3f}{memory_ratio:>7.2f}x  {output_status}"
+              f"{'  FAIL' if failed else ''}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["record", "compare"])
+    parser.add_argument("--profile", default=default_profile(), help="Machine profile name")
+    parser.add_argument("--baseline-dir", default="perf_baselines")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs per benchmark")
+    parser.add_argument("--domain", default="ravake", help="Grid template (record only)")
+    parser.add_argument("--shape", nargs=2, type=int, help="Grid shape, default from template (record only)")
+    parser.add_argument("--members", type=int, default=4, help="Ensemble size (record only)")
+    parser.add_argument("--leadtimes", type=int, default=6, help="Number of leadtimes (record only)")
+    parser.add_argument("--wet", type=float, default=0.2, help="Wet fraction (record only)")
+    parser.add_argument("--update-references", action="store_true",
+                        help="Store benchmark outputs as reference (record only)")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10,
+                        help="Allowed relative peak memory growth")
+    parser.add_argument("--alpha", type=float, default=0.01, help="Significance level of slowdowns")
+    args = parser.parse_args()
+
+    shape = args.shape or synthetic_radar.read_template(synthetic_radar.template_fname(args.domain))[0]
+    case = {"domain": args.domain, "shape": list(shape), "members": args.members,
+            "leadtimes": args.leadtimes, "wet": args.wet, "seed": 0}
+    if args.command == "record":
+        sys.exit(record(args, case))
+    sys.exit(compare(args, case))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Generate synthetic radar composite sequences for benchmarking FMI-PPN.
+
+Grid size and ODIM metadata are taken from the composite templates
+(config/template_DOMAIN=<domain>.h5). Rain is a smooth random field, thresholded
+to the requested wet fraction, which advects with a constant velocity and
+slowly evolves, so optical flow and STEPS see realistic moving rain cells.
+
+Run from fmippn source folder:
+    $ python tools/synthetic_radar.py --domain ravake --wet 0.2 --count 6 --out /tmp/synth
+    $ python tools/synthetic_radar.py --domain europe --format pgm --out /tmp/synth_eur
+"""
+import argparse
+import datetime as dt
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pgm_io  # pylint: disable=wrong-import-position
+
+REPO_CONFIG = Path(__file__).resolve().parents[2].joinpath("config")
+
+# ODIM encoding of the templates
+GAIN = 0.5
+OFFSET = -32.0
+UNDETECT = 0
+NODATA = 255
+
+ODIM_FN_PATTERN = "%Y%m%d%H%M_radar.rack.comp_CONF=FMIPPN,ANDRE"
+PGM_FN_PATTERN = "%Y%m%d%H%M_fmi.radar.composite.lowest_FIN_RAVAKE"
+
+
+def template_fname(domain):
+    return REPO_CONFIG.joinpath(f"template_DOMAIN={domain}.h5")
+
+
+def read_template(fname):
+    """Return grid shape and the root what/where/how attributes of a composite template"""
+    with h5py.File(fname, "r") as f:
+        shape = f["dataset1/data1/data"].shape
+        attrs = {group: dict(f[group].attrs) for group in ("what", "where", "how") if group in f}
+    return shape, attrs
+
+
+def _smooth_noise(rng, shape, scale):
+    """Random field with features of about `scale` pixels"""
+    noise = rng.standard_normal(shape)
+    ky = np.fft.fftfreq(shape[0])[:, None]
+    kx = np.fft.rfftfreq(shape[1])[None, :]
+    spectrum = np.fft.rfft2(noise) * np.exp(-(kx**2 + ky**2) * (np.pi * scale)**2)
+    field = np.fft.irfft2(spectrum, s=shape)
+    return (field - field.mean()) / field.std()
+
+
+def rain_sequence(shape, count, wet_fraction=0.1, velocity=(2.0, 3.0), cell_scale=40.0,
+                  evolution=0.05, max_dbz=55.0, nodata_fraction=0.0, seed=0):
+    """Generate reflectivity fields (dBZ, NaN for nodata).
+
+    Input:
+        shape -- grid shape (y, x)
+        count -- number of fields
+        wet_fraction -- fraction of pixels with rain
+        velocity -- rain motion (dy, dx) in pixels per timestep
+        cell_scale -- size of rain features in pixels
+        evolution -- weight of new structure mixed in per timestep (0 = frozen)
+        max_dbz -- reflectivity of the strongest cores
+        nodata_fraction -- fraction of pixels outside radar coverage (corners)
+        seed -- random seed
+
+    Output:
+        generator of float32 arrays
+    """
+    rng = np.random.default_rng(seed)
+    base = _smooth_noise(rng, shape, cell_scale)
+    threshold = np.quantile(base, 1.0 - wet_fraction)
+    yy, xx = np.indices(shape)
+    radius = np.hypot((yy - shape[0] / 2) / shape[0], (xx - shape[1] / 2) / shape[1])
+    nodata = radius > np.quantile(radius, 1.0 - nodata_fraction) if nodata_fraction > 0 else None
+
+    for index in range(count):
+        shift = (int(round(velocity[0] * index)), int(round(velocity[1] * index)))
+        field = np.roll(base, shift, axis=(0, 1))
+        if evolution > 0 and index > 0:
+            base = np.sqrt(1.0 - evolution**2) * base + evolution * _smooth_noise(rng, shape, cell_scale)
+        wet = field > threshold
+        dbz = np.full(shape, OFFSET, dtype=np.float32)  # undetect
+        dbz[wet] = np.minimum(10.0 + (field[wet] - threshold) * 15.0, max_dbz)
+        if nodata is not None:
+            dbz[nodata] = np.nan
+        yield dbz
+
+
+def encode(dbz):
+    """Encode dBZ field to uint8 with the template gain, offset, undetect and nodata"""
+    nodata = np.isnan(dbz)
+    data = np.clip(np.round((np.where(nodata, OFFSET, dbz) - OFFSET) / GAIN), 1, 254).astype(np.uint8)
+    data[dbz <= OFFSET] = UNDETECT
+    data[nodata] = NODATA
+    return data
+
+
+def write_odim(fname, data, timestamp, template_attrs):
+    """Write an ODIM HDF5 composite like the template"""
+    with h5py.File(fname, "w") as f:
+        f.attrs["Conventions"] = np.bytes_("ODIM_H5/V2_1")
+        for group, attrs in template_attrs.items():
+            grp = f.create_group(group)
+            for key, value in attrs.items():
+                grp.attrs[key] = value
+        f["what"].attrs["date"] = np.bytes_(f"{timestamp:%Y%m%d}")
+        f["what"].attrs["time"] = np.bytes_(f"{timestamp:%H%M%S}")
+        dset_what = f.create_group("dataset1/what")
+        for prefix in ("start", "end"):
+            dset_what.attrs[f"{prefix}date"] = np.bytes_(f"{timestamp:%Y%m%d}")
+            dset_what.attrs[f"{prefix}time"] = np.bytes_(f"{timestamp:%H%M%S}")
+        dset_what.attrs["product"] = np.bytes_("COMP")
+        data_grp = f.create_group("dataset1/data1")
+        data_grp.create_dataset("data", data=data, compression="gzip", compression_opts=1)
+        what = data_grp.create_group("what")
+        what.attrs["quantity"] = np.bytes_("DBZH")
+        what.attrs["gain"] = GAIN
+        what.attrs["offset"] = OFFSET
+        what.attrs["undetect"] = float(UNDETECT)
+        what.attrs["nodata"] = float(NODATA)
+
+
+def write_pgm(fname, data, comments):
+    """Write an FMI PGM composite with the given header comments"""
+    pgm_io.write_pgm(fname, data, maxval=255, comments=comments)
+
+
+def generate(out_dir, domain="ravake", fmt="odim", end_time=None, count=4, timestep=5,
+             wet_fraction=0.1, velocity=(2.0, 3.0), cell_scale=40.0, evolution=0.05,
+             nodata_fraction=0.0, pgm_header=None, fn_pattern=None, seed=0):
+    """Generate a sequence of composites ending at `end_time` into `out_dir`.
+
+    Output:
+        dictionary with data source settings (for the data_source config
+        group) and the list of written files
+    """
+    shape, template_attrs = read_template(template_fname(domain))
+    end_time = end_time or dt.datetime(2023, 1, 1, 12, 0)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if fmt == "pgm":
+        fn_pattern = fn_pattern or PGM_FN_PATTERN
+        if pgm_header is None:
+            pgm_header = REPO_CONFIG.joinpath(f"{domain}_PGM_stere.hdr")
+            if not pgm_header.exists():
+                pgm_header = REPO_CONFIG.joinpath("europe_PGM_stere.hdr")
+        comments = pgm_io.read_hdr_file(pgm_header)["comments"]
+    else:
+        fn_pattern = fn_pattern or ODIM_FN_PATTERN
+
+    files = []
+    fields = rain_sequence(shape, count, wet_fraction=wet_fraction, velocity=velocity,
+                           cell_scale=cell_scale, evolution=evolution,
+                           nodata_fraction=nodata_fraction, seed=seed)
+    for index, dbz in enumerate(fields):
+        timestamp = end_time - (count - 1 - index) * dt.timedelta(minutes=timestep)
+        data = encode(dbz)
+        if fmt == "pgm":
+            fname = out_dir.joinpath(f"{timestamp:{fn_pattern}}.pgm")
+            write_pgm(fname, data, comments)
+        else:
+            fname = out_dir.joinpath(f"{timestamp:{fn_pattern}}.h5")
+            write_odim(fname, data, timestamp, template_attrs)
+        files.append(fname)
+
+    data_source = {
+        "root_path": str(out_dir),
+        "path_fmt": "",
+        "fn_pattern": fn_pattern,
+        "fn_ext": "pgm" if fmt == "pgm" else "h5",
+        "importer": "fmippn_pgm" if fmt == "pgm" else "odim_hdf5",
+        "timestep": timestep,
+        "importer_kwargs": {"gzipped": False} if fmt == "pgm" else {"gzipped": False, "qty": "DBZH"},
+    }
+    return {"data_source": data_source, "files": files, "shape": shape,
+            "end_time": end_time}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--domain", default="ravake", help="Template config/template_DOMAIN=<domain>.h5")
+    parser.add_argument("--format", dest="fmt", choices=["odim", "pgm"], default="odim")
+    parser.add_argument("--out", required=True, help="Output folder")
+    parser.add_argument("--end", help="Time of the last composite", metavar="YYYYMMDDHHMM")
+    parser.add_argument("--count", type=int, default=4, help="Number of composites")
+    parser.add_argument("--timestep", type=int, default=5, help="Minutes between composites")
+    parser.add_argument("--wet", type=float, default=0.1, help="Fraction of wet pixels")
+    parser.add_argument("--velocity", nargs=2, type=float, default=[2.0, 3.0],
+                        help="Rain motion dy dx in pixels per timestep")
+    parser.add_argument("--cell-scale", type=float, default=40.0, help="Rain feature size in pixels")
+    parser.add_argument("--evolution", type=float, default=0.05)
+    parser.add_argument("--nodata", type=float, default=0.0, help="Fraction of nodata pixels")
+    parser.add_argument("--pgm-header", help="Domain header file for PGM comments")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    end_time = dt.datetime.strptime(args.end, "%Y%m%d%H%M") if args.end else None
+    result = generate(args.out, domain=args.domain, fmt=args.fmt, end_time=end_time,
+                      count=args.count, timestep=args.timestep, wet_fraction=args.wet,
+                      velocity=args.velocity, cell_scale=args.cell_scale,
+                      evolution=args.evolution, nodata_fraction=args.nodata,
+                      pgm_header=args.pgm_header, seed=args.seed)
+    print(f"Wrote {len(result['files'])} composites of {result['shape'][0]}x{result['shape'][1]} "
+          f"to {args.out}, last {result['end_time']:%Y%m%d%H%M}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Trace events of a nowcast slot for the Chrome/Perfetto trace viewer.
+
+Spans are stored as trace events ("ph": "X", timestamps in microseconds
+since the epoch) in a JSON lines file. The shell scripts of a slot append
+their spans to the same file (trace_span in config/common_functions.sh), so
+the Python run and the shell stages end up in one timeline. Convert the file
+to trace-event JSON, which chrome://tracing and ui.perfetto.dev open, with
+
+    python tracing.py export trace.jsonl trace.json
+
+In Python, spans are collected with `span(name, **args)` after `start()`.
+metrics.stage() and metrics.timed() record a span too, so all measured
+stages appear in the trace. Events are buffered and appended to the file by
+`finish()`, or at exit if the run ends with an error.
+"""
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+_trace_file = None
+_events = []
+_lock = threading.Lock()
+_exit_hook_registered = False
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+def _add(event):
+    with _lock:
+        _events.append(event)
+
+
+def start(trace_file, process_name="ppn", **args):
+    """Start collecting spans into `trace_file` (JSON lines)"""
+    global _trace_file, _exit_hook_registered
+    _trace_file = trace_file
+    _events.clear()
+    _add({"name": "process_name", "ph": "M", "pid": os.getpid(), "tid": threading.get_native_id(),
+          "args": {"name": process_name}})
+    _add({"name": "process_labels", "ph": "M", "pid": os.getpid(), "tid": threading.get_native_id(),
+          "args": {"labels": ", ".join(f"{key}={value}" for key, value in args.items())}})
+    # Once per process, batch mode starts a trace for every run
+    if not _exit_hook_registered:
+        atexit.register(finish)
+        _exit_hook_registered = True
+
+
+def enabled():
+    return _trace_file is not None
+
+
+@contextlib.contextmanager
+def _span(name, category, args):
+    start_us = _now_us()
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        event = {"name": name, "cat": category, "ph": "X", "ts": start_us,
+                 "dur": (time.perf_counter_ns() - start_ns) / 1000.0,
+                 "pid": os.getpid(), "tid": threading.get_native_id()}
+        if args:
+            event["args"] = args
+        _add(event)
+
+
+def span(name, category="ppn", **args):
+    """Context manager recording a span, no-op if tracing is not started"""
+    if _trace_file is None:
+        return contextlib.nullcontext()
+    return _span(name, category, args)
+
+
+def instant(name, category="ppn", **args):
+    """Record an instant event, e.g. a deadline being reached"""
+    if _trace_file is not None:
+        _add({"name": name, "cat": category, "ph": "i", "s": "p", "ts": _now_us(),
+              "pid": os.getpid(), "tid": threading.get_native_id(), "args": args})
+
+
+def finish():
+    """Append collected events to the trace file"""
+    global _trace_file
+    if _trace_file is None:
+        return
+    with _lock:
+        lines = "".join(json.dumps(event) + "\n" for event in _events)
+        _events.clear()
+    # One write, so the events are not mixed with lines appended by other processes
+    with open(_trace_file, "a") as f:
+        f.write(lines)
+    _trace_file = None
+
+
+def export(jsonl_fname, json_fname):
+    """Convert JSON lines trace file to Chrome trace-event JSON"""
+    events = []
+    with open(jsonl_fname, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    events.sort(key=lambda event: event.get("ts", 0))
+    with open(json_fname, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FMI-PPN trace files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Convert JSON lines trace to Chrome trace JSON")
+    export_parser.add_argument("jsonl_file")
+    export_parser.add_argument("json_file")
+    args = parser.parse_args()
+    if args.command == "export":
+        n_events = export(args.jsonl_file, args.json_file)
+        print(f"Wrote {n_events} trace events to {args.json_file}")
+
+
+if __name__ == "__main__":
+    main()
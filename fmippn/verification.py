@@ -0,0 +1,232 @@
+"""Online verification of past nowcasts for FMI-PPN.
+
+Each run verifies the nowcasts of earlier runs that are valid at its newest
+observation: for leadtime k, the run started k nowcast timesteps earlier.
+Only the leadtime valid at the observation time is read from the past
+output (ppn_reader reads single fields lazily), so the cost per run does not
+grow with the length of the verification period.
+
+Scores are computed in rain rate (mm/h) and accumulated per forecast type
+("det" or "ens") and leadtime in a JSON state file:
+
+    contingency table per rain rate threshold -- CSI, POD, FAR
+    (ensemble: all members pooled)
+    absolute error sum                        -- MAE (ensemble: of the mean)
+    CRPS sum (ensemble only)                  -- CRPS
+
+Members without any data at the valid time (time-lagged members after the
+end of their run's forecast) are left out. Pixels where the observation or
+any remaining forecast value is nodata are left out.
+A past run is verified only once for each valid time, also when a slot is
+rerun.
+"""
+import datetime as dt
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+import ppn_reader
+
+# Number of verified (type, startdate, validtime) keys kept for detecting reruns
+MAX_VERIFIED_KEYS = 5000
+
+
+def crps_ensemble(members, observation):
+    """CRPS of an ensemble for each pixel.
+
+    Input:
+        members -- array (member, pixel)
+        observation -- array (pixel,)
+
+    Output:
+        array (pixel,), CRPS = E|X - y| - E|X - X'| / 2 with the empirical
+        distribution of the members
+    """
+    n_members = members.shape[0]
+    absolute_error = np.mean(np.abs(members - observation), axis=0)
+    # E|X - X'| from sorted members: 2 / M^2 * sum_i (2i - M - 1) x_(i), i = 1..M
+    weights = (2.0 * np.arange(1, n_members + 1) - n_members - 1).astype(members.dtype)
+    spread = 2.0 / n_members**2 * np.tensordot(weights, np.sort(members, axis=0), axes=1)
+    return absolute_error - 0.5 * spread
+
+
+def contingency(forecasts, observation, thresholds):
+    """Contingency table counts for each threshold.
+
+    Input:
+        forecasts -- array (forecast, pixel), e.g. ensemble members
+        observation -- array (pixel,)
+        thresholds -- rain rate thresholds
+
+    Output:
+        int64 array (threshold, 4): hits, misses, false alarms, correct negatives
+    """
+    counts = np.zeros((len(thresholds), 4), dtype=np.int64)
+    for index, threshold in enumerate(thresholds):
+        observed = observation >= threshold
+        n_observed = np.count_nonzero(observed)
+        forecast = forecasts >= threshold
+        hits = np.count_nonzero(forecast & observed)
+        n_forecast = np.count_nonzero(forecast)
+        n_total = forecast.size
+        counts[index] = (hits, forecasts.shape[0] * n_observed - hits, n_forecast - hits,
+                         n_total - n_forecast - forecasts.shape[0] * n_observed + hits)
+    return counts
+
+
+class _Accumulator:
+    """Running sums of one forecast type and leadtime"""
+    def __init__(self, n_thresholds, values=None):
+        values = values or dict()
+        self.n_pixels = values.get("n_pixels", 0)
+        self.n_forecasts = values.get("n_forecasts", 0)
+        self.abs_error = values.get("abs_error", 0.0)
+        self.crps = values.get("crps", 0.0)
+        self.table = np.array(values.get("table", np.zeros((n_thresholds, 4))), dtype=np.int64)
+
+    def add(self, forecasts, observation, thresholds):
+        """Add forecasts (forecast, pixel) and observation (pixel,) with nodata removed"""
+        self.n_pixels += observation.size
+        self.n_forecasts += 1
+        mean = forecasts.mean(axis=0) if forecasts.shape[0] > 1 else forecasts[0]
+        self.abs_error += float(np.abs(mean - observation).sum(dtype=np.float64))
+        if forecasts.shape[0] > 1:
+            self.crps += float(crps_ensemble(forecasts, observation).sum(dtype=np.float64))
+        self.table += contingency(forecasts, observation, thresholds)
+
+    def as_dict(self):
+        return {"n_pixels": self.n_pixels, "n_forecasts": self.n_forecasts,
+                "abs_error": self.abs_error, "crps": self.crps, "table": self.table.tolist()}
+
+
+def scores(values, thresholds, ensemble):
+    """Return scores from accumulated values (see _Accumulator.as_dict)"""
+    n_pixels = values["n_pixels"]
+    result = {"n_forecasts": values["n_forecasts"], "n_pixels": n_pixels,
+              "mae": values["abs_error"] / n_pixels if n_pixels else None}
+    if ensemble:
+        result["crps"] = values["crps"] / n_pixels if n_pixels else None
+    for threshold, (hits, misses, false_alarms, _) in zip(thresholds, values["table"]):
+        result[f"csi_{threshold:g}"] = (hits / (hits + misses + false_alarms)
+                                        if hits + misses + false_alarms else None)
+        result[f"pod_{threshold:g}"] = hits / (hits + misses) if hits + misses else None
+        result[f"far_{threshold:g}"] = false_alarms / (hits + false_alarms) if hits + false_alarms else None
+    return result
+
+
+class Verification:
+    """Verification accumulators kept in a JSON state file.
+
+    Usage:
+        verif = Verification("/var/tmp/ppn_verif.json", thresholds=[0.1, 1, 5])
+        verif.add("ens", 15, startdate, validtime, members, observation)  # rain rates
+        verif.save()
+        verif.scores()  # {"ens": {15: {"crps": ..., "csi_1": ...}}}
+    """
+    def __init__(self, state_file, thresholds):
+        self.state_file = Path(state_file).expanduser()
+        self.thresholds = [float(threshold) for threshold in thresholds]
+        self._accumulators = {"det": dict(), "ens": dict()}
+        self._verified = []
+        self.slot_scores = {"det": dict(), "ens": dict()}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get("thresholds") != self.thresholds:
+            # Accumulated tables do not match the thresholds, start over
+            return
+        for fc_type, leadtimes in state["accumulators"].items():
+            for leadtime, values in leadtimes.items():
+                self._accumulators[fc_type][int(leadtime)] = _Accumulator(len(self.thresholds), values)
+        self._verified = state.get("verified", [])
+
+    def is_verified(self, fc_type, startdate, validtime):
+        return f"{fc_type}/{startdate:%Y%m%d%H%M}/{validtime:%Y%m%d%H%M}" in self._verified
+
+    def add(self, fc_type, leadtime, startdate, validtime, forecasts, observation):
+        """Verify forecasts (forecast, y, x) of the run at `startdate` against
+        `observation` (y, x). Return False if nothing was added."""
+        if self.is_verified(fc_type, startdate, validtime):
+            return False
+        forecasts = forecasts.reshape(forecasts.shape[0], -1)
+        forecasts = forecasts[np.isfinite(forecasts).any(axis=1)]
+        if forecasts.shape[0] == 0:
+            return False
+        observation = observation.reshape(-1)
+        valid = np.isfinite(observation) & np.all(np.isfinite(forecasts), axis=0)
+        forecasts = forecasts[:, valid]
+        observation = observation[valid]
+        if observation.size == 0:
+            return False
+
+        self._accumulators[fc_type].setdefault(leadtime, _Accumulator(len(self.thresholds)))
+        self._accumulators[fc_type][leadtime].add(forecasts, observation, self.thresholds)
+        slot = _Accumulator(len(self.thresholds))
+        slot.add(forecasts, observation, self.thresholds)
+        self.slot_scores[fc_type][leadtime] = scores(slot.as_dict(), self.thresholds, fc_type == "ens")
+        self._verified.append(f"{fc_type}/{startdate:%Y%m%d%H%M}/{validtime:%Y%m%d%H%M}")
+        return True
+
+    def scores(self):
+        """Return accumulated scores by forecast type and leadtime (minutes)"""
+        return {fc_type: {leadtime: scores(acc.as_dict(), self.thresholds, fc_type == "ens")
+                          for leadtime, acc in sorted(accumulators.items())}
+                for fc_type, accumulators in self._accumulators.items()}
+
+    def save(self):
+        state = {
+            "thresholds": self.thresholds,
+            "updated": dt.datetime.utcnow().isoformat(timespec="seconds"),
+            "accumulators": {fc_type: {str(leadtime): acc.as_dict() for leadtime, acc in accs.items()}
+                             for fc_type, accs in self._accumulators.items()},
+            "verified": self._verified[-MAX_VERIFIED_KEYS:],
+        }
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fname = self.state_file.with_name(f".{self.state_file.name}.{os.getpid()}")
+        with open(tmp_fname, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_fname, self.state_file)
+
+    def write_slot_scores(self, scores_file, validtime, **labels):
+        """Append scores of this run's verification to a JSON lines file"""
+        record = dict(labels, validtime=f"{validtime:%Y%m%d%H%M}",
+                      scores={fc_type: {str(leadtime): values for leadtime, values in leadtimes.items()}
+                              for fc_type, leadtimes in self.slot_scores.items() if leadtimes})
+        Path(scores_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(scores_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_valid_field(paths, validtime, undetect_value=None):
+    """Read the fields valid at `validtime` from past output.
+
+    Input:
+        paths -- output file of a run, or list of callback files (one per
+                 member) that contain the leadtime
+        validtime -- datetime
+        undetect_value -- value for undetect pixels (default=unpack them)
+
+    Output:
+        float array (forecast, y, x) in the units of the stored output, or
+        None if the output has no field valid at `validtime`
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    fields = []
+    for path in paths:
+        with ppn_reader.open_output(path) as output:
+            if validtime not in output.valid_times:
+                return None
+            index = output.valid_times.index(validtime)
+            if output.ensemble is not None:
+                fields.append(output.ensemble.decoded(undetect_value=undetect_value)[:, index])
+            else:
+                fields.append(output.deterministic.decoded(undetect_value=undetect_value)[index][None])
+    return np.concatenate(fields)
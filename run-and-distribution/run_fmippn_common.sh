@@ -34,9 +34,17 @@ fi
 conda activate $CONDAENV
 
 
+# Trace of the slot (see fmippn/tracing.py), enabled by setting TRACEDIR
+if [ $TRACEDIR ]; then
+   mkdir -p $TRACEDIR
+   export FMIPPN_TRACE_FILE=$TRACEDIR/trace_DOMAIN=${DOMAIN}_${TIMESTAMP}.jsonl
+   echo "{\"name\": \"process_name\", \"ph\": \"M\", \"pid\": $$, \"tid\": $$, \"args\": {\"name\": \"run_fmippn_common.sh\"}}" >> $FMIPPN_TRACE_FILE
+fi
+
 set_BeginTime
 echo "$BeginStamp : BEGIN=fmippn domain=${DOMAIN} timestamp=$TIMESTAMP" >> $RUNLOG
 fmippn_BeginTime=$BeginTime # store the begin time of whole fmippn process
+fmippn_BeginUs=$BeginUs
 
 #______________________________________________________________
 # Preprocess
@@ -51,7 +59,13 @@ if [ -e $PREPROC ]; then
        source $COMMONCONF  
    fi
 fi
+# Decode the new composite once into shared memory for run_ppn.py (see fmippn/shm_io.py),
+# enabled by setting SHM_INPUT=1 (and shared_memory_input.enabled in the configuration)
+if [ $SHM_INPUT ]; then
+   $PYTHON $PPNDIR/shm_io.py publish --config=${DOMAIN} --timestamp=${TIMESTAMP} >> $PREPROCLOG 2>&1
+fi
 get_Runtime
+trace_span preprocess
 echo "$EndStamp : END=preprocess domain=${DOMAIN} timestamp=$TIMESTAMP runtime=$Runtime" >> $RUNLOG
 
 #______________________________________________________________
@@ -63,6 +77,7 @@ cd $PPNDIR
 # conda info -e
 $PYTHON run_ppn.py --timestamp=${TIMESTAMP} --config=${DOMAIN}  >> $PPNLOG 2>&1
 get_Runtime
+trace_span ppn
 echo "$EndStamp : END=ppn domain=${DOMAIN} timestamp=$TIMESTAMP runtime=$Runtime" >> $RUNLOG
 
 #______________________________________________________________
@@ -73,6 +88,7 @@ echo "$BeginStamp : BEGIN=postprocess domain=${DOMAIN} timestamp=$TIMESTAMP" >>
 cd $POSTPROCDIR
 ./run_postprocesses.sh >> $RUNLOG
 get_Runtime
+trace_span postprocess
 echo "$EndStamp : END=postprocess domain=${DOMAIN} timestamp=$TIMESTAMP runtime=$Runtime" >> $RUNLOG
 
 
@@ -86,6 +102,7 @@ if [ -e $DISTRIBUTE ]; then
    echo "$BeginStamp : BEGIN=distribution domain=${DOMAIN} timestamp=$TIMESTAMP" >> $RUNLOG
    ./$DISTRIBUTE >> $DISTRIBLOG 2>&1 
    get_Runtime
+   trace_span distribution
    echo "$EndStamp : END=distribution domain=${DOMAIN} timestamp=$TIMESTAMP runtime=$Runtime" >> $RUNLOG
 fi
 
@@ -94,8 +111,22 @@ fi
 
 find $PPN_OUTPUT_DIR -name 'nc_????????????.h5' -mmin +15 -exec rm -f {} \;
 find $OBSDIR -type f -mtime +1 -exec rm -f {} \;
-conda deactivate
+if [ $SHM_INPUT ]; then
+   $PYTHON $PPNDIR/shm_io.py cleanup --prefix=fmippn_${DOMAIN} --older-than=${SHM_INPUT_MINUTES:-120} >> $RUNLOG 2>&1
+fi
+# Shared memory output arenas (see fmippn/output_arena.py), enabled by SHM_OUTPUT=1
+if [ $SHM_OUTPUT ]; then
+   for tag in ens det; do
+      $PYTHON $PPNDIR/shm_io.py cleanup --prefix=fmippn_${DOMAIN}_out_${tag} --older-than=${SHM_OUTPUT_MINUTES:-60} >> $RUNLOG 2>&1
+   done
+fi
 BeginTime=$fmippn_BeginTime
+BeginUs=$fmippn_BeginUs
 get_Runtime
+trace_span fmippn
+if [ $FMIPPN_TRACE_FILE ]; then
+   $PYTHON $PPNDIR/tracing.py export $FMIPPN_TRACE_FILE ${FMIPPN_TRACE_FILE%.jsonl}.json >> $RUNLOG 2>&1
+fi
+conda deactivate
 echo "$EndStamp : END=fmippn domain=${DOMAIN} timestamp=$TIMESTAMP runtime=$Runtime" >> $RUNLOG
 exit